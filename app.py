@@ -1,9 +1,21 @@
 import os
 import base64
 from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, Response, stream_with_context
 from pymongo import MongoClient
-from courses import get_user_courses, save_user_courses
+from courses import get_user_courses, save_user_courses, record_courses, record_course_count, session_courses
+from result_store import result_store
+from basket import (
+    basket_service, basket_item_code, basket_contains, compact_basket_item,
+    hydrate_basket, is_compact_basket_item, session_basket_item
+)
+from session_backend import SESSION_FREE_ENDPOINTS, configure_session_backend, session_backend_stats
+from catalog import course_catalog, register_course_levels
+from engine import qualification_engine
+from db_health import connection_health
+from batch import detect_format, run_batch_text
+from qualification_cache import qualification_cache
+from qualification import GRADE_VALUES
 from pymongo.errors import ConnectionFailure, ServerSelectionTimeoutError
 from dotenv import load_dotenv
 from bson import ObjectId
@@ -11,6 +23,7 @@ import requests
 from requests.auth import HTTPBasicAuth
 import json
 import re
+import time
 from datetime import timedelta
 
 
@@ -20,12 +33,13 @@ load_dotenv()
 app = Flask(__name__)
 app.secret_key = os.getenv('FLASK_SECRET_KEY', 'default_secret_key_not_for_production')
 app.config.update(
-    SESSION_TYPE='filesystem',
     PERMANENT_SESSION_LIFETIME=timedelta(minutes=30),
     SESSION_COOKIE_SECURE=True,
     SESSION_COOKIE_HTTPONLY=True,
     SESSION_COOKIE_SAMESITE='Lax',
-    SESSION_REFRESH_EACH_REQUEST=True,
+    # The session middleware rewrites last_activity at least once a minute while the
+    # user is active, which refreshes the stored session; no need to save every request
+    SESSION_REFRESH_EACH_REQUEST=False,
     PREFERRED_URL_SCHEME='https'
 )
 
@@ -39,10 +53,6 @@ SUBJECTS = {
     'building': 'ARD', 'electronics': 'COM', 'metalwork': 'ARD'
 }
 
-GRADE_VALUES = {
-    'A': 12, 'A-': 11, 'B+': 10, 'B': 9, 'B-': 8, 'C+': 7, 'C': 6, 'C-': 5,
-    'D+': 4, 'D': 3, 'D-': 2, 'E': 1
-}
 CLUSTER_NAMES = {
     'cluster_1': 'Law',
     'cluster_2': 'Business, Hospitality & Related',
@@ -66,44 +76,6 @@ CLUSTER_NAMES = {
     'cluster_20': 'Religious Studies, Theology, Islamic Studies & Related'
 }
 
-CLUSTERS = [f"cluster_{i}" for i in range(1, 21)]
-
-DIPLOMA_COLLECTIONS = [
-    "Agricultural_Sciences_Related", "Animal_Health_Related", "Applied_Sciences",
-    "Building_Construction_Related", "Business_Related", "Clothing_Fashion_Textile",
-    "Computing_IT_Related", "Education_Related", "Engineering_Technology_Related",
-    "Environmental_Sciences", "Food_Science_Related", "Graphics_MediaStudies_Related",
-    "Health_Sciences_Related", "HairDressing_Beauty_Therapy", "Hospitality_Hotel_Tourism_Related",
-    "Library_Information_Science", "Natural_Sciences_Related", "Nutrition_Dietetics",
-    "Social_Sciences", "Tax_Custom_Administration", "Technical_Courses"
-]
-
-KMTC_COLLECTIONS = ["kmtc_courses"]
-
-CERTIFICATE_COLLECTIONS = [
-    "Agricultural_Sciences", "Applied_Sciences", "Building_Construction_Related",
-    "Business_Related", "Clothing_Fashion_Textile", "Computing_IT_Related",
-    "Engineering_Technology_Related", "Environmental_Sciences", "Food_Science_Related",
-    "Graphics_MediaStudies_Related", "HairDressing_Beauty_Therapy", "Health_Sciences_Related",
-    "Hospitality_Hotel_Tourism_Related", "Library_Information_Science",
-    "Natural_Sciences_Related", "Nutrition_Dietetics", "Social_Sciences", "Tax_Custom_Administration"
-]
-
-ARTISAN_COLLECTIONS = [
-    "Business_Related",
-    "Building_Construction_Related",
-    "Engineering_Technology_Related",
-    "Food_Science_Related",
-    "Social_Sciences",
-    "Applied_Sciences",
-    "IT_Related",
-    "Hospitality_Hotel_Tourism_Related",
-    "Clothing_Fashion_Textile",
-    "Agricultural_Sciences_Related",
-    "Technical_Courses",
-    "Hair_Dressing_Beauty_Therapy"
-]
-
 
 # --- Database Connections ---
 MONGODB_URI = os.getenv('MONGODB_URI')
@@ -138,12 +110,14 @@ def initialize_database():
                 socketTimeoutMS=30000,
                 retryWrites=True,
                 retryReads=True,
-                maxPoolSize=50
+                maxPoolSize=50,
+                event_listeners=[connection_health]
             )
             
             # Test the connection
             client.admin.command('ping')
             print("✅ Successfully connected to MongoDB")
+            connection_health.start_probe(client)
             
             # Initialize databases
             db = client['Degree']
@@ -179,6 +153,7 @@ def initialize_database():
             
             try:
                 user_baskets_collection = db_user_data['user_baskets']
+                basket_service.attach(user_baskets_collection)
                 print("✅ User baskets collection initialized")
             except Exception as e:
                 print(f"❌ Error initializing user_baskets collection: {str(e)}")
@@ -412,6 +387,22 @@ def initialize_database():
                 print("❌ Failed to connect to MongoDB after multiple attempts")
                 return False
 database_connected = initialize_database()            
+
+# Server-side sessions (SESSION_BACKEND: auto, memory, filesystem, mongodb or cookie)
+configure_session_backend(app, db_user_data.client if database_connected else None)
+
+def configure_course_catalog():
+    """Register every course level with the in-process catalog snapshot"""
+    if not database_connected:
+        print("⚠️ Database not connected, course catalog not configured")
+        return
+    register_course_levels(db.client)
+    # Shared refresh generation, so /admin/catalog/refresh reaches every worker
+    course_catalog.attach(db_user_data['catalog_state'])
+    if course_catalog.live:
+        course_catalog.ensure_pushdown_indexes()
+
+configure_course_catalog()
             
 def get_user_courses_data(email, index_number, level):
     """Get user courses from database with better validation"""
@@ -426,15 +417,9 @@ def get_user_courses_data(email, index_number, level):
                 'level': level
             })
             
-            if courses_data and 'courses' in courses_data:
-                # Validate and convert courses
-                valid_courses = []
-                for course in courses_data['courses']:
-                    if course and isinstance(course, dict):
-                        course_dict = dict(course)
-                        if '_id' in course_dict and isinstance(course_dict['_id'], ObjectId):
-                            course_dict['_id'] = str(course_dict['_id'])
-                        valid_courses.append(course_dict)
+            if courses_data and ('courses' in courses_data or 'course_refs' in courses_data):
+                # Hydrate course references (or legacy embedded copies)
+                valid_courses = record_courses(level, courses_data)
                 
                 courses_data['courses'] = valid_courses
                 courses_data['courses_count'] = len(valid_courses)
@@ -445,8 +430,9 @@ def get_user_courses_data(email, index_number, level):
     
     # Fallback to session
     if not courses_data or not courses_data.get('courses'):
-        session_key = f'{level}_courses_{index_number}'
-        courses_data = session.get(session_key)
+        session_data = session.get(f'{level}_courses_{index_number}')
+        courses = session_courses(level, index_number)
+        courses_data = dict(session_data, courses=courses) if session_data and courses is not None else session_data
         
         if courses_data and 'courses' in courses_data:
             print(f"✅ Loaded {len(courses_data['courses'])} courses from session for {level}")
@@ -494,16 +480,65 @@ def clear_session_data(partial=False):
     # Reinitialize session
     init_session()
 
+# last_activity is rewritten at most this often, so most requests leave the session untouched
+SESSION_ACTIVITY_INTERVAL = timedelta(seconds=int(os.getenv('SESSION_ACTIVITY_INTERVAL', '60') or 0))
+
 @app.before_request
-def check_session_timeout():
-    """Check for session timeout and handle accordingly"""
-    if 'last_activity' in session:
-        last_activity = datetime.fromisoformat(session['last_activity'])
-        if datetime.now() - last_activity > timedelta(minutes=30):
-            clear_session_data()
-            return redirect(url_for('index'))
+def session_middleware():
+    """Single session hook: init, timeout, throttled activity tracking and page-refresh handling"""
+    if request.endpoint in SESSION_FREE_ENDPOINTS:
+        return None
+    
+    # Initialize session if needed
+    if 'initialized' not in session:
+        init_session()
+    
+    # Check for session timeout
+    now = datetime.now()
+    last_activity = session.get('last_activity')
+    try:
+        last_activity = datetime.fromisoformat(last_activity) if last_activity else None
+    except (TypeError, ValueError):
+        last_activity = None
+    if last_activity and now - last_activity > app.permanent_session_lifetime:
+        clear_session_data()
+        return redirect(url_for('index'))
     
-    session['last_activity'] = datetime.now().isoformat()
+    # Update last activity (throttled)
+    if last_activity is None or now - last_activity >= SESSION_ACTIVITY_INTERVAL:
+        session['last_activity'] = now.isoformat()
+    
+    # Adds the database rejected as duplicates when they were flushed (see basket.py)
+    index_number = session.get('index_number')
+    if index_number and database_connected:
+        dropped = basket_service.take_dropped(index_number)
+        if dropped and isinstance(session.get('course_basket'), list):
+            session['course_basket'] = [
+                item for item in session['course_basket'] if item.get('basket_id') not in dropped
+            ]
+            print(f"🔄 Dropped {len(dropped)} duplicate basket items from the session")
+    
+    # Handle page refresh for course pages: a course handle that came from the
+    # database is dropped so the page reloads it; no database read needed here
+    if request.endpoint in ('results', 'basket'):
+        index_number = session.get('index_number')
+        current_level = session.get('current_level')
+        if session.get('email') and index_number and current_level:
+            session_key = f'{current_level}_courses_{index_number}'
+            handle = session.get(session_key)
+            if handle and handle.get('from_db'):
+                session.pop(session_key, None)
+                print(f"🔄 Refreshing courses from database for {current_level}")
+    
+    # For basket operations, protect critical session data
+    if request.endpoint == 'clear_basket':
+        protected_keys = [
+            'email', 'index_number', 'verified_payment', 'verified_index', 
+            'verified_receipt', 'current_flow', 'current_level'
+        ]
+        request.protected_session_data = {
+            k: session[k] for k in protected_keys if k in session
+        }
 
 # --- Helper Classes ---
 class JSONEncoder:
@@ -515,225 +550,65 @@ class JSONEncoder:
 
 app.json_encoder = JSONEncoder
 
-# --- Helper Functions ---
-def parse_grade(grade_str):
-    """Parse grade string, handling unexpected formats"""
-    if not grade_str:
-        return None
-    if grade_str in GRADE_VALUES:
-        return grade_str
-    if '/' in grade_str:
-        parts = grade_str.split('/')
-        for part in parts:
-            if part in GRADE_VALUES:
-                return part
-    return None
-
-def meets_requirement(requirement_key, requirement_grade, user_grades):
-    """Check if user meets a single requirement (handles / for either/or)"""
-    parsed_grade = parse_grade(requirement_grade)
-    if not parsed_grade:
-        return False
-        
-    if '/' in requirement_key:
-        alternatives = requirement_key.split('/')
-        for subject in alternatives:
-            if subject in user_grades:
-                if GRADE_VALUES[user_grades[subject]] >= GRADE_VALUES[parsed_grade]:
-                    return True
-        return False
-    else:
-        if requirement_key in user_grades:
-            return GRADE_VALUES[user_grades[requirement_key]] >= GRADE_VALUES[parsed_grade]
-        return False
-
-def check_course_qualification(course, user_grades, user_cluster_points):
-    """Check if user qualifies for a specific course based on subjects and cluster points"""
-    requirements = course.get('minimum_subject_requirements', {})
-    
-    subject_qualified = True
-    if requirements:
-        for subject_key, required_grade in requirements.items():
-            if not meets_requirement(subject_key, required_grade, user_grades):
-                subject_qualified = False
-                break
-    
-    cluster_qualified = True
-    cluster_name = course.get('cluster', '')
-    cut_off_points = course.get('cut_off_points', 0)
-    
-    if cluster_name and cut_off_points:
-        user_points = user_cluster_points.get(cluster_name, 0)
-        if user_points < cut_off_points:
-            cluster_qualified = False
-    
-    return subject_qualified and cluster_qualified
-
-def check_diploma_course_qualification(course, user_grades, user_mean_grade):
-    """Check if user qualifies for a specific diploma course based on mean grade and subject requirements"""
-    mean_grade_qualified = True
-    min_mean_grade = course.get('minimum_grade', {}).get('mean_grade')
-    
-    if min_mean_grade:
-        if GRADE_VALUES[user_mean_grade] < GRADE_VALUES[min_mean_grade]:
-            mean_grade_qualified = False
-    
-    subject_qualified = True
-    requirements = course.get('minimum_subject_requirements', {})
-    
-    if requirements:
-        for subject_key, required_grade in requirements.items():
-            if not meets_requirement(subject_key, required_grade, user_grades):
-                subject_qualified = False
-                break
-    
-    return mean_grade_qualified and subject_qualified
-
-def check_certificate_course_qualification(course, user_grades, user_mean_grade):
-    """Check if user qualifies for a specific certificate course based on mean grade and subject requirements"""
-    return check_diploma_course_qualification(course, user_grades, user_mean_grade)
+# --- Course Qualification Functions ---
+# All qualification goes through the shared engine (see engine.py), which runs
+# against the in-process catalog snapshot with compiled requirements, caches
+# results per grade profile and deduplicates concurrent identical requests.
+def get_qualifying_courses_for_flow(flow):
+    """Get the courses of any level that the grade profile in the session qualifies for"""
+    if not database_connected:
+        print(f"❌ Database not available for {flow} courses")
+        return []
+    return qualification_engine.qualify_session(flow, session)
 
-def check_artisan_course_qualification(course, user_grades, user_mean_grade):
-    """Check if user qualifies for a specific artisan course based on mean grade and subject requirements"""
-    return check_diploma_course_qualification(course, user_grades, user_mean_grade)
+def requalify_after_resubmit(flow, user_grades, user_mean_grade=None, user_cluster_points=None):
+    """Changed grades: update the previous result incrementally so results load from the cache"""
+    if not database_connected:
+        return
+    try:
+        requalified = qualification_engine.requalify_session(
+            flow, session, user_grades, user_mean_grade, user_cluster_points
+        )
+        if requalified:
+            print(f"🔁 Re-qualified {flow}: +{len(requalified['added'])} / -{len(requalified['removed'])} courses "
+                  f"({requalified['evaluated']} re-checked)")
+    except Exception as e:
+        print(f"⚠️ Incremental re-qualification failed for {flow}: {str(e)}")
 
-# --- Course Qualification Functions ---
 def get_qualifying_courses(user_grades, user_cluster_points):
     """Get all degree courses that the user qualifies for"""
     if not database_connected:
         print("❌ Database not available for degree courses")
         return []
-        
-    qualifying_courses = []
-    
-    for collection_name in CLUSTERS:
-        try:
-            if collection_name not in db.list_collection_names():
-                continue
-                
-            collection = db[collection_name]
-            courses = collection.find()
-            
-            for course in courses:
-                course_with_cluster = dict(course)
-                course_with_cluster['cluster'] = collection_name
-                
-                if check_course_qualification(course_with_cluster, user_grades, user_cluster_points):
-                    qualifying_courses.append(course_with_cluster)
-        
-        except Exception as e:
-            print(f"Error processing collection {collection_name}: {str(e)}")
-            continue
-    
-    return qualifying_courses
+    return qualification_engine.qualify('degree', user_grades, user_cluster_points=user_cluster_points)
 
 def get_qualifying_diploma_courses(user_grades, user_mean_grade):
     """Get all diploma courses that the user qualifies for"""
     if not database_connected:
         print("❌ Database not available for diploma courses")
         return []
-        
-    qualifying_courses = []
-    
-    for collection_name in DIPLOMA_COLLECTIONS:
-        try:
-            if collection_name not in db_diploma.list_collection_names():
-                continue
-                
-            collection = db_diploma[collection_name]
-            courses = collection.find()
-            
-            for course in courses:
-                if check_diploma_course_qualification(course, user_grades, user_mean_grade):
-                    course_with_collection = dict(course)
-                    course_with_collection['collection'] = collection_name
-                    qualifying_courses.append(course_with_collection)
-        
-        except Exception as e:
-            print(f"Error processing diploma collection {collection_name}: {str(e)}")
-            continue
-    
-    return qualifying_courses
+    return qualification_engine.qualify('diploma', user_grades, user_mean_grade=user_mean_grade)
 
 def get_qualifying_kmtc_courses(user_grades, user_mean_grade):
     """Get all KMTC courses that the user qualifies for"""
     if not database_connected:
         print("❌ Database not available for KMTC courses")
         return []
-        
-    qualifying_courses = []
-    
-    try:
-        if 'kmtc_courses' not in db_kmtc.list_collection_names():
-            return qualifying_courses
-            
-        collection = db_kmtc['kmtc_courses']
-        courses = collection.find()
-        
-        for course in courses:
-            if check_diploma_course_qualification(course, user_grades, user_mean_grade):
-                qualifying_courses.append(course)
-                
-    except Exception as e:
-        print(f"Error processing KMTC collection: {str(e)}")
-        
-    return qualifying_courses
+    return qualification_engine.qualify('kmtc', user_grades, user_mean_grade=user_mean_grade)
 
 def get_qualifying_certificate_courses(user_grades, user_mean_grade):
     """Get all certificate courses that the user qualifies for"""
     if not database_connected:
         print("❌ Database not available for certificate courses")
         return []
-        
-    qualifying_courses = []
-    
-    for collection_name in CERTIFICATE_COLLECTIONS:
-        try:
-            if collection_name not in db_certificate.list_collection_names():
-                continue
-                
-            collection = db_certificate[collection_name]
-            courses = collection.find()
-            
-            for course in courses:
-                if check_certificate_course_qualification(course, user_grades, user_mean_grade):
-                    course_with_collection = dict(course)
-                    course_with_collection['collection'] = collection_name
-                    qualifying_courses.append(course_with_collection)
-        
-        except Exception as e:
-            print(f"Error processing certificate collection {collection_name}: {str(e)}")
-            continue
-    
-    return qualifying_courses
+    return qualification_engine.qualify('certificate', user_grades, user_mean_grade=user_mean_grade)
 
 def get_qualifying_artisan_courses(user_grades, user_mean_grade):
     """Get all artisan courses that the user qualifies for"""
     if not database_connected:
         print("❌ Database not available for artisan courses")
         return []
-        
-    qualifying_courses = []
-    
-    for collection_name in ARTISAN_COLLECTIONS:
-        try:
-            if collection_name not in db_artisan.list_collection_names():
-                continue
-                
-            collection = db_artisan[collection_name]
-            courses = collection.find()
-            
-            for course in courses:
-                if check_artisan_course_qualification(course, user_grades, user_mean_grade):
-                    course_with_collection = dict(course)
-                    course_with_collection['collection'] = collection_name
-                    qualifying_courses.append(course_with_collection)
-        
-        except Exception as e:
-            print(f"Error processing artisan collection {collection_name}: {str(e)}")
-            continue
-    
-    return qualifying_courses
+    return qualification_engine.qualify('artisan', user_grades, user_mean_grade=user_mean_grade)
 
 # --- Database Operations ---
 def save_user_payment(email, index_number, level, transaction_ref=None, amount=1):
@@ -791,71 +666,23 @@ def debug_user_courses():
     try:
         if database_connected and user_courses_collection is not None:
             db_rec = user_courses_collection.find_one({'email': email, 'index_number': index_number, 'level': level})
-            if db_rec and 'courses' in db_rec:
-                # convert ObjectId to str for JSON
-                for c in db_rec['courses']:
-                    if '_id' in c and isinstance(c['_id'], ObjectId):
-                        c['_id'] = str(c['_id'])
+            if db_rec:
+                db_rec['_id'] = str(db_rec['_id'])
+                # Show the hydrated courses next to the stored references
+                db_rec['courses'] = record_courses(level, db_rec, migrate=False)
     except Exception as e:
         print(f"❌ Debug: error reading DB record: {e}")
 
     try:
         session_key = f'{level}_courses_{index_number}'
         sess_rec = session.get(session_key)
+        if sess_rec:
+            sess_rec = dict(sess_rec, courses=session_courses(level, index_number))
     except Exception:
         sess_rec = None
 
     return jsonify({'success': True, 'db_record': db_rec, 'session_record': sess_rec})
 
-@app.before_request
-def manage_session():
-    """Manage session state and handle page refreshes"""
-    # Initialize session if needed
-    if 'initialized' not in session:
-        init_session()
-    
-    # Check for session timeout
-    if 'last_activity' in session:
-        last_activity = datetime.fromisoformat(session['last_activity'])
-        if datetime.now() - last_activity > timedelta(minutes=30):
-            clear_session_data()
-            return redirect(url_for('index'))
-    
-    # Update last activity
-    session['last_activity'] = datetime.now().isoformat()
-    
-    # Handle page refresh for course pages
-    if request.endpoint in ['results', 'basket']:
-        # Get current user info
-        email = session.get('email')
-        index_number = session.get('index_number')
-        current_level = session.get('current_level')
-        
-        if email and index_number and current_level:
-            # Only clear session course data if it exists in database
-            if database_connected:
-                courses_data = get_user_courses_data(email, index_number, current_level)
-                if courses_data and courses_data.get('courses'):
-                    # Clear session course data to get fresh data from DB
-                    session_key = f'{current_level}_courses_{index_number}'
-                    session.pop(session_key, None)
-                    print(f"🔄 Refreshing courses from database for {current_level}")
-                else:
-                    # Keep session data since no DB data exists
-                    print(f"ℹ️ Keeping session courses for {current_level} - not in database")
-    
-    # Protect critical session data
-    protected_keys = [
-        'email', 'index_number', 'verified_payment', 'verified_index', 
-        'verified_receipt', 'current_flow', 'current_level'
-    ]
-    
-    # For basket operations, protect critical data
-    if request.endpoint == 'clear_basket':
-        request.protected_session_data = {
-            k: session[k] for k in protected_keys if k in session
-        }
-
 @app.after_request
 def restore_protected_data(response):
     """Restore protected session data after request"""
@@ -953,15 +780,9 @@ def get_user_courses_data(email, index_number, level):
                 'level': level
             })
             
-            if courses_data and 'courses' in courses_data:
-                # Validate and convert courses
-                valid_courses = []
-                for course in courses_data['courses']:
-                    if course and isinstance(course, dict):
-                        course_dict = dict(course)
-                        if '_id' in course_dict and isinstance(course_dict['_id'], ObjectId):
-                            course_dict['_id'] = str(course_dict['_id'])
-                        valid_courses.append(course_dict)
+            if courses_data and ('courses' in courses_data or 'course_refs' in courses_data):
+                # Hydrate course references (or legacy embedded copies)
+                valid_courses = record_courses(level, courses_data)
                 
                 courses_data['courses'] = valid_courses
                 courses_data['courses_count'] = len(valid_courses)
@@ -972,8 +793,9 @@ def get_user_courses_data(email, index_number, level):
     
     # Fallback to session
     if not courses_data or not courses_data.get('courses'):
-        session_key = f'{level}_courses_{index_number}'
-        courses_data = session.get(session_key)
+        session_data = session.get(f'{level}_courses_{index_number}')
+        courses = session_courses(level, index_number)
+        courses_data = dict(session_data, courses=courses) if session_data and courses is not None else session_data
         
         if courses_data and 'courses' in courses_data:
             print(f"✅ Loaded {len(courses_data['courses'])} courses from session for {level}")
@@ -1072,42 +894,18 @@ def process_courses_after_payment(email, index_number, flow):
     
     try:
         qualifying_courses = []
-        user_grades = {}
-        user_mean_grade = None
-        user_cluster_points = {}
+        profile = qualification_engine.session_profile(flow, session)
         
-        # Get the appropriate data based on flow
         if flow == 'degree':
-            user_grades = session.get('degree_grades', {})
-            user_cluster_points = session.get('degree_cluster_points', {})
-            
             # 🔥 VALIDATION: Ensure we have required grade data
-            if not user_grades or not user_cluster_points:
-                print(f"⚠️ Missing required grade data for degree - Grades: {bool(user_grades)}, Points: {bool(user_cluster_points)}")
+            if not profile.complete:
+                print(f"⚠️ Missing required grade data for degree - Grades: {bool(profile.grades)}, Points: {bool(profile.cluster_points)}")
                 return False
                 
-            print(f"📊 Processing degree with {len(user_grades)} grades and {len(user_cluster_points)} cluster points")
-            qualifying_courses = get_qualifying_courses(user_grades, user_cluster_points)
-            
-        elif flow == 'diploma':
-            user_grades = session.get('diploma_grades', {})
-            user_mean_grade = session.get('diploma_mean_grade', '')
-            qualifying_courses = get_qualifying_diploma_courses(user_grades, user_mean_grade)
-            
-        elif flow == 'certificate':
-            user_grades = session.get('certificate_grades', {})
-            user_mean_grade = session.get('certificate_mean_grade', '')
-            qualifying_courses = get_qualifying_certificate_courses(user_grades, user_mean_grade)
-            
-        elif flow == 'artisan':
-            user_grades = session.get('artisan_grades', {})
-            user_mean_grade = session.get('artisan_mean_grade', '')
-            qualifying_courses = get_qualifying_artisan_courses(user_grades, user_mean_grade)
-            
-        elif flow == 'kmtc':
-            user_grades = session.get('kmtc_grades', {})
-            user_mean_grade = session.get('kmtc_mean_grade', '')
-            qualifying_courses = get_qualifying_kmtc_courses(user_grades, user_mean_grade)
+            print(f"📊 Processing degree with {len(profile.grades)} grades and {len(profile.cluster_points)} cluster points")
+        
+        if profile is not None:
+            qualifying_courses = get_qualifying_courses_for_flow(flow)
         
         # Save courses to database
         if qualifying_courses:
@@ -1728,7 +1526,11 @@ def get_user_existing_data(email, index_number):
                 {'index_number': index_number}
             ]
         })
-        user_data['courses'] = list(courses)
+        user_data['courses'] = []
+        for record in courses:
+            if 'course_refs' in record:
+                record['courses'] = record_courses(record.get('level'), record)
+            user_data['courses'].append(record)
         
         # Get paid categories
         user_data['paid_categories'] = get_user_paid_categories(email, index_number)
@@ -1739,44 +1541,6 @@ def get_user_existing_data(email, index_number):
     return user_data
 
 # --- Basket Database Functions ---
-def save_user_basket(email, index_number, basket_data):
-    """Save user basket to database with enhanced validation"""
-    print(f"💾 ENHANCED: Saving basket for {index_number}")
-    
-    # Validate and process basket data first
-    processed_basket = validate_and_process_basket(basket_data, "save")
-    
-    if not database_connected:
-        session['course_basket'] = processed_basket
-        print(f"💾 Basket saved to session: {len(processed_basket)} items")
-        return True
-        
-    basket_record = {
-        'email': email,
-        'index_number': index_number,
-        'basket': processed_basket,
-        'created_at': datetime.now(),
-        'updated_at': datetime.now(),
-        'is_active': True
-    }
-    
-    try:
-        result = user_baskets_collection.update_one(
-            {'index_number': index_number},
-            {'$set': basket_record},
-            upsert=True
-        )
-        print(f"✅ Basket saved to database for {index_number} with {len(processed_basket)} courses")
-        
-        # Also update session for consistency
-        session['course_basket'] = processed_basket
-        return True
-        
-    except Exception as e:
-        print(f"❌ Error saving user basket: {str(e)}")
-        # Fallback to session
-        session['course_basket'] = processed_basket
-        return False
 def get_user_basket_by_index(index_number):
     """Get user basket from database by index number with enhanced error handling"""
     print(f"🛒 ENHANCED: Loading basket for index: {index_number}")
@@ -1791,18 +1555,22 @@ def get_user_basket_by_index(index_number):
         
         return validate_and_process_basket(session_basket, "session")
     
+    # Adds/removes buffered by another worker are not in the database yet;
+    # until they are written the shared session holds the candidate's basket
+    if (session.get('index_number') == index_number
+            and session.get('basket_pending_until', 0) > time.time()
+            and not basket_service.is_pending(index_number)):
+        print("ℹ️ Basket writes pending in another worker, using session basket")
+        return validate_and_process_basket(session.get('course_basket', []), "session_pending")
+    
     # Database is connected - try to load from database with enhanced error handling
     try:
         print(f"🔍 Searching database for basket of index: {index_number}")
-        basket_data = user_baskets_collection.find_one({
-            'index_number': index_number,
-            'is_active': True
-        })
+        # Pending adds/removes of this candidate are flushed first
+        basket_items = basket_service.load(index_number)
         
-        if basket_data:
+        if basket_items is not None:
             print(f"✅ Found basket data in database for {index_number}")
-            basket_items = basket_data.get('basket', [])
-            
             processed_basket = validate_and_process_basket(basket_items, "database")
             
             # Update session with the database basket for consistency
@@ -1852,7 +1620,13 @@ def validate_and_process_basket(basket_data, source):
     # Validate and process each item
     processed_items = []
     for item in basket_data:
-        if isinstance(item, dict):
+        if isinstance(item, dict) and is_compact_basket_item(item):
+            # id-only items carry no display fields; they are hydrated from the catalog
+            if not (item.get('level') and item.get('basket_id')):
+                print(f"⚠️ {source}: Skipping incomplete basket item: {item}")
+                continue
+            processed_items.append(item)
+        elif isinstance(item, dict):
             # Ensure required fields exist
             if not (item.get('programme_name') or item.get('course_name')):
                 print(f"⚠️ {source}: Skipping item missing name: {item}")
@@ -1883,14 +1657,7 @@ def clear_user_basket(index_number):
     """Clear user basket from database without affecting session"""
     if database_connected:
         try:
-            result = user_baskets_collection.update_one(
-                {'index_number': index_number},
-                {'$set': {
-                    'basket': [],
-                    'updated_at': datetime.now(),
-                    'is_active': False
-                }}
-            )
+            basket_service.clear(index_number)
             print(f"✅ Basket database record cleared for {index_number}")
             return True
         except Exception as e:
@@ -1958,6 +1725,7 @@ def submit_grades():
                 except ValueError:
                     user_cluster_points[f"cluster_{i}"] = 0.0
         
+        requalify_after_resubmit('degree', user_grades, user_cluster_points=user_cluster_points)
         session['degree_grades'] = user_grades
         session['degree_cluster_points'] = user_cluster_points
         session['degree_data_submitted'] = True
@@ -1985,6 +1753,7 @@ def submit_diploma_grades():
                 if grade in GRADE_VALUES:
                     user_grades[subject_code] = grade
         
+        requalify_after_resubmit('diploma', user_grades, user_mean_grade)
         session['diploma_grades'] = user_grades
         session['diploma_mean_grade'] = user_mean_grade
         session['diploma_data_submitted'] = True
@@ -2012,6 +1781,7 @@ def submit_certificate_grades():
                 if grade in GRADE_VALUES:
                     user_grades[subject_code] = grade
         
+        requalify_after_resubmit('certificate', user_grades, user_mean_grade)
         session['certificate_grades'] = user_grades
         session['certificate_mean_grade'] = user_mean_grade
         session['certificate_data_submitted'] = True
@@ -2050,6 +1820,8 @@ def submit_artisan_grades():
         # 🔥 CRITICAL FIX: Enhanced session management
         session.permanent = True  # Ensure session persists
         
+        requalify_after_resubmit('artisan', user_grades, user_mean_grade)
+        
         # Store data in session with explicit modification
         session['artisan_grades'] = user_grades
         session['artisan_mean_grade'] = user_mean_grade
@@ -2098,6 +1870,7 @@ def submit_kmtc_grades():
                 if grade in GRADE_VALUES:
                     user_grades[subject_code] = grade
         
+        requalify_after_resubmit('kmtc', user_grades, user_mean_grade)
         session['kmtc_grades'] = user_grades
         session['kmtc_mean_grade'] = user_mean_grade
         session['kmtc_data_submitted'] = True
@@ -2126,7 +1899,17 @@ def enter_details(flow):
             return redirect(url_for(flow))
         
         print(f"✅ {flow} data validated successfully")
-        return render_template('enter_details.html', flow=flow)
+        
+        # Free count-only preview so nobody pays without knowing they qualify for something
+        preview = None
+        if database_connected:
+            try:
+                preview = qualification_engine.preview(flow, session)
+            except Exception as e:
+                print(f"⚠️ Could not compute qualification preview for {flow}: {str(e)}")
+        strategy = qualification_engine.strategy(flow)
+        return render_template('enter_details.html', flow=flow, preview=preview,
+                               flow_label=strategy.label if strategy else flow.title())
     
     # POST request handling
     try:
@@ -2188,38 +1971,8 @@ def enter_details(flow):
             
             # Generate courses immediately for manually activated users
             try:
-                qualifying_courses = []
                 print(f"🚀 Generating courses for {flow} flow")
-                
-                if flow == 'degree':
-                    user_grades = session.get('degree_grades', {})
-                    user_cluster_points = session.get('degree_cluster_points', {})
-                    print(f"📊 Degree grades: {user_grades}, Cluster points: {user_cluster_points}")
-                    qualifying_courses = get_qualifying_courses(user_grades, user_cluster_points)
-                    
-                elif flow == 'diploma':
-                    user_grades = session.get('diploma_grades', {})
-                    user_mean_grade = session.get('diploma_mean_grade', '')
-                    print(f"📊 Diploma grades: {user_grades}, Mean grade: {user_mean_grade}")
-                    qualifying_courses = get_qualifying_diploma_courses(user_grades, user_mean_grade)
-                    
-                elif flow == 'certificate':
-                    user_grades = session.get('certificate_grades', {})
-                    user_mean_grade = session.get('certificate_mean_grade', '')
-                    print(f"📊 Certificate grades: {user_grades}, Mean grade: {user_mean_grade}")
-                    qualifying_courses = get_qualifying_certificate_courses(user_grades, user_mean_grade)
-                    
-                elif flow == 'artisan':
-                    user_grades = session.get('artisan_grades', {})
-                    user_mean_grade = session.get('artisan_mean_grade', '')
-                    print(f"📊 Artisan grades: {user_grades}, Mean grade: {user_mean_grade}")
-                    qualifying_courses = get_qualifying_artisan_courses(user_grades, user_mean_grade)
-                    
-                elif flow == 'kmtc':
-                    user_grades = session.get('kmtc_grades', {})
-                    user_mean_grade = session.get('kmtc_mean_grade', '')
-                    print(f"📊 KMTC grades: {user_grades}, Mean grade: {user_mean_grade}")
-                    qualifying_courses = get_qualifying_kmtc_courses(user_grades, user_mean_grade)
+                qualifying_courses = get_qualifying_courses_for_flow(flow)
                 
                 print(f"📚 Found {len(qualifying_courses)} qualifying courses for {flow}")
                 
@@ -2692,30 +2445,12 @@ def show_results(flow):
         else:
             # Generate courses if not in database
             print(f"🔄 Courses not in database, generating for {flow}")
-            if flow == 'degree':
-                user_grades = session.get('degree_grades', {})
-                user_cluster_points = session.get('degree_cluster_points', {})
-                qualifying_courses = get_qualifying_courses(user_grades, user_cluster_points)
-                
-            elif flow == 'diploma':
-                user_grades = session.get('diploma_grades', {})
-                user_mean_grade = session.get('diploma_mean_grade', '')
-                qualifying_courses = get_qualifying_diploma_courses(user_grades, user_mean_grade)
-                
-            elif flow == 'certificate':
-                user_grades = session.get('certificate_grades', {})
-                user_mean_grade = session.get('certificate_mean_grade', '')
-                qualifying_courses = get_qualifying_certificate_courses(user_grades, user_mean_grade)
-                
-            elif flow == 'artisan':
-                user_grades = session.get('artisan_grades', {})
-                user_mean_grade = session.get('artisan_mean_grade', '')
-                qualifying_courses = get_qualifying_artisan_courses(user_grades, user_mean_grade)
-                
-            elif flow == 'kmtc':
-                user_grades = session.get('kmtc_grades', {})
-                user_mean_grade = session.get('kmtc_mean_grade', '')
-                qualifying_courses = get_qualifying_kmtc_courses(user_grades, user_mean_grade)
+            profile = qualification_engine.session_profile(flow, session)
+            if profile is not None:
+                user_grades = profile.grades
+                user_mean_grade = profile.mean_grade
+                user_cluster_points = profile.cluster_points
+                qualifying_courses = get_qualifying_courses_for_flow(flow)
             
             # Save courses to database
             if qualifying_courses:
@@ -2792,28 +2527,7 @@ def show_collection_courses(flow, collection_name):
     if user_courses_data and user_courses_data.get('courses'):
         qualifying_courses = user_courses_data['courses']
     else:
-        if flow == 'degree':
-            user_grades = session.get('degree_grades', {})
-            user_cluster_points = session.get('degree_cluster_points', {})
-            qualifying_courses = get_qualifying_courses(user_grades, user_cluster_points)
-        elif flow == 'diploma':
-            user_grades = session.get('diploma_grades', {})
-            user_mean_grade = session.get('diploma_mean_grade', '')
-            qualifying_courses = get_qualifying_diploma_courses(user_grades, user_mean_grade)
-        elif flow == 'certificate':
-            user_grades = session.get('certificate_grades', {})
-            user_mean_grade = session.get('certificate_mean_grade', '')
-            qualifying_courses = get_qualifying_certificate_courses(user_grades, user_mean_grade)
-        elif flow == 'artisan':
-            user_grades = session.get('artisan_grades', {})
-            user_mean_grade = session.get('artisan_mean_grade', '')
-            qualifying_courses = get_qualifying_artisan_courses(user_grades, user_mean_grade)
-        elif flow == 'kmtc':
-            user_grades = session.get('kmtc_grades', {})
-            user_mean_grade = session.get('kmtc_mean_grade', '')
-            qualifying_courses = get_qualifying_kmtc_courses(user_grades, user_mean_grade)
-        else:
-            qualifying_courses = []
+        qualifying_courses = get_qualifying_courses_for_flow(flow)
     
     collection_courses = [course for course in qualifying_courses if course.get('collection') == collection_name]
     
@@ -2824,6 +2538,77 @@ def show_collection_courses(flow, collection_name):
                          email=email,
                          index_number=index_number)
 
+# --- Qualification Preview Routes ---
+QUALIFY_EVERYWHERE_MAX_TOP = 20
+
+@app.route('/qualify-everywhere', methods=['POST'])
+def qualify_everywhere():
+    """Pre-payment preview: course counts and top courses for one grade profile across every level.
+
+    Accepts JSON ({"grades": {"MAT": "B+"}, "mean_grade": "B", "cluster_points": {"cluster_1": 38.2}, "top": 5})
+    or the same form fields as the grade submission pages.
+    """
+    try:
+        payload = request.get_json(silent=True)
+        user_grades = {}
+        user_cluster_points = {}
+        if payload is not None:
+            for subject_code, grade in (payload.get('grades') or {}).items():
+                grade = str(grade).upper()
+                if grade in GRADE_VALUES:
+                    user_grades[str(subject_code).upper()] = grade
+            user_mean_grade = str(payload.get('mean_grade') or '').upper()
+            for cluster, points in (payload.get('cluster_points') or {}).items():
+                try:
+                    user_cluster_points[cluster] = float(points)
+                except (TypeError, ValueError):
+                    user_cluster_points[cluster] = 0.0
+            top_n = payload.get('top', 5)
+        else:
+            form_data = request.form.to_dict()
+            for subject_name, subject_code in SUBJECTS.items():
+                if subject_name in form_data and form_data[subject_name]:
+                    grade = form_data[subject_name].upper()
+                    if grade in GRADE_VALUES:
+                        user_grades[subject_code] = grade
+            user_mean_grade = form_data.get('overall', '').upper()
+            for i in range(1, 21):
+                cluster_key = f"cl{i}"
+                if cluster_key in form_data and form_data[cluster_key]:
+                    try:
+                        user_cluster_points[f"cluster_{i}"] = float(form_data[cluster_key])
+                    except ValueError:
+                        user_cluster_points[f"cluster_{i}"] = 0.0
+            top_n = form_data.get('top', 5)
+        
+        if not user_grades:
+            return jsonify({'success': False, 'error': 'Provide at least one subject grade'}), 400
+        if user_mean_grade and user_mean_grade not in GRADE_VALUES:
+            return jsonify({'success': False, 'error': 'Invalid mean grade'}), 400
+        try:
+            top_n = max(0, min(int(top_n), QUALIFY_EVERYWHERE_MAX_TOP))
+        except (TypeError, ValueError):
+            top_n = 5
+        
+        if not database_connected:
+            return jsonify({'success': False, 'error': 'Course catalog not available'}), 503
+        
+        started = time.perf_counter()
+        levels = qualification_engine.qualify_everywhere(
+            user_grades, user_mean_grade or None, user_cluster_points, top_n=top_n
+        )
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        print(f"🌍 Qualify-everywhere preview: {sum(level['count'] for level in levels.values())} courses in {elapsed_ms:.1f}ms")
+        return jsonify({
+            'success': True,
+            'catalog_version': course_catalog.describe()['version'],
+            'levels': levels,
+            'elapsed_ms': round(elapsed_ms, 2)
+        })
+    except Exception as e:
+        print(f"❌ Error in qualify_everywhere: {str(e)}")
+        return jsonify({'success': False, 'error': 'Could not evaluate grades'}), 500
+
 # --- Payment Verification Routes ---
 @app.route('/verify-payment', methods=['POST'])
 def verify_payment():
@@ -2886,12 +2671,13 @@ def verify_payment():
         
         if database_connected:
             for level in paid_categories:
+                # Only the count is needed here: skip the course list
                 courses_data = user_courses_collection.find_one({
                     'index_number': index_number,
                     'level': level
-                })
-                if courses_data and courses_data.get('courses'):
-                    course_count = len(courses_data['courses'])
+                }, {'course_refs': 1, 'courses._id': 1})
+                course_count = record_course_count(courses_data)
+                if course_count:
                     user_courses[level] = {
                         'count': course_count
                     }
@@ -2942,10 +2728,11 @@ def verified_results_dashboard():
                 'index_number': index_number,
                 'level': level
             })
-            if courses_data and courses_data.get('courses'):
-                course_count = len(courses_data['courses'])
+            level_courses = record_courses(level, courses_data)
+            if level_courses:
+                course_count = len(level_courses)
                 user_courses[level] = {
-                    'courses': courses_data['courses'],
+                    'courses': level_courses,
                     'count': course_count
                 }
                 total_courses += course_count
@@ -3003,19 +2790,12 @@ def show_verified_level_results(level):
             'level': level
         })
     
-    if not courses_data or not courses_data.get('courses'):
+    # Hydrated copies with _id as a string for JSON serialization
+    qualifying_courses = record_courses(level, courses_data)
+    if not qualifying_courses:
         flash(f"No {level} course results found for your payment details", "error")
         return redirect(url_for('verified_results_dashboard', index=index_number, receipt=receipt))
     
-    # Convert ObjectId to string for JSON serialization
-    qualifying_courses = []
-    for course in courses_data['courses']:
-        course_dict = dict(course)
-        # Convert _id from ObjectId to string if it exists
-        if '_id' in course_dict and isinstance(course_dict['_id'], ObjectId):
-            course_dict['_id'] = str(course_dict['_id'])
-        qualifying_courses.append(course_dict)
-    
     # Group courses by collection with proper names
     courses_by_collection = {}
     for course in qualifying_courses:
@@ -3057,7 +2837,7 @@ def show_verified_level_results(level):
 @app.route('/add-to-basket', methods=['POST'])
 def add_to_basket():
     try:
-        course_data = request.get_json()
+        course_data = request.get_json(silent=True) or {}
         print(f"📥 Adding course to basket: {course_data.get('programme_name', 'Unknown Course')}")
         
         # Get current flow/level
@@ -3080,44 +2860,59 @@ def add_to_basket():
                 basket = []
             session['course_basket'] = basket
         
-        course_code = course_data.get('programme_code') or course_data.get('course_code')
-        
-        # Check for duplicates by programme_code
-        existing_course = next((item for item in basket if (
-            item.get('programme_code') == course_code or 
-            item.get('course_code') == course_code
-        )), None)
+        # Only the course identity is kept from the posted JSON; the course must be in the catalog
+        session_only = False
+        if course_catalog.available(current_level):
+            item, course = compact_basket_item(current_level, course_data)
+            if item is None:
+                print(f"⚠️ Course not found in the {current_level} catalog")
+                return jsonify({
+                    'success': False,
+                    'error': 'Course not found',
+                    'basket_count': len(basket)
+                }), 400
+        else:
+            # No catalog to check against (database down): keep the posted course in the session only
+            item = course = session_basket_item(current_level, course_data)
+            session_only = True
+            if item is None:
+                return jsonify({
+                    'success': False,
+                    'error': 'Invalid course',
+                    'basket_count': len(basket)
+                }), 400
+            print(f"ℹ️ {current_level} catalog unavailable, adding course to the session basket only")
+        course_code = basket_item_code(course)
+        
+        # Duplicate check against the session basket; the buffered database write
+        # repeats it atomically in case another tab added the course meanwhile
+        email = session.get('email')
+        index_number = session.get('index_number')
+        added = not basket_contains(basket, item.get('course_id'), course_code)
+        if added and email and index_number and database_connected and not session_only:
+            added = basket_service.add(email, index_number, item, course_code)
+            session['basket_pending_until'] = basket_service.pending_until()
+        basket_count = len(basket) + (1 if added else 0)
         
-        if existing_course:
+        if not added:
             print(f"⚠️ Course already in basket: {course_code}")
             return jsonify({
                 'success': False,
                 'error': 'Course already in basket',
-                'basket_count': len(basket)
+                'basket_count': basket_count
             })
         
-        # Add basket_id and timestamp
-        course_data['basket_id'] = str(ObjectId())
-        course_data['added_at'] = datetime.now().isoformat()
-        course_data['level'] = current_level
-        
-        # Add course to basket
-        basket.append(course_data)
+        # Mirror the item in the session basket
+        if not basket_contains(basket, item.get('course_id'), course_code):
+            basket.append(item)
         session['course_basket'] = basket
         session.modified = True
         
-        print(f"✅ Added course to basket. Total items: {len(basket)}")
-        print(f"📊 Basket contents: {[item.get('programme_name', 'Unknown') for item in basket]}")
-        
-        # Save to database if user is verified
-        email = session.get('email')
-        index_number = session.get('index_number')
-        if email and index_number:
-            save_user_basket(email, index_number, basket)
+        print(f"✅ Added course to basket. Total items: {basket_count}")
         
         return jsonify({
             'success': True,
-            'basket_count': len(basket),
+            'basket_count': basket_count,
             'message': 'Course added to basket successfully'
         })
         
@@ -3165,38 +2960,11 @@ def remove_from_basket():
             session.modified = True
             print(f"✅ Removed from session. New count: {basket_count}")
         
-        # Remove from database
+        # Queue the database removal; it is written with the candidate's next batch
         if database_connected:
-            try:
-                # Get current basket from database
-                basket_data = user_baskets_collection.find_one({
-                    'index_number': index_number,
-                    'is_active': True
-                })
-                
-                if basket_data and 'basket' in basket_data:
-                    # Filter out the item to remove
-                    updated_basket = [course for course in basket_data['basket'] 
-                                    if course.get('basket_id') != basket_id]
-                    
-                    # Update database
-                    result = user_baskets_collection.update_one(
-                        {'index_number': index_number},
-                        {'$set': {
-                            'basket': updated_basket,
-                            'updated_at': datetime.now()
-                        }}
-                    )
-                    
-                    basket_count = len(updated_basket)
-                    print(f"✅ Removed from database. New count: {basket_count}")
-                    
-                    # Update session with the database state
-                    session['course_basket'] = updated_basket
-                    
-            except Exception as db_error:
-                print(f"❌ Error removing from database: {db_error}")
-                # If database fails, we still have the session updated
+            basket_service.remove(index_number, basket_id)
+            session['basket_pending_until'] = basket_service.pending_until()
+            print("✅ Queued removal from database")
         
         return jsonify({
             'success': True, 
@@ -3241,15 +3009,7 @@ def clear_basket():
         db_cleared = False
         if database_connected:
             try:
-                result = user_baskets_collection.update_one(
-                    {'index_number': index_number},
-                    {'$set': {
-                        'basket': [],
-                        'updated_at': datetime.now(),
-                        'is_active': False
-                    }}
-                )
-                if result.modified_count > 0:
+                if basket_service.clear(index_number):
                     print("✅ Basket cleared from database")
                     db_cleared = True
                 else:
@@ -3395,14 +3155,16 @@ def view_basket():
                 
                 processed_basket.append(item_copy)
         
-        basket_count = len(processed_basket)
+        # Fill in display fields of id-only items from the catalog
+        display_basket = hydrate_basket(processed_basket)
+        basket_count = len(display_basket)
         print(f"🎯 Final basket count for display: {basket_count}")
         
-        # Update session with processed basket
+        # Update session with the stored (id-only) basket
         session['course_basket'] = processed_basket
         session.modified = True
         
-        return render_template('basket.html', basket=processed_basket, basket_count=basket_count)
+        return render_template('basket.html', basket=display_basket, basket_count=basket_count)
     
     except Exception as e:
         print(f"❌ Critical error in view_basket: {str(e)}")
@@ -3454,12 +3216,8 @@ def save_basket():
         
         print(f"💾 Saving basket with {len(basket)} items")
         
-        # Save to database if user is identified
-        email = session.get('email')
-        index_number = session.get('index_number')
-        if email and index_number:
-            save_user_basket(email, index_number, basket)
-        
+        # Adds and removes are already persisted atomically, so nothing is written
+        # here: rewriting the whole array from this session would undo another tab's changes
         session.modified = True
         
         return jsonify({
@@ -3576,17 +3334,9 @@ def search_courses_route(flow):
                     'index_number': verified_index,
                     'level': flow
                 })
-                if courses_data and courses_data.get('courses'):
-                    qualifying_courses = courses_data['courses']
-                    # Convert ObjectId to string for JSON serialization
-                    converted_courses = []
-                    for course in qualifying_courses:
-                        if course:  # Check if course is not None
-                            course_dict = dict(course)
-                            if '_id' in course_dict and isinstance(course_dict['_id'], ObjectId):
-                                course_dict['_id'] = str(course_dict['_id'])
-                            converted_courses.append(course_dict)
-                    qualifying_courses = converted_courses
+                # Hydrated copies with _id as a string for JSON serialization
+                qualifying_courses = record_courses(flow, courses_data)
+                if qualifying_courses:
                     print(f"✅ Loaded {len(qualifying_courses)} courses from database for verified user")
                 else:
                     print(f"⚠️ No courses found in database for {flow} level")
@@ -3594,79 +3344,21 @@ def search_courses_route(flow):
             else:
                 # Regular users without verification - get courses based on flow from session
                 print(f"🔍 Regular user - checking session data for {flow}")
-                if flow == 'degree':
-                    user_grades = session.get('degree_grades', {})
-                    user_cluster_points = session.get('degree_cluster_points', {})
-                    if user_grades and user_cluster_points:
-                        qualifying_courses = get_qualifying_courses(user_grades, user_cluster_points)
-                        print(f"✅ Loaded {len(qualifying_courses)} degree courses from qualification check")
-                    else:
-                        qualifying_courses = []
-                        print("⚠️ No degree grades or cluster points in session")
-                elif flow == 'diploma':
-                    user_grades = session.get('diploma_grades', {})
-                    user_mean_grade = session.get('diploma_mean_grade', '')
-                    if user_grades and user_mean_grade:
-                        qualifying_courses = get_qualifying_diploma_courses(user_grades, user_mean_grade)
-                        print(f"✅ Loaded {len(qualifying_courses)} diploma courses from qualification check")
-                    else:
-                        qualifying_courses = []
-                        print("⚠️ No diploma grades or mean grade in session")
-                elif flow == 'certificate':
-                    user_grades = session.get('certificate_grades', {})
-                    user_mean_grade = session.get('certificate_mean_grade', '')
-                    if user_grades and user_mean_grade:
-                        qualifying_courses = get_qualifying_certificate_courses(user_grades, user_mean_grade)
-                        print(f"✅ Loaded {len(qualifying_courses)} certificate courses from qualification check")
-                    else:
-                        qualifying_courses = []
-                        print("⚠️ No certificate grades or mean grade in session")
-                elif flow == 'artisan':
-                    user_grades = session.get('artisan_grades', {})
-                    user_mean_grade = session.get('artisan_mean_grade', '')
-                    if user_grades and user_mean_grade:
-                        qualifying_courses = get_qualifying_artisan_courses(user_grades, user_mean_grade)
-                        print(f"✅ Loaded {len(qualifying_courses)} artisan courses from qualification check")
-                    else:
-                        qualifying_courses = []
-                        print("⚠️ No artisan grades or mean grade in session")
-                elif flow == 'kmtc':
-                    user_grades = session.get('kmtc_grades', {})
-                    user_mean_grade = session.get('kmtc_mean_grade', '')
-                    if user_grades and user_mean_grade:
-                        qualifying_courses = get_qualifying_kmtc_courses(user_grades, user_mean_grade)
-                        print(f"✅ Loaded {len(qualifying_courses)} KMTC courses from qualification check")
-                    else:
-                        qualifying_courses = []
-                        print("⚠️ No KMTC grades or mean grade in session")
-                else:
+                strategy = qualification_engine.strategy(flow)
+                profile = qualification_engine.session_profile(flow, session)
+                if strategy is None:
                     qualifying_courses = []
                     print(f"⚠️ Unknown flow type: {flow}")
+                elif profile.complete:
+                    qualifying_courses = get_qualifying_courses_for_flow(flow)
+                    print(f"✅ Loaded {len(qualifying_courses)} {strategy.label} courses from qualification check")
+                else:
+                    qualifying_courses = []
+                    print(f"⚠️ Incomplete {strategy.label} grade data in session")
         else:
             # Regular users with session data - get courses based on flow
             print(f"🔍 Regular user with session - getting {flow} courses")
-            if flow == 'degree':
-                user_grades = session.get('degree_grades', {})
-                user_cluster_points = session.get('degree_cluster_points', {})
-                qualifying_courses = get_qualifying_courses(user_grades, user_cluster_points)
-            elif flow == 'diploma':
-                user_grades = session.get('diploma_grades', {})
-                user_mean_grade = session.get('diploma_mean_grade', '')
-                qualifying_courses = get_qualifying_diploma_courses(user_grades, user_mean_grade)
-            elif flow == 'certificate':
-                user_grades = session.get('certificate_grades', {})
-                user_mean_grade = session.get('certificate_mean_grade', '')
-                qualifying_courses = get_qualifying_certificate_courses(user_grades, user_mean_grade)
-            elif flow == 'artisan':
-                user_grades = session.get('artisan_grades', {})
-                user_mean_grade = session.get('artisan_mean_grade', '')
-                qualifying_courses = get_qualifying_artisan_courses(user_grades, user_mean_grade)
-            elif flow == 'kmtc':
-                user_grades = session.get('kmtc_grades', {})
-                user_mean_grade = session.get('kmtc_mean_grade', '')
-                qualifying_courses = get_qualifying_kmtc_courses(user_grades, user_mean_grade)
-            else:
-                qualifying_courses = []
+            qualifying_courses = get_qualifying_courses_for_flow(flow)
         
         # Ensure qualifying_courses is a list
         if not isinstance(qualifying_courses, list):
@@ -4056,9 +3748,16 @@ def admin_system_health():
     try:
         health_data = {
             'database_connected': database_connected,
+            'database_connection': connection_health.stats(),
             'session_keys_count': len(session.keys()) if session else 0,
             'current_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'application_uptime': 'N/A'
+            'application_uptime': 'N/A',
+            'course_catalog': course_catalog.describe(),
+            'qualification_engine': qualification_engine.stats(),
+            'qualification_cache': qualification_cache.stats(),
+            'result_store': result_store.stats(),
+            'session_backend': session_backend_stats(app),
+            'basket_service': basket_service.stats()
         }
         
         if database_connected:
@@ -4082,6 +3781,84 @@ def admin_system_health():
         flash("Error loading system health data", "error")
         return render_template('admin_system_health.html', health_data={})
 
+@app.route('/admin/catalog/refresh', methods=['POST'])
+def admin_refresh_catalog():
+    """Reload the course catalog snapshot after the course data changed.
+
+    This worker reloads now; the others see the bumped shared generation and
+    reload within CATALOG_SYNC_INTERVAL seconds.
+    """
+    if not session.get('admin_logged_in'):
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+    
+    try:
+        previous_version = course_catalog.describe()['version']
+        snapshot = course_catalog.refresh(broadcast=True)
+        if course_catalog.load_failures:
+            print(f"⚠️ Course catalog refresh incomplete: {course_catalog.load_failures}")
+            return jsonify({
+                'success': False,
+                'error': 'Some course collections could not be read; the reload will be retried',
+                'failed_collections': course_catalog.load_failures,
+                'version': snapshot.version
+            }), 503
+        print(f"🔄 Course catalog refreshed: {previous_version} -> {snapshot.version}")
+        return jsonify({
+            'success': True,
+            'previous_version': previous_version,
+            'version': snapshot.version,
+            'counts': snapshot.counts(),
+            'sync_interval': course_catalog.sync_interval
+        })
+    except Exception as e:
+        print(f"❌ Error refreshing course catalog: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/admin/catalog/problems')
+def admin_catalog_problems():
+    """List courses whose requirement grades cannot be parsed (they never qualify anyone)"""
+    if not session.get('admin_logged_in'):
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+    
+    snapshot = course_catalog.snapshot()
+    problems = snapshot.problems()
+    return jsonify({
+        'success': True,
+        'version': snapshot.version,
+        'counts': {level: len(items) for level, items in problems.items()},
+        'problems': problems
+    })
+
+@app.route('/admin/batch-qualify', methods=['POST'])
+def admin_batch_qualify():
+    """Qualify a CSV / NDJSON upload of grade profiles and stream the results as NDJSON.
+
+    Evaluated inside this web worker (BATCH_ADMIN_WORKERS, default 1); whole
+    schools should go through scripts/batch_qualify.py instead.
+    """
+    if not session.get('admin_logged_in'):
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+    
+    upload = request.files.get('profiles')
+    if not upload or not upload.filename:
+        return jsonify({'success': False, 'error': 'Upload a CSV or NDJSON file as "profiles"'}), 400
+    
+    levels = [level.strip() for level in request.form.get('levels', '').split(',') if level.strip()]
+    levels = levels or qualification_engine.levels()
+    unknown = [level for level in levels if qualification_engine.strategy(level) is None]
+    if unknown:
+        return jsonify({'success': False, 'error': f"Unknown levels: {', '.join(unknown)}"}), 400
+    
+    try:
+        text = upload.read().decode('utf-8-sig')
+    except UnicodeDecodeError:
+        return jsonify({'success': False, 'error': 'File must be UTF-8 text'}), 400
+    
+    count_only = request.form.get('count_only') in ('1', 'true', 'on')
+    print(f"📦 Admin batch qualification: {upload.filename} for {', '.join(levels)}")
+    lines = run_batch_text(text, detect_format(upload.filename), levels, count_only=count_only)
+    return Response(stream_with_context(lines), mimetype='application/x-ndjson')
+
 # --- Debug and Testing Routes ---
 @app.route('/debug/database')
 def debug_database():
@@ -4159,14 +3936,15 @@ def health_check():
         'environment': os.environ.get('FLASK_ENV', 'production')
     }
     
-    # Add database health check if connected
+    # Database health comes from the background connection monitor, not a query
     if database_connected:
-        try:
-            user_payments_collection.find_one({}, {'_id': 1})
+        connection = connection_health.stats()
+        health_status['database_connection'] = connection
+        if connection['healthy']:
             health_status['database_status'] = 'connected_and_responding'
-        except Exception as e:
+        else:
             health_status['database_status'] = 'error'
-            health_status['database_error'] = str(e)
+            health_status['database_error'] = connection['last_error']
             health_status['status'] = 'degraded'
     
     return jsonify(health_status)
@@ -4210,9 +3988,15 @@ def monitor_health():
         'timestamp': datetime.now().isoformat(),
         'components': {
             'web_server': 'operational',
-            'database': 'connected' if database_connected else 'disconnected',
+            'database': connection_health.state if database_connected else 'disconnected',
             'api_endpoints': 'responsive'
-        }
+        },
+        'database_connection': connection_health.stats(),
+        'qualification_engine': qualification_engine.stats(),
+        'qualification_cache': qualification_cache.stats(),
+        'result_store': result_store.stats(),
+        'session_backend': session_backend_stats(app),
+        'basket_service': basket_service.stats()
     })
 import threading
 import time
@@ -1,125 +1,381 @@
-# --- Basket Management Functions ---
-from flask import session
-from datetime import datetime, timedelta
-
-def clear_basket(email, index_number):
-    """Clear user's basket and refresh courses from database"""
-    # Clear basket-related session data
-    session_keys_to_clear = []
-    for key in session:
-        if key.startswith('basket_') or key.endswith('_basket'):
-            session_keys_to_clear.append(key)
-    
-    for key in session_keys_to_clear:
-        session.pop(key, None)
-    
-    # Force reload of courses from database
-    courses_keys_to_clear = []
-    for key in session:
-        if '_courses_' in key:
-            courses_keys_to_clear.append(key)
-    
-    for key in courses_keys_to_clear:
-        session.pop(key, None)
-    
-    if database_connected:
-        try:
-            # Update basket in database
-            user_baskets_collection.update_one(
-                {'email': email, 'index_number': index_number},
-                {
-                    '$set': {
-                        'courses': [],
-                        'cleared_at': datetime.now(),
-                        'is_empty': True
-                    }
-                },
-                upsert=True
-            )
-        except Exception as e:
-            print(f"❌ Error clearing basket in database: {str(e)}")
-
-def add_to_basket(email, index_number, level, course):
-    """Add course to user's basket with database sync"""
-    basket_key = f'basket_{level}_{index_number}'
-    
-    # Get current basket
-    basket = session.get(basket_key, {'courses': []})
-    
-    # Check if course already in basket
-    course_id = str(course.get('_id', ''))
-    if not any(str(c.get('_id', '')) == course_id for c in basket['courses']):
-        basket['courses'].append(course)
-        basket['updated_at'] = datetime.now().isoformat()
-        session[basket_key] = basket
-        
-        # Sync with database if connected
-        if database_connected:
-            try:
-                user_baskets_collection.update_one(
-                    {'email': email, 'index_number': index_number, 'level': level},
-                    {
-                        '$set': {
-                            'courses': basket['courses'],
-                            'updated_at': datetime.now(),
-                            'is_empty': False
-                        }
-                    },
-                    upsert=True
-                )
-            except Exception as e:
-                print(f"❌ Error syncing basket to database: {str(e)}")
-                
-def get_basket(email, index_number, level):
-    """Get user's basket with database sync"""
-    basket_key = f'basket_{level}_{index_number}'
-    
-    # Try database first if connected
-    if database_connected:
-        try:
-            db_basket = user_baskets_collection.find_one({
-                'email': email,
+# --- Course Basket Service ---
+"""One basket per candidate, stored in ``user_baskets`` keyed by index number.
+
+Basket items are stored id-only: (level, collection, course_id, added_at,
+basket_id). Display fields are hydrated from the course catalog; legacy items
+that embed the whole course are still read as they are.
+
+Adds and removes are not written one by one. ``BasketService`` buffers them per
+candidate for ``BASKET_FLUSH_WINDOW`` seconds and then flushes the batch as a
+single ordered ``bulk_write`` (one round trip): an upsert that makes sure the
+document exists, one ``$pull`` for all removed items and one guarded ``$push``
+per added item, so a course already in the basket (from another tab or worker)
+is still never added twice. An add that is removed again inside the window
+never reaches the database at all. Adds the guard rejects are reported back
+through ``take_dropped`` so the session basket can drop them.
+
+The buffer is per process. Until a batch is written, the session (which every
+worker shares) is the candidate's basket: ``pending_until`` gives the time
+before which readers should trust the session copy over the database.
+
+Pending operations are flushed:
+ - by the background flusher once their window has passed (no request pays for it)
+ - before the basket is read or cleared, so a candidate sees their own writes
+ - at interpreter shutdown (atexit)
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from catalog import course_catalog
+
+logger = logging.getLogger(__name__)
+
+# Seconds adds/removes are buffered per candidate before they are written (0 writes through)
+BASKET_FLUSH_WINDOW = float(os.getenv('BASKET_FLUSH_WINDOW', '2') or 0)
+
+
+def basket_item_code(item):
+    return item.get('programme_code') or item.get('course_code')
+
+
+def compact_basket_item(level, course_data):
+    """(id-only basket item, catalog course) for a posted course; (None, None) if it is not in the catalog"""
+    ref = course_catalog.course_ref(level, course_data or {})
+    if ref is None:
+        return None, None
+    resolved = course_catalog.resolve(level, [ref])
+    if not resolved:
+        return None, None
+    item = {
+        'level': level,
+        'collection': ref[0],
+        'course_id': ref[1],
+        'added_at': datetime.now().isoformat(),
+        'basket_id': str(ObjectId())
+    }
+    return item, resolved[0]
+
+
+# Posted fields kept for a session-only item (what basket.html renders)
+SESSION_ITEM_FIELDS = (
+    'programme_name', 'course_name', 'programme_code', 'course_code', 'institution_name',
+    'cluster', 'collection', 'cut_off_points', 'minimum_grade', 'minimum_subject_requirements'
+)
+
+
+def session_basket_item(level, course_data):
+    """Display item built from the posted course, for when the catalog is unavailable; None if it has no name or code"""
+    item = {field: course_data[field] for field in SESSION_ITEM_FIELDS if course_data.get(field) is not None}
+    if not ((item.get('programme_name') or item.get('course_name')) and basket_item_code(item)):
+        return None
+    if course_data.get('_id') is not None:
+        item['course_id'] = str(course_data['_id'])
+    item.update({
+        'level': level,
+        'added_at': datetime.now().isoformat(),
+        'basket_id': str(ObjectId())
+    })
+    return item
+
+
+def is_compact_basket_item(item):
+    return 'course_id' in item and not (item.get('programme_name') or item.get('course_name'))
+
+
+def basket_contains(basket, course_id, code):
+    return any(
+        (course_id and item.get('course_id') == course_id) or (code and basket_item_code(item) == code)
+        for item in basket
+    )
+
+
+def hydrate_basket(basket):
+    """Display dicts for basket items, in basket order: id-only items are filled in from the catalog"""
+    refs_by_level = {}
+    for item in basket:
+        if is_compact_basket_item(item):
+            refs_by_level.setdefault(item.get('level'), []).append([item.get('collection'), item['course_id']])
+    courses = {}
+    for level, refs in refs_by_level.items():
+        for course in course_catalog.resolve(level, refs):
+            courses[str(course['_id'])] = course
+
+    hydrated = []
+    for item in basket:
+        if not is_compact_basket_item(item):
+            hydrated.append(dict(item))
+            continue
+        course = courses.get(item['course_id'])
+        if course is None:
+            logger.warning(f"⚠️ Basket course {item['course_id']} is no longer in the {item.get('level')} catalog")
+            continue
+        display = dict(course)
+        display['_id'] = str(display['_id'])
+        display.update(item)
+        hydrated.append(display)
+    return hydrated
+
+
+class PendingBasketOps:
+    """Adds and removes of one candidate that have not been written yet"""
+
+    def __init__(self, email):
+        self.email = email
+        self.adds = []
+        self.removes = []
+        self.since = time.monotonic()
+
+    def __len__(self):
+        return len(self.adds) + len(self.removes)
+
+
+class BasketService:
+    """Write-behind buffer in front of the ``user_baskets`` collection"""
+
+    def __init__(self, window=BASKET_FLUSH_WINDOW):
+        self.window = window
+        self._collection = None
+        self._pending = {}
+        self._lock = threading.Lock()
+        # Serialises flushes so two batches of one candidate are never applied out of order
+        self._flush_lock = threading.Lock()
+        self._flusher = None
+        self._stop = threading.Event()
+        # basket_ids of adds the duplicate guard rejected, per candidate
+        self._dropped = {}
+        self.buffered = 0
+        self.coalesced = 0
+        self.flushes = 0
+        self.writes = 0
+        self.errors = 0
+        self.dropped = 0
+
+    def attach(self, collection):
+        """Use ``collection`` (user_data.user_baskets) for reads and flushes"""
+        self._collection = collection
+
+    @property
+    def connected(self):
+        return self._collection is not None
+
+    def pending_until(self):
+        """Epoch time by which operations queued now have been written (the flusher runs every half window)"""
+        return time.time() + 2 * self.window
+
+    def is_pending(self, index_number):
+        with self._lock:
+            return index_number in self._pending
+
+    def take_dropped(self, index_number):
+        """basket_ids of the candidate's adds that were rejected as duplicates when flushed"""
+        with self._lock:
+            return self._dropped.pop(index_number, [])
+
+    # --- Buffered writes ---
+    def add(self, email, index_number, item, code=None):
+        """Queue ``item`` for the candidate's basket; False if that course is already pending"""
+        code = code or basket_item_code(item)
+        with self._lock:
+            pending = self._pending.get(index_number)
+            if pending is None:
+                pending = self._pending[index_number] = PendingBasketOps(email)
+            if basket_contains([entry for entry, _ in pending.adds], item.get('course_id'), code):
+                return False
+            pending.email = email
+            pending.adds.append((item, code))
+            self.buffered += 1
+        self._after_write(index_number)
+        return True
+
+    def remove(self, index_number, basket_id):
+        """Queue removal of one item by basket_id (dropping a pending add of it instead, if any)"""
+        with self._lock:
+            pending = self._pending.get(index_number)
+            if pending is not None:
+                kept = [(item, code) for item, code in pending.adds if item.get('basket_id') != basket_id]
+                if len(kept) != len(pending.adds):
+                    pending.adds = kept
+                    self.coalesced += 1
+                    if not pending:
+                        del self._pending[index_number]
+                    return
+            else:
+                pending = self._pending[index_number] = PendingBasketOps(None)
+            pending.removes.append(basket_id)
+            self.buffered += 1
+        self._after_write(index_number)
+
+    def _after_write(self, index_number):
+        if self.window <= 0:
+            self.flush(index_number)
+        else:
+            self._start_flusher()
+
+    # --- Flushing ---
+    def _take(self, index_numbers):
+        with self._lock:
+            return [(number, self._pending.pop(number)) for number in index_numbers if number in self._pending]
+
+    def _due(self):
+        now = time.monotonic()
+        with self._lock:
+            return [number for number, pending in self._pending.items() if now - pending.since >= self.window]
+
+    def _write(self, index_number, pending):
+        """Apply one candidate's batch as a single ordered bulk_write"""
+        now = datetime.now()
+        operations = [UpdateOne(
+            {'index_number': index_number},
+            {'$setOnInsert': {
                 'index_number': index_number,
-                'level': level
-            })
-            
-            if db_basket:
-                # Update session with database data
-                session[basket_key] = {
-                    'courses': db_basket.get('courses', []),
-                    'updated_at': datetime.now().isoformat(),
-                    'from_db': True
-                }
-                return session[basket_key]
-        except Exception as e:
-            print(f"❌ Error getting basket from database: {str(e)}")
-    
-    # Fallback to session
-    return session.get(basket_key, {'courses': [], 'updated_at': datetime.now().isoformat()})
-
-def remove_from_basket(email, index_number, level, course_id):
-    """Remove course from user's basket with database sync"""
-    basket_key = f'basket_{level}_{index_number}'
-    basket = session.get(basket_key, {'courses': []})
-    
-    # Remove course from basket
-    basket['courses'] = [c for c in basket['courses'] if str(c.get('_id', '')) != str(course_id)]
-    basket['updated_at'] = datetime.now().isoformat()
-    session[basket_key] = basket
-    
-    # Sync with database if connected
-    if database_connected:
-        try:
-            user_baskets_collection.update_one(
-                {'email': email, 'index_number': index_number, 'level': level},
-                {
-                    '$set': {
-                        'courses': basket['courses'],
-                        'updated_at': datetime.now(),
-                        'is_empty': len(basket['courses']) == 0
-                    }
-                },
-                upsert=True
+                'basket': [],
+                'created_at': now,
+                'is_active': True
+            }},
+            upsert=True
+        )]
+        if pending.removes:
+            operations.append(UpdateOne(
+                {'index_number': index_number},
+                {'$pull': {'basket': {'basket_id': {'$in': pending.removes}}}, '$set': {'updated_at': now}}
+            ))
+        for item, code in pending.adds:
+            # $ne on an array field matches only when no element has that value;
+            # course_id covers id-only items, the codes cover legacy items.
+            # {'$ne': None} would reject every basket holding an item without a code.
+            guard = {'index_number': index_number, 'basket.course_id': {'$ne': item.get('course_id')}}
+            if code:
+                guard['basket.programme_code'] = {'$ne': code}
+                guard['basket.course_code'] = {'$ne': code}
+            operations.append(UpdateOne(guard, {
+                '$push': {'basket': item},
+                '$set': {'email': pending.email, 'updated_at': now, 'is_active': True}
+            }))
+        result = self._collection.bulk_write(operations, ordered=True)
+
+        # Every push (and the pull) modifies the document unless its guard rejected it,
+        # so fewer modifications means an add may have been dropped: find out which
+        expected = len(pending.adds) + (1 if pending.removes else 0)
+        if not pending.adds or result.modified_count >= expected:
+            return []
+        document = self._collection.find_one({'index_number': index_number}, {'_id': 0, 'basket.basket_id': 1}) or {}
+        stored = {entry.get('basket_id') for entry in document.get('basket', [])}
+        return [item['basket_id'] for item, _ in pending.adds if item.get('basket_id') not in stored]
+
+    def flush(self, index_number=None):
+        """Write the pending operations of one candidate (or of everyone); returns the batches written"""
+        if index_number is None:
+            with self._lock:
+                numbers = list(self._pending)
+        else:
+            numbers = [index_number]
+        return self._flush(numbers)
+
+    def flush_due(self):
+        """Write the batches whose window has passed"""
+        return self._flush(self._due())
+
+    def _flush(self, index_numbers):
+        if not index_numbers or not self.connected:
+            return 0
+        written = 0
+        with self._flush_lock:
+            for index_number, pending in self._take(index_numbers):
+                if not pending:
+                    continue
+                try:
+                    dropped = self._write(index_number, pending)
+                    written += 1
+                    with self._lock:
+                        self.writes += 1
+                        self.flushes += len(pending)
+                        if dropped:
+                            self.dropped += len(dropped)
+                            self._dropped.setdefault(index_number, []).extend(dropped)
+                    if dropped:
+                        logger.warning(f"⚠️ {len(dropped)} basket adds for {index_number} were already in the basket")
+                except Exception as e:
+                    logger.error(f"❌ Error flushing basket for {index_number}: {str(e)}")
+                    self._requeue(index_number, pending)
+        return written
+
+    def _requeue(self, index_number, pending):
+        """Put a failed batch back in front of anything queued since, to retry on the next flush"""
+        with self._lock:
+            self.errors += 1
+            newer = self._pending.get(index_number)
+            if newer is not None:
+                pending.adds.extend(newer.adds)
+                pending.removes.extend(newer.removes)
+                pending.email = newer.email or pending.email
+            self._pending[index_number] = pending
+
+    def _start_flusher(self):
+        if self._flusher and self._flusher.is_alive():
+            return
+        with self._lock:
+            if self._flusher and self._flusher.is_alive():
+                return
+            self._stop.clear()
+
+            def run():
+                while not self._stop.wait(max(self.window / 2, 0.1)):
+                    self.flush_due()
+
+            self._flusher = threading.Thread(target=run, name='basket-flusher', daemon=True)
+            self._flusher.start()
+
+    def shutdown(self):
+        """Stop the flusher and write everything still pending"""
+        self._stop.set()
+        written = self.flush()
+        if written:
+            logger.info(f"💾 Flushed {written} pending baskets on shutdown")
+
+    # --- Reads and clearing ---
+    def load(self, index_number):
+        """Stored items of the candidate's active basket after flushing their pending operations; None if there is none"""
+        self.flush(index_number)
+        document = self._collection.find_one({'index_number': index_number, 'is_active': True})
+        if document is None:
+            return None
+        return document.get('basket', [])
+
+    def clear(self, index_number):
+        """Empty the candidate's basket; pending operations are discarded. True if a basket was cleared"""
+        with self._flush_lock:
+            self._take([index_number])
+            result = self._collection.update_one(
+                {'index_number': index_number},
+                {'$set': {
+                    'basket': [],
+                    'updated_at': datetime.now(),
+                    'is_active': False
+                }}
             )
-        except Exception as e:
-            print(f"❌ Error syncing basket removal to database: {str(e)}")
\ No newline at end of file
+        return result.modified_count > 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'window_seconds': self.window,
+                'pending_baskets': len(self._pending),
+                'pending_operations': sum(len(pending) for pending in self._pending.values()),
+                'buffered': self.buffered,
+                'coalesced': self.coalesced,
+                'flushed': self.flushes,
+                'writes': self.writes,
+                'errors': self.errors,
+                'dropped': self.dropped
+            }
+
+
+basket_service = BasketService()
+atexit.register(basket_service.shutdown)
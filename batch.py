@@ -0,0 +1,258 @@
+# --- Batch Qualification ---
+"""Qualify a whole class of candidates at once for schools and counsellors.
+
+Profiles come in as CSV or NDJSON and are evaluated in chunks on a
+``ProcessPoolExecutor``. Each worker receives the compiled catalog levels and
+the course summaries once (``CompiledLevel`` pickles without its lazily built
+indexes) and encodes its own NDJSON, which is the expensive part for full
+course lists; the parent only writes the finished text out. At most one chunk
+per worker (plus the one being written) is in flight, so output is streamed in
+input order without collecting the whole result. Nothing here touches the per-user session code.
+
+CSV columns are read as subject grades only when they name a KCSE subject code
+(or a subject the catalog's requirements use); other columns (stream, gender,
+...) are ignored.
+
+Used by ``scripts/batch_qualify.py``, which spreads the work over
+``BATCH_WORKERS`` processes, and the ``/admin/batch-qualify`` route, which runs
+in the web worker and therefore uses ``BATCH_ADMIN_WORKERS`` (default 1: no
+process pool inside the web server). Large classes belong on the CLI.
+"""
+import csv
+import io
+import json
+import logging
+import multiprocessing
+import os
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from catalog import course_catalog, course_summary
+from qualification import (
+    GRADE_VALUES, ENGINE_LOOP, ENGINE_COMPILED, QUALIFICATION_ENGINE, SUBJECT_CODES,
+    qualifying_indices, qualifying_count
+)
+
+logger = logging.getLogger(__name__)
+
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', str(os.cpu_count() or 1)) or 1)
+# The admin upload route runs inside a web worker: evaluate in-process unless configured
+BATCH_ADMIN_WORKERS = int(os.getenv('BATCH_ADMIN_WORKERS', '1') or 1)
+BATCH_CHUNK_SIZE = int(os.getenv('BATCH_CHUNK_SIZE', '250') or 250)
+# 'spawn' keeps workers independent of the web process's threads and sockets
+BATCH_START_METHOD = os.getenv('BATCH_START_METHOD', 'spawn')
+
+# CSV columns that are not subject grades
+ID_COLUMNS = ('id', 'index_number', 'candidate', 'name')
+MEAN_GRADE_COLUMNS = ('mean_grade', 'mean', 'overall')
+CLUSTER_COLUMN = re.compile(r'^(?:cluster_|cl)(\d+)$', re.IGNORECASE)
+
+
+# --- Input parsing ---
+def known_subject_codes(catalog=course_catalog):
+    """Columns a CSV may carry grades in: the KCSE codes plus subjects named by catalog requirements"""
+    codes = set(SUBJECT_CODES)
+    snapshot = catalog.snapshot()
+    for level in snapshot.levels():
+        compiled = snapshot.compiled(level)
+        if compiled is not None:
+            codes.update(subject.upper() for subject in compiled.subject_index)
+    return codes
+
+
+def _profile_from_columns(row, line_number, subject_codes, ignored):
+    """CSV row -> profile dict: id, mean grade, subject grade columns and cluster_N / clN columns"""
+    profile = {'id': None, 'grades': {}, 'mean_grade': None, 'cluster_points': {}}
+    for column, value in row.items():
+        if column is None or value is None:
+            continue
+        key = column.strip()
+        value = str(value).strip()
+        if not value:
+            continue
+        lowered = key.lower()
+        cluster = CLUSTER_COLUMN.match(lowered)
+        if lowered in ID_COLUMNS:
+            profile['id'] = profile['id'] or value
+        elif lowered in MEAN_GRADE_COLUMNS:
+            profile['mean_grade'] = value.upper()
+        elif cluster:
+            profile['cluster_points'][f"cluster_{int(cluster.group(1))}"] = value
+        elif key.upper() in subject_codes:
+            profile['grades'][key.upper()] = value.upper()
+        else:
+            ignored.add(key)
+    if profile['id'] is None:
+        profile['id'] = str(line_number)
+    return profile
+
+
+def read_profiles(stream, fmt='csv', subject_codes=None):
+    """Parse grade profiles from a text stream ('csv' or 'ndjson')"""
+    profiles = []
+    if fmt == 'csv':
+        subject_codes = known_subject_codes() if subject_codes is None else subject_codes
+        ignored = set()
+        for line_number, row in enumerate(csv.DictReader(stream), start=1):
+            profiles.append(_profile_from_columns(row, line_number, subject_codes, ignored))
+        if ignored:
+            logger.info(f"ℹ️ Batch CSV: ignored non-subject columns {', '.join(sorted(ignored))}")
+        return profiles
+
+    for line_number, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            profiles.append({'id': str(line_number), 'error': f"invalid JSON: {str(e)}"})
+            continue
+        if not isinstance(record, dict):
+            profiles.append({'id': str(line_number), 'error': 'each line must be a JSON object'})
+            continue
+        profiles.append({
+            'id': str(record.get('id') or record.get('index_number') or line_number),
+            'grades': {str(k).upper(): str(v).upper() for k, v in (record.get('grades') or {}).items()},
+            'mean_grade': str(record['mean_grade']).upper() if record.get('mean_grade') else None,
+            'cluster_points': dict(record.get('cluster_points') or {}),
+        })
+    return profiles
+
+
+def detect_format(filename):
+    """'ndjson' for .ndjson/.jsonl/.json uploads, 'csv' otherwise"""
+    return 'ndjson' if (filename or '').lower().endswith(('.ndjson', '.jsonl', '.json')) else 'csv'
+
+
+def clean_profile(profile):
+    """Validate grades and points; returns (grades, mean grade, cluster points) or raises ValueError"""
+    if profile.get('error'):
+        raise ValueError(profile['error'])
+    grades = {}
+    for subject, grade in (profile.get('grades') or {}).items():
+        if grade not in GRADE_VALUES:
+            raise ValueError(f"invalid grade {grade!r} for {subject}")
+        grades[subject] = grade
+    mean_grade = profile.get('mean_grade')
+    if mean_grade and mean_grade not in GRADE_VALUES:
+        raise ValueError(f"invalid mean grade {mean_grade!r}")
+    cluster_points = {}
+    for cluster, points in (profile.get('cluster_points') or {}).items():
+        try:
+            cluster_points[cluster] = float(points)
+        except (TypeError, ValueError):
+            raise ValueError(f"invalid points {points!r} for {cluster}")
+    return grades, mean_grade, cluster_points
+
+
+# --- Worker processes ---
+_worker_levels = {}
+_worker_engine = QUALIFICATION_ENGINE
+_worker_summaries = {}
+_worker_version = None
+
+
+def _init_worker(levels, engine, summaries=None, version=None):
+    global _worker_levels, _worker_engine, _worker_summaries, _worker_version
+    _worker_levels = levels
+    _worker_engine = engine
+    _worker_summaries = summaries or {}
+    _worker_version = version
+
+
+def _qualify_chunk(chunk, count_only=False):
+    """Evaluate a chunk of profiles against the worker's levels: one result dict per profile"""
+    results = []
+    for profile in chunk:
+        try:
+            grades, mean_grade, cluster_points = clean_profile(profile)
+        except ValueError as e:
+            results.append({'id': profile.get('id'), 'error': str(e)})
+            continue
+        levels = {}
+        for level, compiled in _worker_levels.items():
+            if count_only:
+                levels[level] = qualifying_count(
+                    compiled, None, grades, mean_grade, cluster_points, engine=_worker_engine
+                )
+            else:
+                levels[level] = qualifying_indices(
+                    compiled, None, grades, mean_grade, cluster_points, engine=_worker_engine
+                )
+        results.append({'id': profile.get('id'), 'levels': levels})
+    return results
+
+
+def _result_line(result, count_only):
+    if 'levels' in result:
+        output = {}
+        for level, found in result['levels'].items():
+            if count_only:
+                output[level] = {'count': found}
+            else:
+                summaries = _worker_summaries[level]
+                output[level] = {'count': len(found), 'courses': [summaries[position] for position in found]}
+        result = {'id': result['id'], 'catalog_version': _worker_version, 'levels': output}
+    return json.dumps(result, default=str) + "\n"
+
+
+def _chunk_text(chunk, count_only=False):
+    """Evaluate a chunk and encode it as NDJSON in the worker (one string crosses back)"""
+    return ''.join(_result_line(result, count_only) for result in _qualify_chunk(chunk, count_only))
+
+
+# --- Output ---
+def _chunks(items, size):
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+def run_batch(profiles, levels, workers=None, count_only=False, catalog=course_catalog):
+    """Yield NDJSON text in input order: single lines in-process, whole chunks from worker processes.
+
+    Each line holds the profile ``id`` and, per requested level, the qualifying
+    ``count`` plus (unless ``count_only``) the qualifying course summaries, or
+    an ``error`` when the profile could not be evaluated.
+    """
+    workers = BATCH_WORKERS if workers is None else max(1, workers)
+    snapshot = catalog.snapshot()
+    compiled = {level: snapshot.compiled(level) for level in levels if snapshot.compiled(level) is not None}
+    # The loop engine needs raw documents, which workers do not receive
+    engine = ENGINE_COMPILED if QUALIFICATION_ENGINE == ENGINE_LOOP else QUALIFICATION_ENGINE
+    summaries = {} if count_only else {
+        level: [course_summary(course) for course in snapshot.courses(level)] for level in compiled
+    }
+    initargs = (compiled, engine, summaries, snapshot.version)
+
+    chunks = _chunks(profiles, BATCH_CHUNK_SIZE)
+    if workers == 1 or len(chunks) <= 1:
+        _init_worker(*initargs)
+        for chunk in chunks:
+            for result in _qualify_chunk(chunk, count_only):
+                yield _result_line(result, count_only)
+        return
+
+    workers = min(workers, len(chunks))
+    context = multiprocessing.get_context(BATCH_START_METHOD)
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=context, initializer=_init_worker, initargs=initargs
+    ) as pool:
+        # Bounded window instead of pool.map, which would queue every chunk's result in memory
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(_chunk_text, chunk, count_only))
+            if len(pending) > workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def run_batch_text(text, fmt, levels, workers=BATCH_ADMIN_WORKERS, count_only=False):
+    """Convenience wrapper for uploads: parse ``text`` and stream the NDJSON result text.
+
+    Runs in-process by default (``BATCH_ADMIN_WORKERS``), since it is called from a web worker.
+    """
+    profiles = read_profiles(io.StringIO(text), fmt)
+    logger.info(f"📦 Batch qualification: {len(profiles)} profiles, levels {levels}")
+    return run_batch(profiles, levels, workers=workers, count_only=count_only)
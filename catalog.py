@@ -0,0 +1,613 @@
+# --- Course Catalog Snapshot ---
+"""In-process snapshot of the KUCCPS course catalog.
+
+The course collections (degree clusters, diploma, certificate, artisan and KMTC
+collections) change maybe once a season, so each worker loads them once into
+memory and every qualification check runs against that snapshot instead of
+re-reading MongoDB per request. Call ``course_catalog.refresh()`` after the
+catalog has been updated to pick up the new data.
+
+With ``CATALOG_SOURCE=live`` the courses are read from MongoDB on every request
+instead. Either way the collections of a level are read concurrently over the
+shared MongoClient and merged back in catalog order.
+
+A load in which any collection could not be read is incomplete: it never
+replaces a complete snapshot and is retried after ``CATALOG_RETRY_SECONDS``.
+``refresh(broadcast=True)`` also bumps a generation counter in the attached
+MongoDB collection; every worker compares it with the generation it loaded at
+most every ``CATALOG_SYNC_INTERVAL`` seconds and reloads when it is behind.
+"""
+import atexit
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from bson import ObjectId
+
+from qualification import KIND_CLUSTER, KIND_MEAN, PUSHDOWN_INDEXES, compile_level
+
+logger = logging.getLogger(__name__)
+
+# Optional maximum snapshot age in seconds (0 = only refresh explicitly)
+CATALOG_MAX_AGE = int(os.getenv('CATALOG_MAX_AGE', '0') or 0)
+
+# 'snapshot' serves qualification from memory; 'live' reads MongoDB on every request
+CATALOG_SOURCE_SNAPSHOT = 'snapshot'
+CATALOG_SOURCE_LIVE = 'live'
+CATALOG_SOURCE = os.getenv('CATALOG_SOURCE', CATALOG_SOURCE_SNAPSHOT)
+
+# Upper bound on concurrent collection reads over the shared MongoClient pool
+CATALOG_FETCH_WORKERS = int(os.getenv('CATALOG_FETCH_WORKERS', '8') or 1)
+
+# How long the list of existing collections of a level is trusted (seconds)
+COLLECTION_LIST_TTL = 600
+
+# Seconds before an incomplete load (some collection failed) is retried
+CATALOG_RETRY_SECONDS = int(os.getenv('CATALOG_RETRY_SECONDS', '30') or 0)
+
+# How often a worker checks the shared refresh generation (seconds, 0 = never)
+CATALOG_SYNC_INTERVAL = int(os.getenv('CATALOG_SYNC_INTERVAL', '30') or 0)
+CATALOG_SYNC_ID = 'course_catalog'
+
+# --- Course levels ---
+# Database and collections of every KUCCPS level
+CLUSTERS = [f"cluster_{i}" for i in range(1, 21)]
+
+DIPLOMA_COLLECTIONS = [
+    "Agricultural_Sciences_Related", "Animal_Health_Related", "Applied_Sciences",
+    "Building_Construction_Related", "Business_Related", "Clothing_Fashion_Textile",
+    "Computing_IT_Related", "Education_Related", "Engineering_Technology_Related",
+    "Environmental_Sciences", "Food_Science_Related", "Graphics_MediaStudies_Related",
+    "Health_Sciences_Related", "HairDressing_Beauty_Therapy", "Hospitality_Hotel_Tourism_Related",
+    "Library_Information_Science", "Natural_Sciences_Related", "Nutrition_Dietetics",
+    "Social_Sciences", "Tax_Custom_Administration", "Technical_Courses"
+]
+
+KMTC_COLLECTIONS = ["kmtc_courses"]
+
+CERTIFICATE_COLLECTIONS = [
+    "Agricultural_Sciences", "Applied_Sciences", "Building_Construction_Related",
+    "Business_Related", "Clothing_Fashion_Textile", "Computing_IT_Related",
+    "Engineering_Technology_Related", "Environmental_Sciences", "Food_Science_Related",
+    "Graphics_MediaStudies_Related", "HairDressing_Beauty_Therapy", "Health_Sciences_Related",
+    "Hospitality_Hotel_Tourism_Related", "Library_Information_Science",
+    "Natural_Sciences_Related", "Nutrition_Dietetics", "Social_Sciences", "Tax_Custom_Administration"
+]
+
+ARTISAN_COLLECTIONS = [
+    "Business_Related",
+    "Building_Construction_Related",
+    "Engineering_Technology_Related",
+    "Food_Science_Related",
+    "Social_Sciences",
+    "Applied_Sciences",
+    "IT_Related",
+    "Hospitality_Hotel_Tourism_Related",
+    "Clothing_Fashion_Textile",
+    "Agricultural_Sciences_Related",
+    "Technical_Courses",
+    "Hair_Dressing_Beauty_Therapy"
+]
+
+
+class CatalogLevel:
+    """Where the courses of one level live and how they are tagged"""
+
+    def __init__(self, name, database, collections, tag_field=None, kind=KIND_MEAN):
+        self.name = name
+        self.database = database
+        self.collections = list(collections)
+        # Field set on every course with the name of its source collection
+        # ('cluster' for degree, 'collection' for diploma/certificate/artisan)
+        self.tag_field = tag_field
+        # Whether courses are gated by cluster cut-off points or by mean grade
+        self.kind = kind
+        self._existing = None
+        self._existing_resolved_at = 0
+
+    def existing_collections(self, refresh=False):
+        """Configured collections that exist in the database (cached for COLLECTION_LIST_TTL)"""
+        expired = time.monotonic() - self._existing_resolved_at > COLLECTION_LIST_TTL
+        if self._existing is None or refresh or expired:
+            names = set(self.database.list_collection_names())
+            self._existing = [name for name in self.collections if name in names]
+            self._existing_resolved_at = time.monotonic()
+        return self._existing
+
+
+class CatalogSnapshot:
+    """Immutable view of every course level loaded at one point in time"""
+
+    def __init__(self, courses, collections, version, loaded_at, compiled=None, complete=True):
+        # level -> list of course dicts (already tagged with their collection)
+        self._courses = courses
+        # level -> list of source collection names, parallel to _courses
+        self._collections = collections
+        # level -> qualification.CompiledLevel, parallel to _courses
+        self._compiled = compiled or {}
+        self._course_indexes = {}
+        self.version = version
+        self.loaded_at = loaded_at
+        self.loaded_monotonic = time.monotonic()
+        # False when some collection could not be read (the snapshot is missing courses)
+        self.complete = complete
+
+    def courses(self, level):
+        """Return the list of course dicts for a level (do not mutate)"""
+        return self._courses.get(level, [])
+
+    def collections(self, level):
+        """Return the source collection name of every course of a level"""
+        return self._collections.get(level, [])
+
+    def compiled(self, level):
+        """Return the precompiled requirements of a level (None if not loaded)"""
+        return self._compiled.get(level)
+
+    def levels(self):
+        return list(self._courses.keys())
+
+    def counts(self):
+        return {level: len(courses) for level, courses in self._courses.items()}
+
+    def total_courses(self):
+        return sum(len(courses) for courses in self._courses.values())
+
+    def problems(self):
+        """Courses whose requirement grades could not be parsed, per level"""
+        return {level: compiled.problems for level, compiled in self._compiled.items()}
+
+    def course_index(self, level):
+        """(collection, course id) -> course dict for a level, built on first use"""
+        index = self._course_indexes.get(level)
+        if index is None:
+            index = {
+                (collection_name, course_id(course)): course
+                for course, collection_name in zip(self.courses(level), self.collections(level))
+            }
+            self._course_indexes[level] = index
+        return index
+
+
+EMPTY_SNAPSHOT = CatalogSnapshot({}, {}, version='empty', loaded_at=None)
+
+# Indexes on the identity fields written by scripts/normalize_catalog.py
+CATALOG_KEY_INDEXES = [('course_key', 1), ('course_id', 1)]
+
+
+def course_key(level, collection_name, course):
+    """Canonical, human-readable key of a course: level:collection:programme code.
+
+    Falls back to the programme and institution names for courses without a code.
+    """
+    code = course.get('programme_code') or course.get('course_code')
+    if not code:
+        name = course.get('programme_name') or course.get('course_name') or ''
+        code = f"{name}@{course.get('institution_name', '')}"
+    code = '-'.join(str(code).strip().lower().split())
+    return f"{level}:{collection_name}:{code}"
+
+
+def course_id(course):
+    """Stable string id of a course document (its _id as a string)"""
+    return str(course.get('_id')) if course.get('_id') is not None else None
+
+
+def course_summary(course):
+    """The fields needed to identify a course in batch reports and previews"""
+    return {
+        'course_id': course_id(course),
+        'programme_code': course.get('programme_code') or course.get('course_code'),
+        'programme_name': course.get('programme_name') or course.get('course_name'),
+        'institution_name': course.get('institution_name'),
+        'collection': course.get('cluster') or course.get('collection'),
+    }
+
+
+def compute_catalog_version(courses):
+    """Content hash of the catalog so every worker with the same data agrees on the version"""
+    digest = hashlib.sha1()
+    for level in sorted(courses):
+        digest.update(level.encode('utf-8'))
+        for course in courses[level]:
+            digest.update(json.dumps(course, sort_keys=True, default=str).encode('utf-8'))
+    return digest.hexdigest()[:12]
+
+
+class CourseCatalog:
+    """Loads all course levels once per worker and serves them from memory"""
+
+    def __init__(self, max_age=CATALOG_MAX_AGE, source=CATALOG_SOURCE, fetch_workers=CATALOG_FETCH_WORKERS):
+        self._levels = {}
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self.max_age = max_age
+        self.source = source
+        self.fetch_workers = max(1, fetch_workers)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        # Loads attempted so far (lets threads waiting on the lock skip a load that just ran)
+        self._loads = 0
+        # No reload before this monotonic time after an incomplete load
+        self._retry_at = 0
+        # "level.collection" names that failed in the last load
+        self.load_failures = []
+        # Shared refresh generation (see attach)
+        self._sync = None
+        self.sync_interval = CATALOG_SYNC_INTERVAL
+        self._generation = 0
+        self._synced_at = 0
+
+    def attach(self, collection):
+        """Use ``collection`` (user_data.catalog_state) for the refresh generation shared by every worker"""
+        self._sync = collection
+
+    def register_level(self, name, database, collections, tag_field=None, kind=KIND_MEAN):
+        """Register (or re-register after reconnecting) the source of a course level"""
+        self._levels[name] = CatalogLevel(name, database, collections, tag_field, kind)
+
+    @property
+    def configured(self):
+        return bool(self._levels)
+
+    @property
+    def live(self):
+        """True when qualification must read MongoDB per request instead of the snapshot"""
+        return self.source == CATALOG_SOURCE_LIVE
+
+    @property
+    def version(self):
+        return self.snapshot().version
+
+    def level(self, name):
+        return self._levels.get(name)
+
+    def available(self, name):
+        """True when courses of level ``name`` can be looked up (registered, and loaded unless live)"""
+        if name not in self._levels:
+            return False
+        return self.live or bool(self.courses(name))
+
+    def registered_levels(self):
+        return list(self._levels.values())
+
+    def snapshot(self):
+        """Return the current snapshot, loading it on first use"""
+        snapshot = self._snapshot
+        if snapshot is not None and not self._is_stale(snapshot) and not self._refresh_requested():
+            return snapshot
+
+        loads = self._loads
+        with self._lock:
+            # Another thread may have loaded it while we waited for the lock
+            if self._snapshot is not None and self._loads != loads:
+                return self._snapshot
+            return self._load()
+
+    def courses(self, level):
+        return self.snapshot().courses(level)
+
+    def refresh(self, broadcast=False):
+        """Reload every level from MongoDB and swap the snapshot atomically.
+
+        With ``broadcast`` the shared generation is bumped first, so the other
+        workers reload within CATALOG_SYNC_INTERVAL too.
+        """
+        if broadcast and self._sync is not None:
+            self._sync.update_one(
+                {'_id': CATALOG_SYNC_ID},
+                {'$inc': {'generation': 1}, '$set': {'refreshed_at': datetime.now()}},
+                upsert=True
+            )
+        with self._lock:
+            return self._load()
+
+    def _is_stale(self, snapshot):
+        if time.monotonic() < self._retry_at:
+            return False
+        if not snapshot.complete:
+            return True
+        if not self.max_age:
+            return False
+        return time.monotonic() - snapshot.loaded_monotonic > self.max_age
+
+    def _shared_generation(self):
+        """Current shared refresh generation; None if it cannot be read"""
+        if self._sync is None:
+            return None
+        try:
+            document = self._sync.find_one({'_id': CATALOG_SYNC_ID}, {'generation': 1})
+        except Exception as e:
+            logger.error(f"❌ Error reading the catalog refresh generation: {str(e)}")
+            return None
+        return (document or {}).get('generation', 0)
+
+    def _refresh_requested(self):
+        """True when another worker refreshed the catalog after this one loaded it"""
+        if self._sync is None or not self.sync_interval:
+            return False
+        now = time.monotonic()
+        if now - self._synced_at < self.sync_interval:
+            return False
+        self._synced_at = now
+        generation = self._shared_generation()
+        return generation is not None and generation > self._generation
+
+    def _load(self):
+        if not self._levels:
+            logger.warning("⚠️ Course catalog has no levels registered (database not connected?)")
+            self._snapshot = self._snapshot or EMPTY_SNAPSHOT
+            return self._snapshot
+
+        started = time.perf_counter()
+        # Read before the courses, so a refresh requested during the load is not missed
+        generation = self._shared_generation()
+        failures = []
+        fetched = self.fetch_levels(list(self._levels), refresh_collections=True, failures=failures)
+        self._loads += 1
+        courses = {}
+        collections = {}
+        compiled = {}
+        for level in self._levels.values():
+            courses[level.name], collections[level.name] = fetched[level.name]
+            compiled[level.name] = compile_level(
+                level.name, level.kind, courses[level.name], collections[level.name]
+            )
+
+        snapshot = CatalogSnapshot(
+            courses,
+            collections,
+            version=compute_catalog_version(courses),
+            loaded_at=datetime.now(),
+            compiled=compiled,
+            complete=not failures
+        )
+        self.load_failures = failures
+        if failures:
+            self._retry_at = time.monotonic() + CATALOG_RETRY_SECONDS
+            logger.error(
+                f"❌ Course catalog load incomplete, {len(failures)} collections failed "
+                f"({', '.join(failures[:5])}); retrying in {CATALOG_RETRY_SECONDS}s"
+            )
+            previous = self._snapshot
+            if previous is not None and previous.complete and previous.total_courses():
+                logger.error("❌ Keeping the previous complete catalog snapshot")
+                return previous
+            # Nothing better to serve meanwhile; _is_stale reloads it once the retry time has passed
+            self._snapshot = snapshot
+            return snapshot
+        self._retry_at = 0
+
+        if self._snapshot is not None and self._snapshot.total_courses() and not snapshot.total_courses():
+            # Never replace a good snapshot with an empty one (e.g. transient Atlas outage)
+            logger.error("❌ Catalog reload returned no courses, keeping previous snapshot")
+            return self._snapshot
+
+        self._snapshot = snapshot
+        if generation is not None:
+            self._generation = generation
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        logger.info(
+            f"✅ Course catalog loaded: version {snapshot.version}, "
+            f"{snapshot.counts()} in {elapsed_ms:.0f}ms"
+        )
+        return snapshot
+
+    # --- MongoDB fan-out ---
+    def _pool(self):
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.fetch_workers, thread_name_prefix='catalog-fetch'
+                    )
+        return self._executor
+
+    def fetch_level(self, name, query=None, projection=None):
+        """Read one level straight from MongoDB: returns (courses, collection names).
+
+        ``query`` is a filter dict or a callable taking the collection name (for
+        per-collection filters such as degree cut-offs).
+        """
+        return self.fetch_levels([name], query=query, projection=projection)[name]
+
+    def fetch_levels(self, names, query=None, projection=None, refresh_collections=False, failures=None):
+        """Read all collections of the given levels concurrently and merge them in catalog order.
+
+        Collections that cannot be listed or read are skipped; their
+        "level.collection" names are appended to ``failures`` when given.
+        """
+        jobs = []
+        for name in names:
+            level = self._levels.get(name)
+            if level is None:
+                continue
+            try:
+                existing = level.existing_collections(refresh=refresh_collections)
+            except Exception as e:
+                logger.error(f"❌ Error listing collections for {name}: {str(e)}")
+                if failures is not None:
+                    failures.append(f"{name}.*")
+                continue
+            for collection_name in existing:
+                collection_query = query(collection_name) if callable(query) else query
+                jobs.append((level, collection_name, collection_query))
+
+        if len(jobs) > 1 and self.fetch_workers > 1:
+            futures = [
+                self._pool().submit(self._read_collection, level, collection_name, collection_query, projection)
+                for level, collection_name, collection_query in jobs
+            ]
+            results = [future.result() for future in futures]
+        else:
+            results = [
+                self._read_collection(level, collection_name, collection_query, projection)
+                for level, collection_name, collection_query in jobs
+            ]
+
+        # Merge in job order so the result never depends on which read finished first
+        fetched = {name: ([], []) for name in names}
+        for (level, collection_name, _), documents in zip(jobs, results):
+            if documents is None:
+                if failures is not None:
+                    failures.append(f"{level.name}.{collection_name}")
+                continue
+            courses, collections = fetched[level.name]
+            courses.extend(documents)
+            collections.extend([collection_name] * len(documents))
+        return fetched
+
+    def hydrate(self, name, collection_names, ids):
+        """Full documents for (collection, _id) pairs, one $in read per collection.
+
+        Returns the documents in the order of ``ids``; ids that no longer exist
+        (catalog updated between the two reads) are dropped.
+        """
+        level = self._levels.get(name)
+        if level is None:
+            return []
+        wanted = {}
+        for collection_name, course_id in zip(collection_names, ids):
+            wanted.setdefault(collection_name, []).append(course_id)
+
+        jobs = [
+            (collection_name, {'_id': {'$in': collection_ids}})
+            for collection_name, collection_ids in wanted.items()
+        ]
+        if len(jobs) > 1 and self.fetch_workers > 1:
+            futures = [
+                self._pool().submit(self._read_collection, level, collection_name, query, None)
+                for collection_name, query in jobs
+            ]
+            results = [future.result() for future in futures]
+        else:
+            results = [self._read_collection(level, collection_name, query, None) for collection_name, query in jobs]
+
+        by_id = {}
+        for (collection_name, _), documents in zip(jobs, results):
+            for course in documents or ():
+                by_id[(collection_name, course['_id'])] = course
+        hydrated = []
+        for collection_name, course_id in zip(collection_names, ids):
+            course = by_id.get((collection_name, course_id))
+            if course is not None:
+                hydrated.append(course)
+        return hydrated
+
+    # --- Course references ---
+    def course_ref(self, name, course):
+        """Compact [collection, course id] reference of a course (None if it cannot be referenced)"""
+        level = self._levels.get(name)
+        if level is None or course.get('_id') is None:
+            return None
+        collection_name = course.get(level.tag_field) if level.tag_field else None
+        if collection_name is None and len(level.collections) == 1:
+            collection_name = level.collections[0]
+        if collection_name is None:
+            return None
+        return [collection_name, course_id(course)]
+
+    def resolve(self, name, refs):
+        """Courses for stored [collection, course id] references, in reference order.
+
+        Served from the snapshot; references it does not hold (live mode, or a
+        catalog updated since they were written) are hydrated from MongoDB.
+        References that no longer exist are dropped. Snapshot courses are shared,
+        copy before mutating.
+        """
+        refs = [(collection_name, str(ref_id)) for collection_name, ref_id in refs]
+        index = {} if self.live else self.snapshot().course_index(name)
+        found = [index.get(ref) for ref in refs]
+
+        missing = [ref for ref, course in zip(refs, found) if course is None]
+        if missing:
+            documents = self.hydrate(
+                name,
+                [collection_name for collection_name, _ in missing],
+                [ObjectId(ref_id) if ObjectId.is_valid(ref_id) else ref_id for _, ref_id in missing]
+            )
+            hydrated = {course_id(course): course for course in documents}
+            for position, (ref, course) in enumerate(zip(refs, found)):
+                if course is None:
+                    found[position] = hydrated.get(ref[1])
+        return [course for course in found if course is not None]
+
+    @staticmethod
+    def _read_collection(level, collection_name, query, projection):
+        """Documents of one collection, tagged with its name; None if it could not be read"""
+        documents = []
+        try:
+            for course in level.database[collection_name].find(query or {}, projection):
+                course = dict(course)
+                if level.tag_field:
+                    course[level.tag_field] = collection_name
+                documents.append(course)
+        except Exception as e:
+            logger.error(f"❌ Error loading {level.name} collection {collection_name}: {str(e)}")
+            return None
+        return documents
+
+    def ensure_pushdown_indexes(self):
+        """Create the indexes the server-side filters and course id lookups rely on"""
+        created = 0
+        for level in self._levels.values():
+            try:
+                existing = level.existing_collections()
+            except Exception as e:
+                logger.error(f"❌ Error listing collections for {level.name}: {str(e)}")
+                continue
+            for collection_name in existing:
+                for field, direction in PUSHDOWN_INDEXES[level.kind] + CATALOG_KEY_INDEXES:
+                    try:
+                        level.database[collection_name].create_index([(field, direction)], name=f'{field}_index')
+                        created += 1
+                    except Exception as e:
+                        logger.error(f"❌ Error creating {field} index on {level.name}.{collection_name}: {str(e)}")
+        logger.info(f"✅ Ensured {created} catalog indexes")
+        return created
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def describe(self):
+        """Summary used by the admin health pages"""
+        snapshot = self._snapshot or EMPTY_SNAPSHOT
+        return {
+            'version': snapshot.version,
+            'loaded_at': snapshot.loaded_at.isoformat() if snapshot.loaded_at else None,
+            'counts': snapshot.counts(),
+            'total_courses': snapshot.total_courses(),
+            'unparseable_requirements': {
+                level: len(problems) for level, problems in snapshot.problems().items()
+            },
+            'max_age': self.max_age,
+            'source': self.source,
+            'complete': snapshot.complete,
+            'load_failures': list(self.load_failures),
+            'generation': self._generation
+        }
+
+
+def register_course_levels(client, catalog=None):
+    """Register every course level of ``client`` with ``catalog`` (the shared catalog by default)"""
+    catalog = catalog or course_catalog
+    catalog.register_level('degree', client['Degree'], CLUSTERS, tag_field='cluster', kind=KIND_CLUSTER)
+    catalog.register_level('diploma', client['diploma'], DIPLOMA_COLLECTIONS, tag_field='collection')
+    catalog.register_level('certificate', client['certificate'], CERTIFICATE_COLLECTIONS, tag_field='collection')
+    catalog.register_level('artisan', client['artisan'], ARTISAN_COLLECTIONS, tag_field='collection')
+    catalog.register_level('kmtc', client['kmtc'], KMTC_COLLECTIONS)
+    return catalog
+
+
+# Shared per-worker catalog, configured by app.py once the database is connected
+course_catalog = CourseCatalog()
+
+# Release the fetch threads on program exit
+atexit.register(course_catalog.shutdown)
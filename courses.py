@@ -1,7 +1,7 @@
 # --- Course Management Functions ---
 from flask import session
 from datetime import datetime, timedelta
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
 from bson import ObjectId
 import os
 from dotenv import load_dotenv
@@ -10,6 +10,10 @@ import os
 import json
 import traceback
 
+from catalog import course_catalog
+from db_health import connection_health
+from result_store import result_store
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -19,6 +23,9 @@ load_dotenv()
 
 # Database connection setup
 MONGODB_URI = os.getenv('MONGODB_URI')
+
+# Log the caller stack of every course save (expensive, for debugging only)
+COURSES_DEBUG_STACKS = os.getenv('COURSES_DEBUG_STACKS', '').lower() in ('1', 'true', 'yes')
 database_connected = False
 user_courses_collection = None
 client = None
@@ -34,13 +41,15 @@ def initialize_database():
             connectTimeoutMS=5000,
             socketTimeoutMS=5000,
             retryWrites=True,
-            retryReads=True
+            retryReads=True,
+            event_listeners=[connection_health]
         )
         # Test connection
         client.admin.command('ping')
         
         db_user_data = client['user_data']
         user_courses_collection = db_user_data['user_courses']
+        result_store.attach(db_user_data['result_store'])
         
         # Create indexes if they don't exist
         user_courses_collection.create_index([
@@ -57,12 +66,113 @@ def initialize_database():
         database_connected = False
         return False
 
+# --- Compact course records ---
+# user_courses documents store [collection, course id] references plus the
+# catalog version instead of full course copies; the courses are hydrated from
+# the catalog at read time. Documents written before this still embed the full
+# copies under 'courses' and are rewritten to references when next read.
+
+def course_refs(level, courses):
+    """[collection, course id] of every course, or None if any course cannot be referenced"""
+    refs = []
+    for course in courses:
+        ref = course_catalog.course_ref(level, course)
+        if ref is None:
+            return None
+        refs.append(ref)
+    return refs
+
+
+def _json_safe(course):
+    course_copy = dict(course)
+    if isinstance(course_copy.get('_id'), ObjectId):
+        course_copy['_id'] = str(course_copy['_id'])
+    return course_copy
+
+
+def record_course_count(record):
+    """Number of courses in a user_courses document of either format"""
+    if not record:
+        return 0
+    if 'course_refs' in record:
+        return len(record['course_refs'])
+    return len(record.get('courses') or [])
+
+
+def record_courses(level, record, migrate=True):
+    """Courses of a user_courses document (either format) as JSON-safe copies"""
+    if not record:
+        return []
+    if 'course_refs' in record:
+        courses = course_catalog.resolve(level, record['course_refs'])
+        if len(courses) != len(record['course_refs']):
+            logger.warning(
+                f"⚠️ {len(record['course_refs']) - len(courses)} stored {level} courses no longer in the catalog "
+                f"(saved at version {record.get('catalog_version')}, now {course_catalog.version})"
+            )
+        return [_json_safe(course) for course in courses]
+
+    courses = [_json_safe(course) for course in record.get('courses') or [] if course and isinstance(course, dict)]
+    if migrate and courses:
+        _migrate_legacy_record(level, record, courses)
+    return courses
+
+
+def _migrate_legacy_record(level, record, courses):
+    """Rewrite a document with embedded course copies to references (only if every course still resolves)"""
+    if not database_connected or user_courses_collection is None:
+        return False
+    refs = course_refs(level, courses)
+    if refs is None or len(course_catalog.resolve(level, refs)) != len(refs):
+        return False
+    if '_id' in record:
+        query = {'_id': record['_id']}
+    else:
+        query = {'email': record.get('email'), 'index_number': record.get('index_number'), 'level': level}
+    try:
+        # Only the legacy shape matches, so a concurrent save is never overwritten
+        query['courses'] = {'$exists': True}
+        result = user_courses_collection.update_one(query, {
+            '$set': {
+                'course_refs': refs,
+                'catalog_version': course_catalog.version,
+                'courses_count': len(refs)
+            },
+            '$unset': {'courses': ''}
+        })
+        if result.modified_count:
+            logger.info(f"🔄 Migrated {level} record to {len(refs)} course references")
+        return bool(result.modified_count)
+    except Exception as e:
+        logger.error(f"❌ Error migrating {level} course record: {str(e)}")
+        return False
+
+
+# --- Session course handles ---
+# The session only holds a handle ({'result_key', 'courses_count', flags}) under
+# '{level}_courses_{index_number}'; the course list itself lives in result_store.
+
+def store_session_courses(level, index_number, courses, **flags):
+    """Put a course list in the result store and keep only its handle in the session"""
+    session[f'{level}_courses_{index_number}'] = result_store.put(index_number, level, courses, **flags)
+
+
+def session_courses(level, index_number):
+    """Course list behind the session handle (None if there is none or it expired)"""
+    session_data = session.get(f'{level}_courses_{index_number}')
+    if not session_data:
+        return None
+    if 'courses' in session_data:
+        # Sessions written before the result store carry the list inline
+        return session_data['courses']
+    return result_store.get(session_data)
+
+
 def verify_courses_consistency(email, index_number, level):
     """Verify course data consistency between session and database"""
     logger.info(f"Verifying course consistency for {email}, {index_number}, {level}")
     
-    session_key = f'{level}_courses_{index_number}'
-    session_data = session.get(session_key)
+    session_data = session_courses(level, index_number)
     
     if not database_connected:
         logger.warning("Database not connected, cannot verify consistency")
@@ -75,16 +185,15 @@ def verify_courses_consistency(email, index_number, level):
             'level': level
         })
         
-        if not db_data or 'courses' not in db_data:
+        if not db_data or not ('courses' in db_data or 'course_refs' in db_data):
             logger.warning("No courses found in database")
             return False
         
-        db_courses = db_data['courses']
+        db_courses = record_courses(level, db_data)
         db_count = len(db_courses)
         
-        if session_data and 'courses' in session_data:
-            session_courses = session_data['courses']
-            session_count = len(session_courses)
+        if session_data is not None:
+            session_count = len(session_data)
             
             if session_count != db_count:
                 logger.warning(f"⚠️ Course count mismatch - Session: {session_count}, DB: {db_count}")
@@ -95,12 +204,10 @@ def verify_courses_consistency(email, index_number, level):
                 # regenerate courses; if session-derived values are incomplete, that may cause
                 # smaller course lists to be computed and (if saved) overwrite DB records.
                 # We update session here deliberately to keep UI in sync with DB.
-                session[session_key] = {
-                    'courses': db_courses,
-                    'courses_count': db_count,
-                    'last_db_fetch': datetime.now().isoformat(),
-                    'from_db': True
-                }
+                store_session_courses(
+                    level, index_number, db_courses,
+                    last_db_fetch=datetime.now().isoformat(), from_db=True
+                )
                 logger.info("✅ Session updated from database")
                 return True
         
@@ -127,36 +234,29 @@ def get_user_courses(email, index_number, level, force_refresh=False):
     """Get user courses with strict database preference"""
     logger.info(f"Getting courses for {email}, {index_number}, {level}")
     
-    session_key = f'{level}_courses_{index_number}'
+    # The background health monitor tracks the connection; when it is degraded
+    # go straight to the session fallback instead of waiting out a server timeout
+    if database_connected and not connection_health.healthy:
+        logger.warning(f"⚠️ Database connection {connection_health.state}, skipping database read")
     
     # Always try database first if connected
-    if database_connected:
+    if database_connected and connection_health.healthy:
         try:
-            # Ensure fresh database connection
-            if not client.admin.command('ping'):
-                logger.warning("Database connection lost, reconnecting...")
-                initialize_database()
-            
             db_data = user_courses_collection.find_one({
                 'email': email,
                 'index_number': index_number,
                 'level': level
             })
             
-            if db_data and 'courses' in db_data:
-                # Validate and convert courses
+            if db_data and ('courses' in db_data or 'course_refs' in db_data):
+                # Hydrate and validate courses
                 valid_courses = []
-                original_count = len(db_data['courses'])
+                original_count = record_course_count(db_data)
                 
-                for course in db_data['courses']:
-                    if course and isinstance(course, dict):
-                        course_copy = dict(course)
-                        if '_id' in course_copy:
-                            if isinstance(course_copy['_id'], ObjectId):
-                                course_copy['_id'] = str(course_copy['_id'])
-                        # Ensure all required fields are present
-                        if ('programme_name' in course_copy or 'course_name' in course_copy):
-                            valid_courses.append(course_copy)
+                for course_copy in record_courses(level, db_data):
+                    # Ensure all required fields are present
+                    if ('programme_name' in course_copy or 'course_name' in course_copy):
+                        valid_courses.append(course_copy)
                 
                 logger.info(f"✅ Loaded {len(valid_courses)} courses from database for {level}")
                 
@@ -208,12 +308,10 @@ def get_user_courses(email, index_number, level, force_refresh=False):
                 # NOTE: Writing verified DB courses into session cache.
                 # This writes the '{level}_courses_{index_number}' session key.
                 # This is safe because data here is validated/verified from DB.
-                session[session_key] = {
-                    'courses': valid_courses,
-                    'courses_count': len(valid_courses),
-                    'last_db_fetch': datetime.now().isoformat(),
-                    'from_db': True
-                }
+                store_session_courses(
+                    level, index_number, valid_courses,
+                    last_db_fetch=datetime.now().isoformat(), from_db=True
+                )
                 
                 return valid_courses
                 
@@ -222,9 +320,8 @@ def get_user_courses(email, index_number, level, force_refresh=False):
     
     # Only use session data if database is unavailable AND not forcing refresh
     if not force_refresh:
-        session_data = session.get(session_key)
-        if session_data and session_data.get('courses'):
-            courses = session_data['courses']
+        courses = session_courses(level, index_number)
+        if courses:
             logger.warning(f"⚠️ Using session data ({len(courses)} courses) - database unavailable")
             return courses
     
@@ -276,60 +373,53 @@ def save_user_courses(email, index_number, level, courses, update_session=True):
     # Always try to save to database first
     if database_connected:
         try:
-            # Ensure fresh database connection
-            if not client.admin.command('ping'):
-                logger.warning("Database connection lost, reconnecting...")
-                initialize_database()
-            
-            # Prepare the record
+            now = datetime.now()
             record = {
                 'email': email,
                 'index_number': index_number,
                 'level': level,
-                'courses': valid_courses,
                 'courses_count': len(valid_courses),
-                'updated_at': datetime.now(),
-                'last_validated': datetime.now()
+                'updated_at': now,
+                'last_validated': now
             }
+            update = {'$set': record}
+            refs = course_refs(level, valid_courses)
+            if refs is not None:
+                record['course_refs'] = refs
+                record['catalog_version'] = course_catalog.version
+                update['$unset'] = {'courses': ''}
+            else:
+                # Courses that are not in the catalog are stored as full copies
+                record['courses'] = valid_courses
+                update['$unset'] = {'course_refs': '', 'catalog_version': ''}
             
-            # Use update_one with upsert to prevent duplicates
-            # Instrumentation: log caller and sizes before updating DB
-            try:
+            if COURSES_DEBUG_STACKS:
                 stack = ''.join(traceback.format_stack(limit=6))
-            except Exception:
-                stack = ''
-            logger.info(f"🛠️ About to update DB for {email}/{index_number}/{level}: saving {len(valid_courses)} courses. Caller stack (trimmed):\n{stack}")
+                logger.info(f"🛠️ About to update DB for {email}/{index_number}/{level}: saving {len(valid_courses)} courses. Caller stack (trimmed):\n{stack}")
 
-            result = user_courses_collection.update_one(
+            # One atomic upsert that returns the post-image (without the course list),
+            # so the save is verified without a ping or a read-back round trip
+            saved_data = user_courses_collection.find_one_and_update(
                 {
                     'email': email,
                     'index_number': index_number,
                     'level': level
                 },
-                {'$set': record},
-                upsert=True
+                update,
+                upsert=True,
+                projection={'_id': 0, 'courses_count': 1},
+                return_document=ReturnDocument.AFTER
             )
             
-            logger.info(f"✅ Saved {len(valid_courses)} courses to database for {level}")
-            
-            # Verify the save
-            saved_data = user_courses_collection.find_one({
-                'email': email,
-                'index_number': index_number,
-                'level': level
-            })
-            
-            if saved_data and len(saved_data.get('courses', [])) == len(valid_courses):
-                logger.info("✅ Database save verified")
+            if saved_data and saved_data.get('courses_count') == len(valid_courses):
+                logger.info(f"✅ Saved {len(valid_courses)} courses to database for {level}")
                 
                 if update_session:
                     # Update session with verified database data
-                    session[f'{level}_courses_{index_number}'] = {
-                        'courses': valid_courses,
-                        'courses_count': len(valid_courses),
-                        'last_db_fetch': datetime.now().isoformat(),
-                        'from_db': True
-                    }
+                    store_session_courses(
+                        level, index_number, valid_courses,
+                        last_db_fetch=now.isoformat(), from_db=True
+                    )
                 
                 return True
             else:
@@ -344,13 +434,10 @@ def save_user_courses(email, index_number, level, courses, update_session=True):
                 # NOTE: Error fallback - saving validated courses to session when DB save fails.
                 # This is a last-resort cache; prefer to surface/handle DB errors instead of
                 # relying on session persistence.
-                session[f'{level}_courses_{index_number}'] = {
-                    'courses': valid_courses,
-                    'courses_count': len(valid_courses),
-                    'last_update': datetime.now().isoformat(),
-                    'from_db': False,
-                    'error': str(e)
-                }
+                store_session_courses(
+                    level, index_number, valid_courses,
+                    last_update=datetime.now().isoformat(), from_db=False, error=str(e)
+                )
             return False
     
     # If no database connection, save to session as last resort
@@ -358,12 +445,10 @@ def save_user_courses(email, index_number, level, courses, update_session=True):
         # NOTE: No-database case: persist courses to session as a last-resort cache.
         # This writes the '{level}_courses_{index_number}' key. Keep this transient
         # and prefer DB writes when connectivity is restored.
-        session[f'{level}_courses_{index_number}'] = {
-            'courses': valid_courses,
-            'courses_count': len(valid_courses),
-            'last_update': datetime.now().isoformat(),
-            'from_db': False
-        }
+        store_session_courses(
+            level, index_number, valid_courses,
+            last_update=datetime.now().isoformat(), from_db=False
+        )
         logger.warning(f"⚠️ Saved {len(valid_courses)} courses to session (database unavailable)")
     
     return True
\ No newline at end of file
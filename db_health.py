@@ -0,0 +1,173 @@
+# --- Database Connection Health ---
+"""Tracks MongoDB connection health in the background.
+
+Request handlers used to ping the server before every read or write, paying a
+round trip (or a full server-selection timeout when the cluster was down) on
+every call. ``ConnectionHealthMonitor`` is registered as a pymongo server
+heartbeat listener on each MongoClient, so the driver's own monitor threads
+keep the state current; an optional low-frequency probe thread asks the
+server as well. Handlers only read ``connection_health.healthy``.
+
+Awaited heartbeats (the streaming protocol of MongoDB 4.4+ / Atlas) block on
+the server for up to heartbeatFrequencyMS, so their duration says nothing about
+latency: they update reachability only.
+
+Healthy means the app can write: a reachable primary (or standalone server /
+mongos). Secondaries answering heartbeats during an election, or with the
+primary gone, do not count.
+"""
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+# Seconds between background pings (0 relies on the driver heartbeats alone)
+DB_HEALTH_PROBE_INTERVAL = float(os.getenv('DB_HEALTH_PROBE_INTERVAL', '0') or 0)
+DB_HEALTH_HISTORY = int(os.getenv('DB_HEALTH_HISTORY', '60') or 60)
+# A reachable server slower than this is reported as degraded
+DB_HEALTH_SLOW_MS = float(os.getenv('DB_HEALTH_SLOW_MS', '2000') or 0)
+
+STATE_UNKNOWN = 'unknown'
+STATE_HEALTHY = 'healthy'
+STATE_DEGRADED = 'degraded'
+
+
+class ConnectionHealthMonitor(monitoring.ServerHeartbeatListener):
+    """Shared healthy/degraded flag fed by heartbeats and an optional probe"""
+
+    def __init__(self, history=DB_HEALTH_HISTORY, slow_ms=DB_HEALTH_SLOW_MS):
+        self.slow_ms = slow_ms
+        self._latencies = deque(maxlen=history)
+        # Latest heartbeat outcome per server address: (ok, latency ms, error)
+        self._servers = {}
+        self._state = STATE_UNKNOWN
+        self._last_error = None
+        self._last_change = None
+        self._failures = 0
+        self._lock = threading.Lock()
+        self._probe_thread = None
+        self._probe_stop = threading.Event()
+
+    # --- Heartbeat listener ---
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        reply = getattr(event, 'reply', None)
+        writable = getattr(reply, 'is_writable', True)
+        # An awaited (streaming) heartbeat waits server-side for up to heartbeatFrequencyMS
+        latency_ms = None if getattr(event, 'awaited', False) else event.duration * 1000.0
+        self._record(event.connection_id, True, latency_ms, writable=writable)
+
+    def failed(self, event):
+        self._record(event.connection_id, False, event.duration * 1000.0, str(event.reply))
+
+    # --- State ---
+    def _record(self, server, ok, latency_ms, error=None, writable=False):
+        """``latency_ms`` None keeps the server's last measured latency (awaited heartbeats)"""
+        with self._lock:
+            last = self._servers.get(server)
+            if latency_ms is None and last is not None and last[0]:
+                latency_ms = last[1]
+            self._servers[server] = (ok, latency_ms, error, ok and writable)
+            if ok and latency_ms is not None:
+                self._latencies.append((time.time(), round(latency_ms, 2)))
+            else:
+                self._failures += 1
+                self._last_error = error
+            # Saves go to the primary, so a reachable writable member is required;
+            # reachable secondaries alone only serve reads
+            writable_latencies = [latency for _, latency, _, can_write in self._servers.values() if can_write]
+            measured = [latency for latency in writable_latencies if latency is not None]
+            if not writable_latencies:
+                state = STATE_DEGRADED
+                if not error and any(ok for ok, _, _, _ in self._servers.values()):
+                    error = 'no writable primary'
+            elif self.slow_ms and measured and min(measured) > self.slow_ms:
+                state = STATE_DEGRADED
+            else:
+                state = STATE_HEALTHY
+            if state != self._state:
+                previous, self._state = self._state, state
+                self._last_change = time.time()
+            else:
+                previous = None
+        if previous is not None:
+            if state == STATE_HEALTHY:
+                logger.info(f"✅ Database connection {state} (was {previous})")
+            else:
+                logger.warning(f"⚠️ Database connection {state} (was {previous}): {error or 'slow responses'}")
+
+    @property
+    def state(self):
+        return self._state
+
+    @property
+    def healthy(self):
+        """False only once the monitor has seen the connection degrade"""
+        return self._state != STATE_DEGRADED
+
+    def reset(self):
+        """Forget per-server state, e.g. after the client was recreated"""
+        with self._lock:
+            self._servers.clear()
+            self._state = STATE_UNKNOWN
+            self._last_change = time.time()
+
+    # --- Probe thread ---
+    def start_probe(self, client, interval=DB_HEALTH_PROBE_INTERVAL):
+        """Ping ``client`` every ``interval`` seconds in a daemon thread"""
+        if interval <= 0 or (self._probe_thread and self._probe_thread.is_alive()):
+            return False
+        self._probe_stop.clear()
+
+        def probe():
+            while not self._probe_stop.wait(interval):
+                started = time.perf_counter()
+                try:
+                    # hello (not ping) so a probe answered by a secondary is not taken as writable
+                    reply = client.admin.command('hello')
+                    writable = bool(reply.get('isWritablePrimary', reply.get('ismaster')))
+                    self._record('probe', True, (time.perf_counter() - started) * 1000.0, writable=writable)
+                except Exception as e:
+                    self._record('probe', False, (time.perf_counter() - started) * 1000.0, str(e))
+
+        self._probe_thread = threading.Thread(target=probe, name='db-health-probe', daemon=True)
+        self._probe_thread.start()
+        logger.info(f"🔄 Database health probe every {interval:g}s")
+        return True
+
+    def stop_probe(self):
+        self._probe_stop.set()
+
+    def stats(self):
+        with self._lock:
+            latencies = [latency for _, latency in self._latencies]
+            history = [
+                {'at': time.strftime('%H:%M:%S', time.localtime(at)), 'ms': latency}
+                for at, latency in self._latencies
+            ]
+            servers = {
+                str(server): {'ok': ok, 'writable': writable, 'latency_ms': round(latency, 2) if latency is not None else None}
+                for server, (ok, latency, _, writable) in self._servers.items()
+            }
+            return {
+                'state': self._state,
+                'healthy': self._state != STATE_DEGRADED,
+                'last_latency_ms': latencies[-1] if latencies else None,
+                'avg_latency_ms': round(sum(latencies) / len(latencies), 2) if latencies else None,
+                'max_latency_ms': max(latencies) if latencies else None,
+                'failures': self._failures,
+                'last_error': self._last_error,
+                'last_change': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self._last_change)) if self._last_change else None,
+                'servers': servers,
+                'history': history,
+            }
+
+
+connection_health = ConnectionHealthMonitor()
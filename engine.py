@@ -0,0 +1,457 @@
+# --- Qualification Engine ---
+"""Single entry point for "which courses does this candidate qualify for".
+
+Every route that needs qualifying courses (results, collection pages, search,
+manual activation, post-payment processing) goes through
+``qualification_engine``. Each course level registers a ``LevelStrategy`` that
+says where its grade profile lives in the session and how it is gated (cluster
+points or mean grade), so caching, timing, engine selection and single-flight
+deduplication are applied in one place instead of once per route.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from catalog import course_catalog, course_summary
+from qualification import (
+    KIND_CLUSTER, KIND_MEAN, QUALIFICATION_ENGINE, QUALIFICATION_PROJECTION,
+    loop_qualifying_indices, pushdown_filter, qualifying_indices
+)
+from qualification_cache import qualification_cache, profile_key
+
+logger = logging.getLogger(__name__)
+
+
+class QualificationProfile:
+    """The grade data one level is qualified on"""
+    __slots__ = ('grades', 'mean_grade', 'cluster_points', 'kind')
+
+    def __init__(self, grades, mean_grade=None, cluster_points=None, kind=KIND_MEAN):
+        self.grades = grades or {}
+        self.mean_grade = mean_grade
+        self.cluster_points = cluster_points or {}
+        self.kind = kind
+
+    @property
+    def complete(self):
+        """Degree needs grades and cluster points; the other levels grades and a mean grade"""
+        if self.kind == KIND_CLUSTER:
+            return bool(self.grades and self.cluster_points)
+        return bool(self.grades and self.mean_grade)
+
+
+def profile_delta(prior_profile, profile):
+    """What changed between two profiles, in the form QualificationEngine.requalify takes"""
+    delta = {}
+    grades = {
+        subject: profile.grades.get(subject)
+        for subject in set(prior_profile.grades) | set(profile.grades)
+        if prior_profile.grades.get(subject) != profile.grades.get(subject)
+    }
+    if grades:
+        delta['grades'] = grades
+    if prior_profile.mean_grade != profile.mean_grade:
+        delta['mean_grade'] = profile.mean_grade
+    points = {
+        cluster: profile.cluster_points.get(cluster, 0)
+        for cluster in set(prior_profile.cluster_points) | set(profile.cluster_points)
+        if prior_profile.cluster_points.get(cluster, 0) != profile.cluster_points.get(cluster, 0)
+    }
+    if points:
+        delta['cluster_points'] = points
+    return delta
+
+
+def apply_delta(prior_profile, delta):
+    """New profile from a prior profile and a delta (see profile_delta)"""
+    grades = dict(prior_profile.grades)
+    for subject, grade in (delta.get('grades') or {}).items():
+        if grade is None:
+            grades.pop(subject, None)
+        else:
+            grades[subject] = grade
+    cluster_points = dict(prior_profile.cluster_points)
+    cluster_points.update(delta.get('cluster_points') or {})
+    return QualificationProfile(
+        grades,
+        mean_grade=delta.get('mean_grade', prior_profile.mean_grade),
+        cluster_points=cluster_points,
+        kind=prior_profile.kind
+    )
+
+
+class LevelStrategy:
+    """Where a level's grade profile is kept in the session and how it is gated"""
+
+    def __init__(self, level, label, kind=KIND_MEAN):
+        self.level = level
+        self.label = label
+        self.kind = kind
+        self.grades_key = f'{level}_grades'
+        self.mean_grade_key = f'{level}_mean_grade'
+        self.cluster_points_key = f'{level}_cluster_points'
+
+    def profile(self, session_data):
+        grades = session_data.get(self.grades_key, {})
+        if self.kind == KIND_CLUSTER:
+            return QualificationProfile(
+                grades, cluster_points=session_data.get(self.cluster_points_key, {}), kind=self.kind
+            )
+        return QualificationProfile(grades, mean_grade=session_data.get(self.mean_grade_key, ''), kind=self.kind)
+
+
+class QualificationEngine:
+    """Registry of level strategies plus the shared qualification pipeline"""
+
+    def __init__(self, catalog=course_catalog, cache=qualification_cache, engine=QUALIFICATION_ENGINE):
+        self.catalog = catalog
+        self.cache = cache
+        self.engine = engine
+        self._strategies = {}
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._timings = {}
+        self.coalesced = 0
+
+    def register(self, strategy):
+        self._strategies[strategy.level] = strategy
+        return strategy
+
+    def strategy(self, level):
+        return self._strategies.get(level)
+
+    def levels(self):
+        return list(self._strategies)
+
+    def session_profile(self, level, session_data):
+        """Grade profile of a level from the session (None for an unknown level)"""
+        strategy = self._strategies.get(level)
+        return strategy.profile(session_data) if strategy else None
+
+    # --- Qualification ---
+    def qualify(self, level, user_grades, user_mean_grade=None, user_cluster_points=None, engine=None):
+        """Return copies of the catalog courses of a level that the grade profile qualifies for.
+
+        Results are memoized per canonical grade profile and catalog version, and
+        concurrent requests for the same profile share one evaluation. Passing
+        ``engine`` overrides QUALIFICATION_ENGINE and bypasses the cache ('loop'
+        re-runs the per-course checks for verification).
+        """
+        started = time.perf_counter()
+        try:
+            if self.catalog.live:
+                courses = self._single_flight(
+                    profile_key(level, 'live', user_grades, user_mean_grade, user_cluster_points,
+                                canonical_points=False),
+                    lambda: self._live_courses(level, user_grades, user_mean_grade, user_cluster_points)
+                )
+                # Coalesced callers share one result list; give every caller its own copies
+                return [dict(course) for course in courses]
+            return self._snapshot_courses(level, user_grades, user_mean_grade, user_cluster_points, engine)
+        finally:
+            self._record(level, time.perf_counter() - started)
+
+    def qualify_ranked(self, level, user_grades, user_mean_grade=None, user_cluster_points=None, limit=None):
+        """Qualifying courses as (margin, course copy), largest margin above the cut-off /
+        minimum mean grade first. Always served from the catalog snapshot.
+        """
+        started = time.perf_counter()
+        try:
+            courses, ranked = self._ranked(level, user_grades, user_mean_grade, user_cluster_points)
+            if limit is not None:
+                ranked = ranked[:limit]
+            return [(margin, dict(courses[position])) for margin, position in ranked]
+        finally:
+            self._record(level, time.perf_counter() - started)
+
+    def _ranked(self, level, user_grades, user_mean_grade, user_cluster_points):
+        """(snapshot courses, ranked (margin, position) pairs) of a level"""
+        snapshot = self.catalog.snapshot()
+        compiled = snapshot.compiled(level)
+        if compiled is None:
+            return [], []
+        ranked = compiled.sorted().qualifying_ranked(user_grades, user_mean_grade, user_cluster_points)
+        return snapshot.courses(level), ranked
+
+    # --- Count-only preview ---
+    def preview(self, level, session_data):
+        """Free pre-payment preview: {'count', 'collections'} for the profile in the session.
+
+        Uses the cached result when there is one, otherwise popcounts the level's
+        requirement bitmaps, so no course is ever materialised. Returns None in
+        live mode (there is no in-memory catalog to count against) or when the
+        session holds no complete profile for the level.
+        """
+        if self.catalog.live:
+            return None
+        profile = self.session_profile(level, session_data)
+        if profile is None or not profile.complete:
+            return None
+        started = time.perf_counter()
+        try:
+            snapshot = self.catalog.snapshot()
+            compiled = snapshot.compiled(level)
+            if compiled is None:
+                return None
+            points = profile.cluster_points if compiled.kind == KIND_CLUSTER else None
+            positions = self.cache.peek(
+                self._cache_key(snapshot, compiled, profile.grades, profile.mean_grade, points), snapshot.version
+            )
+            if positions is not None:
+                count = len(positions)
+                collections = len({compiled.collections[position] for position in positions})
+            else:
+                count, collections = compiled.bitset().qualifying_summary(profile.grades, profile.mean_grade, points)
+            return {'count': count, 'collections': collections}
+        finally:
+            self._record(level, time.perf_counter() - started)
+
+    # --- All levels at once ---
+    def qualify_everywhere(self, user_grades, user_mean_grade=None, user_cluster_points=None, top_n=5, levels=None):
+        """Evaluate one grade profile against every level.
+
+        Degree is gated by the cluster points and the other levels by the mean
+        grade, exactly as their check_*_qualification functions do. Returns
+        level -> {'count', 'top'} where ``top`` holds the summaries of the
+        ``top_n`` courses with the largest margin above their threshold
+        (catalog order in live mode).
+
+        The levels are evaluated one after another: the work is CPU-bound Python
+        under the GIL and mostly served from the cache, so a thread pool only
+        added hand-off overhead (0.83ms vs 0.66ms per profile).
+        """
+        levels = [level for level in (levels or self.levels()) if level in self._strategies]
+        return {
+            level: self._preview_level(level, user_grades, user_mean_grade, user_cluster_points, top_n)
+            for level in levels
+        }
+
+    def _preview_level(self, level, user_grades, user_mean_grade, user_cluster_points, top_n):
+        strategy = self._strategies[level]
+        if strategy.kind == KIND_CLUSTER:
+            user_mean_grade = None
+        else:
+            user_cluster_points = None
+
+        if self.catalog.live:
+            courses = self.qualify(level, user_grades, user_mean_grade, user_cluster_points)
+            return {
+                'label': strategy.label,
+                'count': len(courses),
+                'top': [course_summary(course) for course in courses[:top_n]],
+            }
+
+        started = time.perf_counter()
+        try:
+            courses, ranked = self._ranked(level, user_grades, user_mean_grade, user_cluster_points)
+        finally:
+            self._record(level, time.perf_counter() - started)
+        top = []
+        for margin, position in ranked[:top_n]:
+            summary = course_summary(courses[position])
+            summary['margin'] = round(margin, 3)
+            top.append(summary)
+        return {'label': strategy.label, 'count': len(ranked), 'top': top}
+
+    def qualify_profile(self, level, profile, engine=None):
+        return self.qualify(level, profile.grades, profile.mean_grade, profile.cluster_points, engine=engine)
+
+    def qualify_session(self, level, session_data, engine=None):
+        """Qualifying courses of a level for the grade profile stored in the session"""
+        profile = self.session_profile(level, session_data)
+        if profile is None:
+            logger.warning(f"⚠️ Unknown course level: {level}")
+            return []
+        return self.qualify_profile(level, profile, engine=engine)
+
+    def _snapshot_courses(self, level, user_grades, user_mean_grade, user_cluster_points, engine):
+        snapshot = self.catalog.snapshot()
+        compiled = snapshot.compiled(level)
+        if compiled is None:
+            return []
+        courses = snapshot.courses(level)
+
+        if engine is not None:
+            positions = qualifying_indices(
+                compiled, courses, user_grades, user_mean_grade, user_cluster_points, engine=engine
+            )
+        else:
+            positions = self._positions(snapshot, compiled, user_grades, user_mean_grade, user_cluster_points)
+        return [dict(courses[position]) for position in positions]
+
+    def _cache_key(self, snapshot, compiled, user_grades, user_mean_grade, user_cluster_points):
+        # Only the key floors cluster points to three decimals (so equal profiles share
+        # an entry), and only when no cut-off of the level is finer than that
+        return profile_key(
+            compiled.level, snapshot.version, user_grades,
+            user_mean_grade=user_mean_grade,
+            user_cluster_points=user_cluster_points if compiled.kind == KIND_CLUSTER else None,
+            canonical_points=compiled.cut_offs_on_grid()
+        )
+
+    def _positions(self, snapshot, compiled, user_grades, user_mean_grade, user_cluster_points, cached_only=False):
+        """Qualifying positions of a profile from the cache, evaluating (once) on a miss"""
+        cache_key = self._cache_key(snapshot, compiled, user_grades, user_mean_grade, user_cluster_points)
+        positions = self.cache.get(cache_key, snapshot.version)
+        if positions is not None or cached_only:
+            return positions
+
+        def evaluate():
+            found = qualifying_indices(
+                compiled, snapshot.courses(compiled.level),
+                user_grades, user_mean_grade, user_cluster_points, engine=self.engine
+            )
+            self.cache.put(cache_key, snapshot.version, found)
+            return found
+        return self._single_flight(cache_key, evaluate)
+
+    # --- Incremental re-qualification ---
+    def requalify(self, level, prior_profile, delta, cached_only=False):
+        """Re-qualify a changed grade profile from the result of the previous one.
+
+        ``delta`` holds what changed: ``grades`` (subject -> grade, None removes
+        the subject), ``mean_grade`` and ``cluster_points`` (cluster -> points).
+        Only the courses a change can affect are re-checked. Returns a dict with
+        the new ``profile``, its qualifying ``courses`` and the ``added`` /
+        ``removed`` courses, or None in live mode or when ``cached_only`` is set
+        and the previous result is no longer cached.
+        """
+        if self.catalog.live:
+            return None
+        snapshot = self.catalog.snapshot()
+        compiled = snapshot.compiled(level)
+        if compiled is None:
+            return None
+        profile = apply_delta(prior_profile, delta)
+
+        started = time.perf_counter()
+        prior_positions = self._positions(
+            snapshot, compiled, prior_profile.grades, prior_profile.mean_grade, prior_profile.cluster_points,
+            cached_only=cached_only
+        )
+        if prior_positions is None:
+            return None
+        prior_points = prior_profile.cluster_points if compiled.kind == KIND_CLUSTER else None
+        points = profile.cluster_points if compiled.kind == KIND_CLUSTER else None
+        result = compiled.inverted().requalify(
+            prior_positions,
+            (prior_profile.grades, prior_profile.mean_grade, prior_points),
+            (profile.grades, profile.mean_grade, points)
+        )
+        self.cache.put(
+            self._cache_key(snapshot, compiled, profile.grades, profile.mean_grade, points),
+            snapshot.version, result.positions
+        )
+        self._record(level, time.perf_counter() - started)
+
+        courses = snapshot.courses(level)
+        return {
+            'profile': profile,
+            'courses': [dict(courses[position]) for position in result.positions],
+            'added': [dict(courses[position]) for position in result.added],
+            'removed': [dict(courses[position]) for position in result.removed],
+            'evaluated': result.evaluated,
+        }
+
+    def requalify_session(self, level, session_data, user_grades, user_mean_grade=None, user_cluster_points=None):
+        """Grade resubmission: derive the new result from the cached result of the profile in the session"""
+        strategy = self._strategies.get(level)
+        if strategy is None:
+            return None
+        prior = strategy.profile(session_data)
+        profile = QualificationProfile(user_grades, user_mean_grade, user_cluster_points, kind=strategy.kind)
+        if not prior.complete or not profile.complete:
+            return None
+        delta = profile_delta(prior, profile)
+        if not delta:
+            return None
+        return self.requalify(level, prior, delta, cached_only=True)
+
+    def _live_courses(self, level, user_grades, user_mean_grade, user_cluster_points):
+        """CATALOG_SOURCE=live: read the level's collections concurrently and check every course.
+
+        The cut-off / mean grade comparison is pushed down to MongoDB on the normalized
+        numeric fields, so only courses the candidate could still qualify for are shipped.
+        The first read projects only the requirement fields; full documents are then
+        hydrated with one $in read per collection for the qualifying courses alone.
+        """
+        level_spec = self.catalog.level(level)
+        if level_spec is None:
+            return []
+        courses, collections = self.catalog.fetch_level(
+            level,
+            query=lambda collection_name: pushdown_filter(
+                level_spec.kind, collection_name, user_mean_grade, user_cluster_points
+            ),
+            projection=QUALIFICATION_PROJECTION
+        )
+        positions = loop_qualifying_indices(
+            level_spec.kind, courses, user_grades, user_mean_grade, user_cluster_points
+        )
+        if not positions:
+            return []
+        return self.catalog.hydrate(
+            level,
+            [collections[position] for position in positions],
+            [courses[position]['_id'] for position in positions]
+        )
+
+    def _single_flight(self, key, evaluate):
+        """Run ``evaluate`` once per key at a time; concurrent callers wait for that result"""
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result()
+
+        try:
+            result = evaluate()
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(key, None)
+
+    # --- Instrumentation ---
+    def _record(self, level, elapsed):
+        with self._stats_lock:
+            timing = self._timings.setdefault(level, {'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+            timing['calls'] += 1
+            timing['total_ms'] += elapsed * 1000
+            timing['max_ms'] = max(timing['max_ms'], elapsed * 1000)
+
+    def stats(self):
+        """Per-level call counts and latencies for the admin health pages"""
+        with self._stats_lock:
+            levels = {
+                level: {
+                    'calls': timing['calls'],
+                    'avg_ms': round(timing['total_ms'] / timing['calls'], 3) if timing['calls'] else 0.0,
+                    'max_ms': round(timing['max_ms'], 3),
+                }
+                for level, timing in self._timings.items()
+            }
+        return {
+            'engine': self.engine,
+            'source': self.catalog.source,
+            'coalesced': self.coalesced,
+            'levels': levels,
+        }
+
+
+# Shared per-worker engine with the five KUCCPS course levels
+qualification_engine = QualificationEngine()
+qualification_engine.register(LevelStrategy('degree', 'Degree', kind=KIND_CLUSTER))
+qualification_engine.register(LevelStrategy('diploma', 'Diploma'))
+qualification_engine.register(LevelStrategy('certificate', 'Certificate'))
+qualification_engine.register(LevelStrategy('artisan', 'Artisan'))
+qualification_engine.register(LevelStrategy('kmtc', 'KMTC'))
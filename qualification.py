@@ -0,0 +1,841 @@
+# --- Qualification Functions ---
+"""Course qualification rules for every KUCCPS level.
+
+``check_*_qualification`` evaluate one raw course document the way the results
+pages always have. ``compile_level`` turns a whole level of the catalog into
+integer predicates once at catalog-load time, so evaluating a user is pure
+integer comparison with no grade parsing per request.
+"""
+import bisect
+import heapq
+import logging
+import os
+
+from qualification_cache import on_points_grid
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional; the compiled engine works without it
+    np = None
+
+logger = logging.getLogger(__name__)
+
+GRADE_VALUES = {
+    'A': 12, 'A-': 11, 'B+': 10, 'B': 9, 'B-': 8, 'C+': 7, 'C': 6, 'C-': 5,
+    'D+': 4, 'D': 3, 'D-': 2, 'E': 1
+}
+
+# KCSE subject codes (the values of app.SUBJECTS)
+SUBJECT_CODES = frozenset({
+    'MAT', 'ENG', 'KIS', 'CHE', 'BIO', 'PHY', 'GEO', 'HAG', 'CRE', 'HRE', 'IRE',
+    'AGR', 'COM', 'ARD', 'BST', 'MUC', 'HSC', 'FRE', 'GER', 'AVI'
+})
+
+# Requirement kinds: degree courses are gated by cluster cut-off points,
+# every other level by the KCSE mean grade
+KIND_CLUSTER = 'cluster'
+KIND_MEAN = 'mean'
+
+# Qualification engines: 'loop' re-runs the check_*_qualification functions on
+# every raw course (kept for verification), 'compiled' evaluates the integer
+# predicates course by course, 'vectorized' evaluates a whole level at once
+# with NumPy, 'bitset' combines precomputed course bitmaps and 'sorted'
+# binary-searches courses sorted by cut-off / minimum mean grade.
+ENGINE_LOOP = 'loop'
+ENGINE_COMPILED = 'compiled'
+ENGINE_VECTORIZED = 'vectorized'
+ENGINE_BITSET = 'bitset'
+ENGINE_SORTED = 'sorted'
+ENGINES = (ENGINE_LOOP, ENGINE_COMPILED, ENGINE_VECTORIZED, ENGINE_BITSET, ENGINE_SORTED)
+
+DEFAULT_ENGINE = ENGINE_VECTORIZED if np is not None else ENGINE_COMPILED
+QUALIFICATION_ENGINE = os.getenv('QUALIFICATION_ENGINE', DEFAULT_ENGINE) or DEFAULT_ENGINE
+if QUALIFICATION_ENGINE not in ENGINES:
+    logger.warning(
+        f"⚠️ Unknown QUALIFICATION_ENGINE {QUALIFICATION_ENGINE!r} (expected one of {', '.join(ENGINES)}), "
+        f"using {DEFAULT_ENGINE}"
+    )
+    QUALIFICATION_ENGINE = DEFAULT_ENGINE
+elif QUALIFICATION_ENGINE == ENGINE_VECTORIZED and np is None:
+    logger.warning("⚠️ QUALIFICATION_ENGINE=vectorized needs numpy, using compiled")
+    QUALIFICATION_ENGINE = ENGINE_COMPILED
+
+
+def check_engine(engine):
+    """The engine to run: ``engine`` or QUALIFICATION_ENGINE; raises ValueError for an unknown name"""
+    engine = engine or QUALIFICATION_ENGINE
+    if engine not in ENGINES:
+        raise ValueError(f"unknown qualification engine {engine!r} (expected one of {', '.join(ENGINES)})")
+    return engine
+
+
+def parse_grade(grade_str):
+    """Parse grade string, handling unexpected formats"""
+    if not grade_str:
+        return None
+    if grade_str in GRADE_VALUES:
+        return grade_str
+    if '/' in grade_str:
+        parts = grade_str.split('/')
+        for part in parts:
+            if part in GRADE_VALUES:
+                return part
+    return None
+
+def meets_requirement(requirement_key, requirement_grade, user_grades):
+    """Check if user meets a single requirement (handles / for either/or)"""
+    parsed_grade = parse_grade(requirement_grade)
+    if not parsed_grade:
+        return False
+
+    if '/' in requirement_key:
+        alternatives = requirement_key.split('/')
+        for subject in alternatives:
+            if subject in user_grades:
+                if GRADE_VALUES[user_grades[subject]] >= GRADE_VALUES[parsed_grade]:
+                    return True
+        return False
+    else:
+        if requirement_key in user_grades:
+            return GRADE_VALUES[user_grades[requirement_key]] >= GRADE_VALUES[parsed_grade]
+        return False
+
+def check_course_qualification(course, user_grades, user_cluster_points):
+    """Check if user qualifies for a specific course based on subjects and cluster points"""
+    requirements = course.get('minimum_subject_requirements', {})
+
+    subject_qualified = True
+    if requirements:
+        for subject_key, required_grade in requirements.items():
+            if not meets_requirement(subject_key, required_grade, user_grades):
+                subject_qualified = False
+                break
+
+    cluster_qualified = True
+    cluster_name = course.get('cluster', '')
+    cut_off_points = course.get('cut_off_points', 0)
+
+    if cluster_name and cut_off_points:
+        user_points = user_cluster_points.get(cluster_name, 0)
+        if user_points < cut_off_points:
+            cluster_qualified = False
+
+    return subject_qualified and cluster_qualified
+
+def check_diploma_course_qualification(course, user_grades, user_mean_grade):
+    """Check if user qualifies for a specific diploma course based on mean grade and subject requirements"""
+    mean_grade_qualified = True
+    min_mean_grade = course.get('minimum_grade', {}).get('mean_grade')
+
+    if min_mean_grade:
+        if GRADE_VALUES[user_mean_grade] < GRADE_VALUES[min_mean_grade]:
+            mean_grade_qualified = False
+
+    subject_qualified = True
+    requirements = course.get('minimum_subject_requirements', {})
+
+    if requirements:
+        for subject_key, required_grade in requirements.items():
+            if not meets_requirement(subject_key, required_grade, user_grades):
+                subject_qualified = False
+                break
+
+    return mean_grade_qualified and subject_qualified
+
+def check_certificate_course_qualification(course, user_grades, user_mean_grade):
+    """Check if user qualifies for a specific certificate course based on mean grade and subject requirements"""
+    return check_diploma_course_qualification(course, user_grades, user_mean_grade)
+
+def check_artisan_course_qualification(course, user_grades, user_mean_grade):
+    """Check if user qualifies for a specific artisan course based on mean grade and subject requirements"""
+    return check_diploma_course_qualification(course, user_grades, user_mean_grade)
+
+
+# --- Compiled Requirements ---
+class CompiledCourse:
+    """Requirements of one course reduced to integer thresholds.
+
+    ``groups`` is a tuple of ``(threshold, subject_indices)`` OR-groups: the
+    user must reach ``threshold`` in at least one subject of every group.
+    A zero ``min_mean``/``cut_off`` means the course has no such requirement.
+    """
+    __slots__ = ('groups', 'min_mean', 'cluster_index', 'cut_off', 'never')
+
+    def __init__(self, groups=(), min_mean=0, cluster_index=-1, cut_off=0, never=False):
+        self.groups = groups
+        self.min_mean = min_mean
+        self.cluster_index = cluster_index
+        self.cut_off = cut_off
+        # Requirements that can never be met (unparseable grades and the like)
+        self.never = never
+
+    def matches_subjects(self, grades):
+        """Only the subject requirement groups (thresholds already checked by the caller)"""
+        for threshold, subjects in self.groups:
+            for subject in subjects:
+                if grades[subject] >= threshold:
+                    break
+            else:
+                return False
+        return True
+
+    def matches(self, grades, mean_value, cluster_points):
+        """Evaluate against an encoded profile (see CompiledLevel.encode_profile)"""
+        if self.never:
+            return False
+        if self.min_mean and mean_value < self.min_mean:
+            return False
+        if self.cut_off and cluster_points[self.cluster_index] < self.cut_off:
+            return False
+        for threshold, subjects in self.groups:
+            for subject in subjects:
+                if grades[subject] >= threshold:
+                    break
+            else:
+                return False
+        return True
+
+
+class CompiledLevel:
+    """Every course of one level compiled against shared subject and cluster indexes"""
+
+    def __init__(self, level, kind, courses, subject_index, cluster_index, problems, collections=()):
+        self.level = level
+        self.kind = kind
+        self.courses = courses
+        # Source collection (degree cluster / diploma category) of every course
+        self.collections = list(collections)
+        # subject code -> position in the encoded grade vector
+        self.subject_index = subject_index
+        # cluster name -> position in the encoded cluster points vector
+        self.cluster_index = cluster_index
+        # Courses whose requirements could not be compiled (they never qualify)
+        self.problems = problems
+        self._vectorized = None
+        self._bitset = None
+        self._inverted = None
+        self._sorted = None
+        self._points_on_grid = None
+
+    def __len__(self):
+        return len(self.courses)
+
+    def __getstate__(self):
+        # Pickled for batch worker processes: lazily built indexes are rebuilt there
+        state = dict(self.__dict__)
+        state.update(_vectorized=None, _bitset=None, _inverted=None, _sorted=None, problems=[])
+        return state
+
+    def encode_profile(self, user_grades, user_mean_grade=None, user_cluster_points=None):
+        """Turn a session grade profile into (grade vector, mean value, cluster points vector).
+
+        Subjects missing from the profile (or with an unknown grade) encode as 0,
+        which fails every requirement just like a missing subject does.
+        """
+        grades = [0] * len(self.subject_index)
+        for subject, grade in (user_grades or {}).items():
+            position = self.subject_index.get(subject)
+            if position is not None:
+                grades[position] = GRADE_VALUES.get(grade, 0)
+
+        mean_value = GRADE_VALUES.get(user_mean_grade, 0) if user_mean_grade else 0
+
+        cluster_points = [0] * len(self.cluster_index)
+        for cluster, points in (user_cluster_points or {}).items():
+            position = self.cluster_index.get(cluster)
+            if position is not None:
+                cluster_points[position] = points
+        return grades, mean_value, cluster_points
+
+    def qualifying_indices(self, user_grades, user_mean_grade=None, user_cluster_points=None):
+        """Positions (in catalog order) of every course the profile qualifies for"""
+        grades, mean_value, cluster_points = self.encode_profile(
+            user_grades, user_mean_grade, user_cluster_points
+        )
+        return [
+            position for position, course in enumerate(self.courses)
+            if course.matches(grades, mean_value, cluster_points)
+        ]
+
+    def cut_offs_on_grid(self):
+        """True when every cut-off has at most three decimals, so floored points decide like exact ones"""
+        if self._points_on_grid is None:
+            self._points_on_grid = all(on_points_grid(course.cut_off) for course in self.courses if course.cut_off)
+        return self._points_on_grid
+
+    def vectorized(self):
+        """NumPy arrays for the whole level, built on first use"""
+        if self._vectorized is None:
+            self._vectorized = VectorizedLevel(self)
+        return self._vectorized
+
+    def bitset(self):
+        """Course bitmaps for the whole level, built on first use"""
+        if self._bitset is None:
+            self._bitset = BitsetLevel(self)
+        return self._bitset
+
+    def inverted(self):
+        """Subject -> courses index and sorted thresholds, built on first use"""
+        if self._inverted is None:
+            self._inverted = InvertedLevel(self)
+        return self._inverted
+
+    def sorted(self):
+        """Courses sorted by cut-off / minimum mean grade, built on first use"""
+        if self._sorted is None:
+            self._sorted = SortedLevel(self)
+        return self._sorted
+
+
+class VectorizedLevel:
+    """A compiled level encoded as dense NumPy arrays.
+
+    Every OR-group of every course is one row of a requirement x subject mask
+    with its grade threshold; ``group_course`` maps the rows back to courses.
+    A course qualifies when none of its rows fail and its mean grade and
+    cluster cut-off checks pass, all computed in one vectorized pass.
+    """
+
+    def __init__(self, compiled):
+        if np is None:
+            raise RuntimeError("numpy is required for the vectorized qualification engine")
+
+        self.compiled = compiled
+        course_count = len(compiled.courses)
+        subject_count = len(compiled.subject_index)
+        group_count = sum(len(course.groups) for course in compiled.courses)
+
+        self.group_threshold = np.zeros(group_count, dtype=np.int8)
+        self.group_mask = np.zeros((group_count, subject_count), dtype=bool)
+        self.group_course = np.zeros(group_count, dtype=np.intp)
+        self.min_mean = np.zeros(course_count, dtype=np.int8)
+        # -1 (no cut-off) indexes the extra zero slot appended to the user's points
+        self.cluster_index = np.full(course_count, -1, dtype=np.intp)
+        self.cut_off = np.zeros(course_count, dtype=np.float64)
+        self.never = np.zeros(course_count, dtype=bool)
+
+        row = 0
+        for position, course in enumerate(compiled.courses):
+            for threshold, subjects in course.groups:
+                self.group_threshold[row] = threshold
+                self.group_mask[row, list(subjects)] = True
+                self.group_course[row] = position
+                row += 1
+            self.min_mean[position] = course.min_mean
+            self.cluster_index[position] = course.cluster_index
+            self.cut_off[position] = course.cut_off
+            self.never[position] = course.never
+        self.course_count = course_count
+
+    def qualifying_mask(self, user_grades, user_mean_grade=None, user_cluster_points=None):
+        """Boolean array over the level's courses"""
+        grades, mean_value, cluster_points = self.compiled.encode_profile(
+            user_grades, user_mean_grade, user_cluster_points
+        )
+        grades = np.asarray(grades, dtype=np.int8)
+        cluster_points = np.asarray(list(cluster_points) + [0.0], dtype=np.float64)
+
+        # A requirement row passes when any of its subjects reaches the threshold
+        row_passes = ((grades[None, :] >= self.group_threshold[:, None]) & self.group_mask).any(axis=1)
+        failed_rows = np.bincount(self.group_course[~row_passes], minlength=self.course_count)
+
+        return (
+            (failed_rows == 0)
+            & ~self.never
+            & (self.min_mean <= mean_value)
+            & (cluster_points[self.cluster_index] >= self.cut_off)
+        )
+
+    def qualifying_indices(self, user_grades, user_mean_grade=None, user_cluster_points=None):
+        mask = self.qualifying_mask(user_grades, user_mean_grade, user_cluster_points)
+        return np.flatnonzero(mask).tolist()
+
+
+def iter_bits(bits):
+    """Yield the positions of the set bits of a Python int, lowest first"""
+    while bits:
+        lowest = bits & -bits
+        yield lowest.bit_length() - 1
+        bits ^= lowest
+
+
+class BitsetLevel:
+    """A compiled level indexed as course bitmaps (bit ``i`` = course ``i``).
+
+    Requirement OR-groups are numbered per course (slot 0, 1, ...). For every
+    slot and every (subject, grade value) pair, ``slot_bitmaps`` holds the
+    courses whose group in that slot the pair satisfies; courses with fewer
+    groups are in ``slot_free``. Mean grades and cut-offs are prefix bitmaps,
+    so a profile is evaluated with a handful of AND/OR operations and counted
+    with a popcount, without materialising any course.
+    """
+
+    def __init__(self, compiled):
+        self.compiled = compiled
+        course_count = len(compiled.courses)
+        self.all_courses = (1 << course_count) - 1
+        slot_count = max((len(course.groups) for course in compiled.courses), default=0)
+        max_grade = max(GRADE_VALUES.values())
+
+        # slot -> {(subject position, grade value): bitmap}
+        self.slot_bitmaps = [dict() for _ in range(slot_count)]
+        self.slot_free = [0] * slot_count
+        never = 0
+        # mean_bitmaps[v]: courses whose minimum mean grade is at most v
+        mean_bitmaps = [0] * (max_grade + 1)
+        # cluster position -> list of (cut-off, course bit), turned into prefix bitmaps below
+        cut_offs = {}
+        self.no_cut_off = 0
+
+        for position, course in enumerate(compiled.courses):
+            bit = 1 << position
+            if course.never:
+                never |= bit
+            for slot in range(slot_count):
+                if slot >= len(course.groups):
+                    self.slot_free[slot] |= bit
+                    continue
+                threshold, subjects = course.groups[slot]
+                bitmaps = self.slot_bitmaps[slot]
+                for subject in subjects:
+                    for value in range(threshold, max_grade + 1):
+                        key = (subject, value)
+                        bitmaps[key] = bitmaps.get(key, 0) | bit
+            for value in range(course.min_mean, max_grade + 1):
+                mean_bitmaps[value] |= bit
+            if course.cut_off:
+                cut_offs.setdefault(course.cluster_index, []).append((course.cut_off, bit))
+            else:
+                self.no_cut_off |= bit
+
+        self.valid = self.all_courses & ~never
+        self.mean_bitmaps = mean_bitmaps
+
+        # collection -> bitmap of its courses, to count collections without materialising courses
+        self.collection_bitmaps = {}
+        for position, collection_name in enumerate(compiled.collections):
+            self.collection_bitmaps[collection_name] = self.collection_bitmaps.get(collection_name, 0) | (1 << position)
+
+        # cluster position -> (sorted cut-offs, prefix bitmaps of courses with cut-off <= that value)
+        self.cluster_prefixes = {}
+        for cluster_position, entries in cut_offs.items():
+            entries.sort(key=lambda entry: entry[0])
+            thresholds = []
+            prefixes = []
+            accumulated = 0
+            for cut_off, bit in entries:
+                accumulated |= bit
+                if thresholds and thresholds[-1] == cut_off:
+                    prefixes[-1] = accumulated
+                else:
+                    thresholds.append(cut_off)
+                    prefixes.append(accumulated)
+            self.cluster_prefixes[cluster_position] = (thresholds, prefixes)
+
+    def qualifying_bits(self, user_grades, user_mean_grade=None, user_cluster_points=None):
+        grades, mean_value, cluster_points = self.compiled.encode_profile(
+            user_grades, user_mean_grade, user_cluster_points
+        )
+        result = self.valid & self.mean_bitmaps[mean_value]
+        if not result:
+            return 0
+
+        cluster_ok = self.no_cut_off
+        for cluster_position, (thresholds, prefixes) in self.cluster_prefixes.items():
+            reached = bisect.bisect_right(thresholds, cluster_points[cluster_position])
+            if reached:
+                cluster_ok |= prefixes[reached - 1]
+        result &= cluster_ok
+
+        user_pairs = [(subject, value) for subject, value in enumerate(grades) if value]
+        for slot, bitmaps in enumerate(self.slot_bitmaps):
+            if not result:
+                break
+            satisfied = self.slot_free[slot]
+            for pair in user_pairs:
+                satisfied |= bitmaps.get(pair, 0)
+            result &= satisfied
+        return result
+
+    def qualifying_indices(self, user_grades, user_mean_grade=None, user_cluster_points=None):
+        return list(iter_bits(self.qualifying_bits(user_grades, user_mean_grade, user_cluster_points)))
+
+    def qualifying_count(self, user_grades, user_mean_grade=None, user_cluster_points=None):
+        return self.qualifying_bits(user_grades, user_mean_grade, user_cluster_points).bit_count()
+
+    def qualifying_summary(self, user_grades, user_mean_grade=None, user_cluster_points=None):
+        """(qualifying course count, number of collections with at least one of them)"""
+        bits = self.qualifying_bits(user_grades, user_mean_grade, user_cluster_points)
+        if not bits:
+            return 0, 0
+        collections = sum(1 for bitmap in self.collection_bitmaps.values() if bitmap & bits)
+        return bits.bit_count(), collections
+
+
+class SortedLevel:
+    """A compiled level sorted by its gating threshold.
+
+    Degree courses are stored per cluster sorted by cut-off, every other level
+    as one array sorted by minimum mean grade. The courses a score can reach are
+    then a prefix found with ``bisect``, subject requirements are only checked
+    on that prefix, and walking the prefix from the lowest threshold yields the
+    courses ordered by margin above their threshold.
+    """
+
+    def __init__(self, compiled):
+        self.compiled = compiled
+        # group -> (ascending thresholds, course positions in the same order);
+        # the group is the cluster position for degree and None otherwise
+        entries = {}
+        for position, course in enumerate(compiled.courses):
+            if course.never:
+                continue
+            if compiled.kind == KIND_CLUSTER:
+                entries.setdefault(course.cluster_index, []).append((course.cut_off, position))
+            else:
+                entries.setdefault(None, []).append((course.min_mean, position))
+        self.groups = {}
+        for group, group_entries in entries.items():
+            group_entries.sort()
+            self.groups[group] = (
+                [threshold for threshold, _ in group_entries], [position for _, position in group_entries]
+            )
+
+    def _ranked_candidates(self, mean_value, cluster_points):
+        """Per group, (negated margin, position) of every course the score reaches, best margin first"""
+        for group, (thresholds, positions) in self.groups.items():
+            if group is None:
+                score = mean_value
+            else:
+                score = cluster_points[group] if group >= 0 else 0
+            # A zero threshold means no requirement, so clamp the score at zero
+            reached = bisect.bisect_right(thresholds, max(score, 0))
+            yield [(thresholds[i] - score, positions[i]) for i in range(reached)]
+
+    def qualifying_ranked(self, user_grades, user_mean_grade=None, user_cluster_points=None):
+        """(margin, position) of every qualifying course, largest margin above the threshold first"""
+        grades, mean_value, cluster_points = self.compiled.encode_profile(
+            user_grades, user_mean_grade, user_cluster_points
+        )
+        courses = self.compiled.courses
+        return [
+            (-negated_margin, position)
+            for negated_margin, position in heapq.merge(*self._ranked_candidates(mean_value, cluster_points))
+            if courses[position].matches(grades, mean_value, cluster_points)
+        ]
+
+    def qualifying_indices(self, user_grades, user_mean_grade=None, user_cluster_points=None):
+        grades, mean_value, cluster_points = self.compiled.encode_profile(
+            user_grades, user_mean_grade, user_cluster_points
+        )
+        courses = self.compiled.courses
+        found = []
+        for group, (thresholds, positions) in self.groups.items():
+            if group is None:
+                score = mean_value
+            else:
+                score = cluster_points[group] if group >= 0 else 0
+            reached = bisect.bisect_right(thresholds, max(score, 0))
+            # Every course in the prefix meets its threshold; only the subjects remain
+            found.extend(
+                position for position in positions[:reached]
+                if courses[position].matches_subjects(grades)
+            )
+        found.sort()
+        return found
+
+
+class Requalification:
+    """Result of re-qualifying after a grade change: the new positions plus the difference"""
+    __slots__ = ('positions', 'added', 'removed', 'evaluated')
+
+    def __init__(self, positions, added, removed, evaluated):
+        self.positions = positions
+        self.added = added
+        self.removed = removed
+        # How many courses actually had to be re-checked
+        self.evaluated = evaluated
+
+
+class InvertedLevel:
+    """Indexes a compiled level by what can change between two submissions.
+
+    ``subject_courses`` lists, per subject, the courses whose requirements
+    mention it; mean grades and cut-offs are kept as sorted arrays per cluster.
+    A changed subject grade then re-checks only the courses mentioning it, and a
+    changed mean grade or cluster points a ``bisect`` range of one array.
+    """
+
+    def __init__(self, compiled):
+        self.compiled = compiled
+        subject_courses = [[] for _ in compiled.subject_index]
+        mean_entries = []
+        cluster_entries = {}
+        for position, course in enumerate(compiled.courses):
+            mentioned = set()
+            for _, subjects in course.groups:
+                mentioned.update(subjects)
+            for subject in mentioned:
+                subject_courses[subject].append(position)
+            if course.min_mean:
+                mean_entries.append((course.min_mean, position))
+            if course.cut_off:
+                cluster_entries.setdefault(course.cluster_index, []).append((course.cut_off, position))
+
+        self.subject_courses = [tuple(positions) for positions in subject_courses]
+        mean_entries.sort()
+        self.mean_thresholds = [threshold for threshold, _ in mean_entries]
+        self.mean_positions = [position for _, position in mean_entries]
+        # cluster position -> (sorted cut-offs, course positions in the same order)
+        self.cluster_cut_offs = {}
+        for cluster_position, entries in cluster_entries.items():
+            entries.sort()
+            self.cluster_cut_offs[cluster_position] = (
+                [cut_off for cut_off, _ in entries], [position for _, position in entries]
+            )
+
+    @staticmethod
+    def _between(thresholds, positions, before, after):
+        """Courses whose threshold lies in (low, high]: they flip when the value moves across it"""
+        low, high = min(before, after), max(before, after)
+        return positions[bisect.bisect_right(thresholds, low):bisect.bisect_right(thresholds, high)]
+
+    def affected(self, prior_profile, new_profile):
+        """Positions of the courses whose outcome can differ between two encoded profiles"""
+        prior_grades, prior_mean, prior_points = prior_profile
+        grades, mean_value, cluster_points = new_profile
+        affected = set()
+        for subject, (before, after) in enumerate(zip(prior_grades, grades)):
+            if before != after:
+                affected.update(self.subject_courses[subject])
+        if prior_mean != mean_value:
+            affected.update(self._between(self.mean_thresholds, self.mean_positions, prior_mean, mean_value))
+        for cluster_position, (thresholds, positions) in self.cluster_cut_offs.items():
+            before, after = prior_points[cluster_position], cluster_points[cluster_position]
+            if before != after:
+                affected.update(self._between(thresholds, positions, before, after))
+        return affected
+
+    def requalify(self, prior_positions, prior_profile, new_profile):
+        """Update a prior result for a changed grade profile.
+
+        Both profiles are raw ``(user_grades, user_mean_grade, user_cluster_points)``
+        tuples; ``prior_positions`` is the qualifying result of ``prior_profile``.
+        """
+        compiled = self.compiled
+        prior_encoded = compiled.encode_profile(*prior_profile)
+        encoded = compiled.encode_profile(*new_profile)
+        affected = self.affected(prior_encoded, encoded)
+
+        prior = set(prior_positions)
+        added = []
+        removed = []
+        for position in sorted(affected):
+            qualifies = compiled.courses[position].matches(*encoded)
+            if qualifies and position not in prior:
+                added.append(position)
+            elif not qualifies and position in prior:
+                removed.append(position)
+        positions = sorted((prior - set(removed)) | set(added))
+        return Requalification(positions, added, removed, len(affected))
+
+
+def _problem(course, collection_name, field, value, reason):
+    return {
+        'collection': collection_name,
+        'course_id': str(course.get('_id', '')),
+        'programme_code': course.get('programme_code') or course.get('course_code'),
+        'field': field,
+        'value': value if isinstance(value, (str, int, float)) or value is None else str(value),
+        'reason': reason
+    }
+
+
+def compile_course(course, kind, collection_name, subject_index, cluster_index, problems):
+    """Compile one raw course document, appending any unusable requirement to ``problems``"""
+    groups = []
+    never = False
+
+    requirements = course.get('minimum_subject_requirements', {})
+    if requirements and not isinstance(requirements, dict):
+        problems.append(_problem(course, collection_name, 'minimum_subject_requirements',
+                                 requirements, 'requirements are not a subject -> grade mapping'))
+        never = True
+        requirements = {}
+
+    for subject_key, required_grade in (requirements or {}).items():
+        parsed_grade = parse_grade(required_grade) if isinstance(required_grade, str) else None
+        if not parsed_grade:
+            problems.append(_problem(course, collection_name, f'minimum_subject_requirements.{subject_key}',
+                                     required_grade, 'grade cannot be parsed'))
+            never = True
+            continue
+        subjects = subject_key.split('/') if '/' in subject_key else [subject_key]
+        positions = []
+        for subject in subjects:
+            if subject not in subject_index:
+                subject_index[subject] = len(subject_index)
+            positions.append(subject_index[subject])
+        groups.append((GRADE_VALUES[parsed_grade], tuple(positions)))
+
+    min_mean = 0
+    cluster_position = -1
+    cut_off = 0
+
+    if kind == KIND_MEAN:
+        minimum_grade = course.get('minimum_grade', {})
+        if not isinstance(minimum_grade, dict):
+            problems.append(_problem(course, collection_name, 'minimum_grade',
+                                     minimum_grade, 'minimum_grade is not a mapping'))
+            never = True
+        else:
+            min_mean_grade = minimum_grade.get('mean_grade')
+            if min_mean_grade:
+                if min_mean_grade in GRADE_VALUES:
+                    min_mean = GRADE_VALUES[min_mean_grade]
+                else:
+                    problems.append(_problem(course, collection_name, 'minimum_grade.mean_grade',
+                                             min_mean_grade, 'mean grade cannot be parsed'))
+                    never = True
+    else:
+        cluster_name = course.get('cluster', '')
+        cut_off_points = course.get('cut_off_points', 0)
+        if cluster_name and cut_off_points:
+            if isinstance(cut_off_points, (int, float)):
+                if cluster_name not in cluster_index:
+                    cluster_index[cluster_name] = len(cluster_index)
+                cluster_position = cluster_index[cluster_name]
+                cut_off = cut_off_points
+            else:
+                problems.append(_problem(course, collection_name, 'cut_off_points',
+                                         cut_off_points, 'cut-off points are not numeric'))
+                never = True
+
+    return CompiledCourse(tuple(groups), min_mean, cluster_position, cut_off, never)
+
+
+def compile_level(level, kind, courses, collections, subject_codes=()):
+    """Compile every course of a level; ``collections`` is parallel to ``courses``"""
+    subject_index = {}
+    for code in subject_codes:
+        subject_index.setdefault(code, len(subject_index))
+    cluster_index = {}
+    problems = []
+
+    compiled = [
+        compile_course(course, kind, collection_name, subject_index, cluster_index, problems)
+        for course, collection_name in zip(courses, collections)
+    ]
+
+    if problems:
+        never_count = sum(1 for course in compiled if course.never)
+        logger.warning(
+            f"⚠️ {level}: {never_count} courses have requirements that can never be met "
+            f"({len(problems)} unparseable fields)"
+        )
+    return CompiledLevel(level, kind, compiled, subject_index, cluster_index, problems, collections)
+
+
+# --- Server-side Pushdown ---
+# Normalized numeric fields stored on every catalog document (see
+# scripts/normalize_catalog.py) so MongoDB can discard impossible courses
+# before they are shipped to Python. Documents without them are never filtered.
+PUSHDOWN_INDEXES = {
+    KIND_CLUSTER: [('cut_off_value', 1)],
+    KIND_MEAN: [('min_mean_value', 1)],
+}
+
+
+# Only the fields the qualification check reads; display fields are hydrated
+# afterwards for the qualifying courses alone (see CourseCatalog.hydrate)
+QUALIFICATION_PROJECTION = {
+    '_id': 1,
+    'minimum_subject_requirements': 1,
+    'minimum_grade': 1,
+    'cut_off_points': 1,
+}
+
+
+def normalize_course_document(course, kind, collection_name=None):
+    """Numeric requirement fields for a raw catalog document"""
+    if kind == KIND_CLUSTER and collection_name:
+        # Degree documents only get their cluster from the collection they live in
+        course = dict(course, cluster=collection_name)
+    subject_index = {}
+    compiled = compile_course(course, kind, collection_name, subject_index, {}, [])
+    subjects = {position: code for code, position in subject_index.items()}
+    return {
+        'requirement_groups': [
+            {'subjects': [subjects[position] for position in positions], 'min_value': threshold}
+            for threshold, positions in compiled.groups
+        ],
+        'min_mean_value': compiled.min_mean,
+        'cut_off_value': float(compiled.cut_off),
+        'requirements_valid': not compiled.never,
+    }
+
+
+def pushdown_filter(kind, collection_name, user_mean_grade=None, user_cluster_points=None):
+    """$match for one collection that keeps every course the profile could still qualify for"""
+    if kind == KIND_CLUSTER:
+        user_points = (user_cluster_points or {}).get(collection_name, 0) or 0
+        # Courses without a cut-off are normalized to 0, so clamp at 0 to keep them
+        threshold = {'cut_off_value': {'$lte': max(user_points, 0)}}
+        missing = {'cut_off_value': {'$exists': False}}
+    else:
+        mean_value = GRADE_VALUES.get(user_mean_grade, 0) if user_mean_grade else 0
+        threshold = {'min_mean_value': {'$lte': mean_value}}
+        missing = {'min_mean_value': {'$exists': False}}
+    return {
+        '$and': [
+            {'$or': [threshold, missing]},
+            {'requirements_valid': {'$ne': False}},
+        ]
+    }
+
+
+def loop_qualifying_indices(kind, courses, user_grades, user_mean_grade=None, user_cluster_points=None):
+    """Reference engine: run the check_*_qualification functions on every raw course"""
+    positions = []
+    for position, course in enumerate(courses):
+        try:
+            if kind == KIND_CLUSTER:
+                qualified = check_course_qualification(course, user_grades, user_cluster_points or {})
+            else:
+                qualified = check_diploma_course_qualification(course, user_grades, user_mean_grade)
+        except Exception as e:
+            logger.debug(f"Course {course.get('_id')} failed the qualification check: {str(e)}")
+            continue
+        if qualified:
+            positions.append(position)
+    return positions
+
+
+def qualifying_indices(compiled, courses, user_grades, user_mean_grade=None,
+                       user_cluster_points=None, engine=None):
+    """Positions of the qualifying courses of a level using the selected engine"""
+    engine = check_engine(engine)
+    if engine == ENGINE_LOOP:
+        return loop_qualifying_indices(compiled.kind, courses, user_grades, user_mean_grade, user_cluster_points)
+    if engine == ENGINE_VECTORIZED and np is not None:
+        return compiled.vectorized().qualifying_indices(user_grades, user_mean_grade, user_cluster_points)
+    if engine == ENGINE_BITSET:
+        return compiled.bitset().qualifying_indices(user_grades, user_mean_grade, user_cluster_points)
+    if engine == ENGINE_SORTED:
+        return compiled.sorted().qualifying_indices(user_grades, user_mean_grade, user_cluster_points)
+    return compiled.qualifying_indices(user_grades, user_mean_grade, user_cluster_points)
+
+
+def qualifying_count(compiled, courses, user_grades, user_mean_grade=None,
+                     user_cluster_points=None, engine=None):
+    """Number of qualifying courses of a level without materialising any of them"""
+    engine = check_engine(engine)
+    if engine == ENGINE_VECTORIZED and np is not None:
+        mask = compiled.vectorized().qualifying_mask(user_grades, user_mean_grade, user_cluster_points)
+        return int(mask.sum())
+    if engine in (ENGINE_BITSET, ENGINE_COMPILED):
+        return compiled.bitset().qualifying_count(user_grades, user_mean_grade, user_cluster_points)
+    return len(qualifying_indices(
+        compiled, courses, user_grades, user_mean_grade, user_cluster_points, engine=engine
+    ))
@@ -0,0 +1,160 @@
+# --- Qualification Result Cache ---
+"""Memoizes qualification results per canonical grade profile.
+
+On results-release day thousands of candidates submit identical profiles (same
+subject grades, same mean grade, same cluster points), so the qualifying course
+positions are cached per (level, profile, catalog version) with LRU eviction, a
+TTL and a size bound. Entries store positions into the catalog snapshot, not
+course dicts, and the whole cache is dropped when the catalog version changes.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from decimal import Decimal, ROUND_FLOOR, InvalidOperation
+
+QUALIFICATION_CACHE_SIZE = int(os.getenv('QUALIFICATION_CACHE_SIZE', '10000') or 0)
+QUALIFICATION_CACHE_TTL = int(os.getenv('QUALIFICATION_CACHE_TTL', '3600') or 0)
+
+# KUCCPS cut-off points are published with three decimals, so flooring the
+# candidate's points to three decimals never changes a cut-off comparison.
+# That only holds for cut-offs on this grid (see on_points_grid); levels with
+# finer cut-offs are keyed on the exact points.
+CLUSTER_POINTS_QUANTUM = Decimal('0.001')
+
+
+def canonical_cluster_points(user_cluster_points):
+    """Floor every cluster's points to three decimals (keys sorted)"""
+    canonical = {}
+    for cluster in sorted(user_cluster_points or {}):
+        points = user_cluster_points[cluster]
+        try:
+            canonical[cluster] = float(Decimal(str(points)).quantize(CLUSTER_POINTS_QUANTUM, rounding=ROUND_FLOOR))
+        except (InvalidOperation, ValueError, TypeError):
+            canonical[cluster] = points
+    return canonical
+
+
+def on_points_grid(value):
+    """True when ``value`` has at most three decimals (flooring points to three decimals cannot cross it)"""
+    try:
+        decimal = Decimal(str(value))
+        return decimal == decimal.quantize(CLUSTER_POINTS_QUANTUM)
+    except (InvalidOperation, ValueError, TypeError):
+        return False
+
+
+def profile_key(level, catalog_version, user_grades, user_mean_grade=None, user_cluster_points=None,
+                canonical_points=True):
+    """Stable hash of everything that decides a level's qualifying courses.
+
+    Cluster points are floored to three decimals unless ``canonical_points`` is
+    False; the key only groups profiles, evaluation always uses the exact points.
+    """
+    payload = {
+        'level': level,
+        'version': catalog_version,
+        'grades': sorted((user_grades or {}).items()),
+    }
+    if user_cluster_points is not None:
+        points = canonical_cluster_points(user_cluster_points) if canonical_points else user_cluster_points
+        payload['points'] = sorted(points.items())
+    else:
+        payload['mean'] = user_mean_grade or ''
+    encoded = json.dumps(payload, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+
+class QualificationCache:
+    """Thread-safe LRU + TTL cache of qualifying course positions"""
+
+    def __init__(self, max_size=QUALIFICATION_CACHE_SIZE, ttl=QUALIFICATION_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def _check_version(self, catalog_version):
+        # Called with the lock held: a new catalog makes every entry stale
+        if catalog_version != self._version:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._version = catalog_version
+
+    def get(self, key, catalog_version):
+        if not self.enabled:
+            return None
+        with self._lock:
+            self._check_version(catalog_version)
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored_at, positions = entry
+                if not self.ttl or time.monotonic() - stored_at <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return positions
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def peek(self, key, catalog_version):
+        """Like get() but without touching the LRU order or the hit/miss counters"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            if catalog_version != self._version:
+                return None
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, positions = entry
+            if self.ttl and time.monotonic() - stored_at > self.ttl:
+                return None
+            return positions
+
+    def put(self, key, catalog_version, positions):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._check_version(catalog_version)
+            self._entries[key] = (time.monotonic(), tuple(positions))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'entries': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'catalog_version': self._version
+            }
+
+
+# Shared per-worker cache used by the get_qualifying_* functions
+qualification_cache = QualificationCache()
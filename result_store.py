@@ -0,0 +1,253 @@
+# --- Server-side Result Store ---
+"""Keeps users' qualifying course lists on the server, out of the session.
+
+The session used to carry the whole course list under
+``{level}_courses_{index_number}``, so every request serialised, signed and
+shipped hundreds of course dicts in the cookie. Now the list is stored here,
+keyed by (index number, level, content version), and the session only keeps a
+small handle: the key, the course count and the bookkeeping flags.
+
+Entries live in a per-process LRU + TTL map. When a MongoDB collection is
+attached it is used as the shared tier, so any worker can resolve a handle
+written by another one; it stores course references (see catalog
+``course_ref``) and expires entries through a TTL index.
+
+``put_value``/``get_value`` store arbitrary session values the same way; the
+session size budget spills oversized keys here.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+from catalog import course_catalog
+
+logger = logging.getLogger(__name__)
+
+RESULT_STORE_SIZE = int(os.getenv('RESULT_STORE_SIZE', '5000') or 0)
+# Matches the 30 minute session lifetime with some slack
+RESULT_STORE_TTL = int(os.getenv('RESULT_STORE_TTL', '3600') or 0)
+RESULT_STORE_SHARED = os.getenv('RESULT_STORE_SHARED', 'true').lower() in ('1', 'true', 'yes')
+
+
+def result_version(courses):
+    """Content hash of a course list (ids in order), so a changed list gets a new key"""
+    digest = hashlib.sha1()
+    for course in courses:
+        digest.update(str(course.get('_id')).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()[:12]
+
+
+def _json_safe(course):
+    course_copy = dict(course)
+    if isinstance(course_copy.get('_id'), ObjectId):
+        course_copy['_id'] = str(course_copy['_id'])
+    return course_copy
+
+
+class ResultStore:
+    """Per-process LRU + TTL store of course lists with an optional MongoDB shared tier"""
+
+    def __init__(self, max_size=RESULT_STORE_SIZE, ttl=RESULT_STORE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._shared = None
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def attach(self, collection):
+        """Use ``collection`` as the shared tier (creates its TTL index)"""
+        if not RESULT_STORE_SHARED or collection is None:
+            return
+        try:
+            collection.create_index('expires_at', expireAfterSeconds=0)
+            self._shared = collection
+            logger.info("✅ Result store shared tier attached")
+        except Exception as e:
+            logger.error(f"❌ Error attaching result store shared tier: {str(e)}")
+
+    # --- Local tier ---
+    def _get_local(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, courses = entry
+            if self.ttl and time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return courses
+
+    def _written_recently(self, key):
+        """True (and the entry is marked used) when ``key`` was written less than half a TTL ago.
+
+        Keys are content-addressed, so such an entry already holds the same
+        value in both tiers and need not be written again.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (self.ttl and time.monotonic() - entry[0] >= self.ttl / 2):
+                return False
+            self._entries.move_to_end(key)
+            return True
+
+    def _put_local(self, key, courses, age=0):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() - age, courses)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    # --- Shared tier ---
+    def _put_shared(self, key, level, courses):
+        refs = []
+        for course in courses:
+            ref = course_catalog.course_ref(level, course)
+            if ref is None:
+                refs = None
+                break
+            refs.append(ref)
+        document = {'level': level, 'expires_at': datetime.utcnow() + timedelta(seconds=self.ttl or RESULT_STORE_TTL)}
+        if refs is not None:
+            document['course_refs'] = refs
+        else:
+            document['courses'] = courses
+        try:
+            self._shared.replace_one({'_id': key}, document, upsert=True)
+        except Exception as e:
+            logger.error(f"❌ Error writing result store entry: {str(e)}")
+
+    def _get_shared(self, key):
+        try:
+            document = self._shared.find_one({'_id': key})
+        except Exception as e:
+            logger.error(f"❌ Error reading result store entry: {str(e)}")
+            return None
+        if document is None:
+            return None
+        if 'value' in document:
+            return document['value']
+        if 'course_refs' in document:
+            courses = course_catalog.resolve(document['level'], document['course_refs'])
+            if len(courses) != len(document['course_refs']):
+                # Catalog changed under the entry: treat as missing so callers recompute
+                return None
+            return [_json_safe(course) for course in courses]
+        return document.get('courses') or []
+
+    # --- Handles ---
+    def put(self, index_number, level, courses, **flags):
+        """Store a course list; returns the session handle for it"""
+        courses = [_json_safe(course) for course in courses]
+        key = f"{index_number}:{level}:{result_version(courses)}"
+        if not self._written_recently(key):
+            self._put_local(key, courses)
+            if self._shared is not None:
+                self._put_shared(key, level, courses)
+        handle = {'result_key': key, 'courses_count': len(courses)}
+        handle.update(flags)
+        return handle
+
+    def get(self, handle):
+        """The course list behind a session handle (None when it expired everywhere)"""
+        key = (handle or {}).get('result_key')
+        if not key:
+            return None
+        courses = self._get_local(key)
+        if courses is not None:
+            self.hits += 1
+            return courses
+        if self._shared is not None:
+            courses = self._get_shared(key)
+            if courses is not None:
+                self.shared_hits += 1
+                # Unknown how long ago the shared copy was written: count it as half
+                # expired so the next put of this key rewrites (and renews) it
+                self._put_local(key, courses, age=self.ttl / 2 if self.ttl else 0)
+                return courses
+        self.misses += 1
+        return None
+
+    @staticmethod
+    def value_key(namespace, value):
+        """Content-addressed key put_value stores ``value`` under"""
+        encoded = json.dumps(value, sort_keys=True, default=str).encode('utf-8')
+        return f"{namespace}:{hashlib.sha1(encoded).hexdigest()[:16]}"
+
+    def _put_shared_value(self, key, value):
+        try:
+            self._shared.replace_one({'_id': key}, {
+                'value': value,
+                'expires_at': datetime.utcnow() + timedelta(seconds=self.ttl or RESULT_STORE_TTL)
+            }, upsert=True)
+        except Exception as e:
+            logger.error(f"❌ Error writing result store entry: {str(e)}")
+
+    def put_value(self, namespace, value):
+        """Store any session-serializable value; returns its content-addressed key"""
+        key = self.value_key(namespace, value)
+        if not self._written_recently(key):
+            self._put_local(key, value)
+            if self._shared is not None:
+                self._put_shared_value(key, value)
+        return key
+
+    def touch(self, key, value):
+        """Push back the expiry of a put_value entry that is still in use.
+
+        Rewritten at most once per half TTL (the local entry's age tells when it
+        was last written), so an active session does not write on every request.
+        """
+        if self._written_recently(key):
+            return False
+        self._put_local(key, value)
+        if self._shared is not None:
+            self._put_shared_value(key, value)
+        return True
+
+    def get_value(self, key):
+        """The value stored by put_value (None when it expired everywhere)"""
+        return self.get({'result_key': key})
+
+    def discard(self, handle):
+        key = (handle or {}).get('result_key')
+        if not key:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+        if self._shared is not None:
+            try:
+                self._shared.delete_one({'_id': key})
+            except Exception as e:
+                logger.error(f"❌ Error deleting result store entry: {str(e)}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'shared': self._shared is not None,
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+
+result_store = ResultStore()
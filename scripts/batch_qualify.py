@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""Qualify a whole class of candidates from a CSV or NDJSON file.
+
+CSV: one row per candidate with an id (or index_number) column, subject grade
+columns named by subject code (MAT, ENG, KIS, ...), a mean_grade column and
+cluster_1..cluster_20 (or cl1..cl20) columns for degree.
+NDJSON: {"id": ..., "grades": {"MAT": "B+", ...}, "mean_grade": "B", "cluster_points": {"cluster_1": 38.2}}
+
+Writes one NDJSON line per candidate with the qualifying courses per level.
+
+Usage:
+  python scripts/batch_qualify.py profiles.csv [--levels degree diploma] [--workers 4]
+                                  [--count-only] [--output results.ndjson]
+
+Configure MONGODB_URI in environment or in .env at repo root.
+"""
+import argparse
+import os
+import sys
+import time
+
+from pymongo import MongoClient
+
+# Load .env if available
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except Exception:
+    pass
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from batch import BATCH_WORKERS, detect_format, read_profiles, run_batch  # noqa: E402
+from catalog import register_course_levels  # noqa: E402
+from engine import qualification_engine  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('input', help='CSV or NDJSON file of grade profiles')
+    parser.add_argument('--levels', nargs='*', default=qualification_engine.levels(), help='course levels to evaluate')
+    parser.add_argument('--format', choices=['csv', 'ndjson'], help='input format (default: from the file extension)')
+    parser.add_argument('--workers', type=int, default=BATCH_WORKERS, help='worker processes')
+    parser.add_argument('--count-only', action='store_true', help='only count qualifying courses per level')
+    parser.add_argument('--output', help='NDJSON output file (default: stdout)')
+    args = parser.parse_args()
+
+    # Connected here, not at module level: spawned batch workers re-import this
+    # script and must not connect to MongoDB
+    mongodb_uri = os.environ.get('MONGODB_URI')
+    if not mongodb_uri:
+        print("ERROR: MONGODB_URI not set in environment or .env. Abort.", file=sys.stderr)
+        raise SystemExit(1)
+    register_course_levels(MongoClient(mongodb_uri))
+
+    with open(args.input, 'r', encoding='utf-8', newline='') as f:
+        profiles = read_profiles(f, args.format or detect_format(args.input))
+
+    started = time.perf_counter()
+    output = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    try:
+        for text in run_batch(profiles, args.levels, workers=args.workers, count_only=args.count_only):
+            output.write(text)
+    finally:
+        if args.output:
+            output.close()
+    elapsed = time.perf_counter() - started
+    print(f"✅ Qualified {len(profiles)} profiles for {', '.join(args.levels)} in {elapsed:.2f}s", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""Benchmark the qualification engines against each other on the live course catalog.
+
+Loads the catalog snapshot the same way the app does, generates random KCSE grade
+profiles and times every engine (loop, compiled, vectorized, bitset, sorted) per level.
+Every engine's result is checked against the reference loop engine, so this
+doubles as a parity check after changing the compiled/vectorized/bitset/sorted code.
+
+Usage:
+  python scripts/benchmark_qualification.py [--profiles 500] [--seed 42]
+
+Configure MONGODB_URI in environment or in .env at repo root.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+from pymongo import MongoClient
+
+# Load .env if available
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except Exception:
+    pass
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from catalog import CLUSTERS, CourseCatalog, register_course_levels  # noqa: E402
+from qualification import (  # noqa: E402
+    GRADE_VALUES, ENGINES, ENGINE_LOOP, SUBJECT_CODES, qualifying_indices, qualifying_count
+)
+
+
+def random_profile(rng):
+    """Random but plausible grade profile: 7-9 subjects, mean grade and cluster points"""
+    grades = list(GRADE_VALUES.keys())
+    subject_codes = sorted(SUBJECT_CODES)
+    user_grades = {code: rng.choice(grades) for code in rng.sample(subject_codes, rng.randint(7, 9))}
+    user_mean_grade = rng.choice(grades)
+    user_cluster_points = {cluster: round(rng.uniform(10, 48), 3) for cluster in CLUSTERS}
+    return user_grades, user_mean_grade, user_cluster_points
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--profiles', type=int, default=500, help='number of random grade profiles')
+    parser.add_argument('--seed', type=int, default=42, help='random seed for the profiles')
+    args = parser.parse_args()
+
+    mongodb_uri = os.environ.get('MONGODB_URI')
+    if not mongodb_uri:
+        print("ERROR: MONGODB_URI not set in environment or .env. Abort.")
+        raise SystemExit(1)
+    course_catalog = register_course_levels(MongoClient(mongodb_uri), CourseCatalog())
+
+    snapshot = course_catalog.snapshot()
+    print(f"Catalog version {snapshot.version}: {snapshot.counts()}")
+
+    rng = random.Random(args.seed)
+    profiles = [random_profile(rng) for _ in range(args.profiles)]
+    mismatches = 0
+
+    for level in snapshot.levels():
+        compiled = snapshot.compiled(level)
+        courses = snapshot.courses(level)
+        # Build lazily-built structures up front so they are not timed
+        compiled.bitset()
+        try:
+            compiled.vectorized()
+        except RuntimeError:
+            pass
+
+        reference = [
+            qualifying_indices(compiled, courses, grades, mean, points, engine=ENGINE_LOOP)
+            for grades, mean, points in profiles
+        ]
+        print(f"\n{level} ({len(courses)} courses)")
+        for engine in ENGINES:
+            started = time.perf_counter()
+            results = [
+                qualifying_indices(compiled, courses, grades, mean, points, engine=engine)
+                for grades, mean, points in profiles
+            ]
+            elapsed = time.perf_counter() - started
+
+            started = time.perf_counter()
+            counts = [
+                qualifying_count(compiled, courses, grades, mean, points, engine=engine)
+                for grades, mean, points in profiles
+            ]
+            count_elapsed = time.perf_counter() - started
+
+            engine_mismatches = sum(
+                1 for expected, got, count in zip(reference, results, counts)
+                if sorted(got) != expected or count != len(expected)
+            )
+            mismatches += engine_mismatches
+            print(
+                f"  {engine:<10} {elapsed / len(profiles) * 1000:8.3f} ms/profile"
+                f"  count-only {count_elapsed / len(profiles) * 1000:8.3f} ms/profile"
+                f"  mismatches {engine_mismatches}"
+            )
+
+    if mismatches:
+        print(f"\nFAILED: {mismatches} results differ from the loop engine")
+        raise SystemExit(1)
+    print("\nAll engines agree with the loop engine.")
+
+
+if __name__ == '__main__':
+    main()
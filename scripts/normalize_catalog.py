@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""Normalize the KUCCPS course collections once so qualification never re-parses raw data.
+
+Walks every course database (Degree, diploma, certificate, artisan, kmtc) and
+stores on each course document:
+ - requirement_groups / min_mean_value / cut_off_value / requirements_valid:
+   the parsed numeric requirements used by the server-side pushdown filters
+ - course_key: canonical level:collection:programme-code key
+ - course_id: the document _id as a stable string
+ - normalized_version: version of this normalization (bump NORMALIZATION_VERSION
+   when the fields change so the next run rewrites every course)
+
+Documents that are already up to date are not rewritten. Writes go through
+bulk_write in batches and progress is checkpointed after every batch, so an
+interrupted run resumes where it stopped. Finally the indexes the pushdown and
+course id lookups rely on are created.
+
+Usage:
+  python scripts/normalize_catalog.py [--dry-run] [--batch-size 500] [--levels degree diploma]
+                                      [--checkpoint /tmp/normalize_catalog_checkpoint.json] [--restart]
+
+The checkpoint defaults to the system temp directory (not the tracked backups/).
+
+Configure MONGODB_URI in environment or in .env at repo root.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+from pymongo import MongoClient, UpdateOne
+
+# Load .env if available
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except Exception:
+    pass
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from catalog import CourseCatalog, course_key, course_id, register_course_levels  # noqa: E402
+from qualification import normalize_course_document  # noqa: E402
+
+NORMALIZATION_VERSION = 1
+
+DEFAULT_CHECKPOINT = os.path.join(tempfile.gettempdir(), 'normalize_catalog_checkpoint.json')
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_checkpoint(path, checkpoint):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def normalized_fields(level, collection_name, course):
+    fields = normalize_course_document(course, level.kind, collection_name)
+    fields['course_key'] = course_key(level.name, collection_name, course)
+    fields['course_id'] = course_id(course)
+    fields['normalized_version'] = NORMALIZATION_VERSION
+    return fields
+
+
+def normalize_collection(level, collection_name, args, checkpoint):
+    """Normalize one collection in _id order, resuming after the checkpointed _id"""
+    progress_key = f"{level.name}.{collection_name}"
+    progress = checkpoint.setdefault(progress_key, {'last_id': None, 'updated': 0, 'unchanged': 0, 'done': False})
+    if progress['done'] and not args.restart:
+        print(f"  ⏭️ {progress_key}: already done ({progress['updated']} updated)")
+        return progress
+
+    collection = level.database[collection_name]
+    # _ids are stored as strings in the checkpoint; map them back via the collection's own values
+    last_id = None
+    if progress['last_id'] is not None:
+        last_doc = collection.find_one({'course_id': progress['last_id']}, {'_id': 1})
+        last_id = last_doc['_id'] if last_doc else None
+
+    while True:
+        query = {'_id': {'$gt': last_id}} if last_id is not None else {}
+        batch = list(collection.find(query).sort('_id', 1).limit(args.batch_size))
+        if not batch:
+            break
+
+        operations = []
+        for course in batch:
+            fields = normalized_fields(level, collection_name, course)
+            if all(course.get(name) == value for name, value in fields.items()):
+                progress['unchanged'] += 1
+                continue
+            operations.append(UpdateOne({'_id': course['_id']}, {'$set': fields}))
+
+        if operations and not args.dry_run:
+            result = collection.bulk_write(operations, ordered=False)
+            progress['updated'] += result.modified_count
+        else:
+            progress['updated'] += len(operations)
+
+        last_id = batch[-1]['_id']
+        # Only real runs may resume from a checkpoint; a dry run rewrites nothing
+        if not args.dry_run:
+            progress['last_id'] = course_id(batch[-1])
+            save_checkpoint(args.checkpoint, checkpoint)
+
+    progress['done'] = True
+    if not args.dry_run:
+        save_checkpoint(args.checkpoint, checkpoint)
+    verb = 'would update' if args.dry_run else 'updated'
+    print(f"  ✅ {progress_key}: {verb} {progress['updated']}, unchanged {progress['unchanged']}")
+    return progress
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dry-run', action='store_true', help='report what would change without writing')
+    parser.add_argument('--batch-size', type=int, default=500, help='documents per bulk_write batch')
+    parser.add_argument('--levels', nargs='*', help='only these levels (default: all)')
+    parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT, help='checkpoint file for resuming')
+    parser.add_argument('--restart', action='store_true', help='ignore the checkpoint and start over')
+    args = parser.parse_args()
+
+    mongodb_uri = os.environ.get('MONGODB_URI')
+    if not mongodb_uri:
+        print("ERROR: MONGODB_URI not set in environment or .env. Abort.")
+        raise SystemExit(1)
+    client = MongoClient(mongodb_uri)
+    course_catalog = register_course_levels(client, CourseCatalog())
+
+    checkpoint = {} if (args.restart or args.dry_run) else load_checkpoint(args.checkpoint)
+    if checkpoint.get('normalized_version') not in (None, NORMALIZATION_VERSION):
+        print(f"Checkpoint is for normalization version {checkpoint['normalized_version']}, starting over")
+        checkpoint = {}
+    checkpoint['normalized_version'] = NORMALIZATION_VERSION
+
+    levels = [
+        level for level in course_catalog.registered_levels()
+        if not args.levels or level.name in args.levels
+    ]
+    if args.dry_run:
+        print("DRY RUN: no documents or indexes will be written")
+
+    total_updated = 0
+    for level in levels:
+        print(f"\n{level.name}")
+        for collection_name in level.existing_collections(refresh=True):
+            total_updated += normalize_collection(level, collection_name, args, checkpoint)['updated']
+
+    if args.dry_run:
+        print(f"\nDry run complete: {total_updated} documents would be updated.")
+        return
+
+    print("\nCreating catalog indexes...")
+    created = course_catalog.ensure_pushdown_indexes()
+    print(f"✅ {created} indexes ensured")
+
+    # A finished run leaves nothing to resume
+    if os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    print(f"\nNormalization complete: {total_updated} documents updated.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+# --- Server-side Session Backend ---
+"""Wires Flask-Session so session data stays on the server.
+
+Without ``Session(app)`` Flask falls back to signed cookies and every session
+key (grades, cluster points, baskets, payment stubs) travels with each request.
+The backend is chosen with ``SESSION_BACKEND``:
+
+ - ``auto`` (default): ``mongodb`` when the database is connected, else ``cookie``
+ - ``memory``: cachelib ``SimpleCache`` in the worker (tests, single process)
+ - ``filesystem``: cachelib ``FileSystemCache`` under ``SESSION_FILE_DIR``; opt-in
+   only, since instance disks (Render) are per instance and wiped on every deploy
+ - ``mongodb``: the ``user_data.sessions`` collection with a TTL index
+ - ``cookie``: Flask's default signed cookie (no server-side store)
+
+Sessions are serialized with msgpack (msgspec) and expire after
+``PERMANENT_SESSION_LIFETIME`` in every backend. Opening and saving the session
+is timed per request; the timings are returned in a ``Server-Timing`` header
+and aggregated for the health endpoints. The size budget (session_budget.py)
+is applied at the same two points, so it sees the final session of a request.
+Endpoints in ``SESSION_FREE_ENDPOINTS`` (keep-alive, health checks, assets) get a
+null session: the backend is not read or written for them at all.
+"""
+import logging
+import os
+import threading
+import time
+
+from cachelib import FileSystemCache, SimpleCache
+from flask import g, request
+from flask.sessions import SessionInterface
+from flask_session import Session
+from werkzeug.exceptions import HTTPException
+
+from session_budget import session_budget
+
+logger = logging.getLogger(__name__)
+
+SESSION_BACKEND_MEMORY = 'memory'
+SESSION_BACKEND_FILESYSTEM = 'filesystem'
+SESSION_BACKEND_MONGODB = 'mongodb'
+SESSION_BACKEND_COOKIE = 'cookie'
+SESSION_BACKEND_AUTO = 'auto'
+SESSION_BACKENDS = (
+    SESSION_BACKEND_AUTO, SESSION_BACKEND_MEMORY, SESSION_BACKEND_FILESYSTEM,
+    SESSION_BACKEND_MONGODB, SESSION_BACKEND_COOKIE
+)
+
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', SESSION_BACKEND_AUTO).lower()
+SESSION_FILE_DIR = os.getenv('SESSION_FILE_DIR', os.path.join(os.getcwd(), 'flask_session'))
+SESSION_FILE_THRESHOLD = int(os.getenv('SESSION_FILE_THRESHOLD', '10000') or 10000)
+SESSION_MONGODB_COLLECTION = os.getenv('SESSION_MONGODB_COLLECTION', 'sessions')
+# Session loads or saves slower than this are logged
+SESSION_SLOW_MS = float(os.getenv('SESSION_SLOW_MS', '100') or 0)
+
+# Endpoints that never read or write the session (keep-alive, health checks, assets)
+SESSION_FREE_ENDPOINTS = frozenset({
+    'static', 'ping', 'keep_alive', 'health_check', 'api_status', 'monitor_health'
+})
+
+
+class SessionTimings:
+    """Thread-safe call count, average and maximum of session open/save durations"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = {}
+
+    def record(self, operation, elapsed_ms):
+        with self._lock:
+            calls, total_ms, max_ms = self._totals.get(operation, (0, 0.0, 0.0))
+            self._totals[operation] = (calls + 1, total_ms + elapsed_ms, max(max_ms, elapsed_ms))
+        if SESSION_SLOW_MS and elapsed_ms > SESSION_SLOW_MS:
+            logger.warning(f"⚠️ Slow session {operation}: {elapsed_ms:.1f}ms")
+
+    def stats(self):
+        with self._lock:
+            return {
+                operation: {
+                    'calls': calls,
+                    'avg_ms': round(total_ms / calls, 3) if calls else 0.0,
+                    'max_ms': round(max_ms, 3)
+                }
+                for operation, (calls, total_ms, max_ms) in self._totals.items()
+            }
+
+
+session_timings = SessionTimings()
+
+
+class TimedSessionInterface(SessionInterface):
+    """Delegates to the configured session interface, timing every open and save and applying the size budget"""
+
+    def __init__(self, inner, backend, free_endpoints=SESSION_FREE_ENDPOINTS):
+        self.inner = inner
+        self.backend = backend
+        self.free_endpoints = free_endpoints
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+    def make_null_session(self, app):
+        return self.inner.make_null_session(app)
+
+    def is_null_session(self, obj):
+        return self.inner.is_null_session(obj)
+
+    @staticmethod
+    def _endpoint(app, request):
+        # The session is opened before Flask matches the URL, so match it here
+        adapter = app.create_url_adapter(request)
+        if adapter is None:
+            return None
+        try:
+            rule, _ = adapter.match(return_rule=True)
+        except HTTPException:
+            return None
+        return rule.endpoint
+
+    def open_session(self, app, request):
+        if self._endpoint(app, request) in self.free_endpoints:
+            # Flask skips save_session for null sessions, so no backend I/O either way
+            return self.make_null_session(app)
+        started = time.perf_counter()
+        try:
+            session = self.inner.open_session(app, request)
+            if session is not None:
+                session_budget.restore(session)
+            return session
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            g.session_open_ms = elapsed_ms
+            session_timings.record('open', elapsed_ms)
+
+    def save_session(self, app, session, response):
+        started = time.perf_counter()
+        try:
+            if not session_budget.enforce(session, request.endpoint):
+                return None
+            return self.inner.save_session(app, session, response)
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            session_timings.record('save', elapsed_ms)
+            timing = f"session-save;dur={elapsed_ms:.2f}"
+            if 'session_open_ms' in g:
+                timing = f"session-open;dur={g.session_open_ms:.2f}, {timing}"
+            response.headers.add('Server-Timing', timing)
+
+
+def configure_session_backend(app, mongo_client=None, backend=SESSION_BACKEND):
+    """Install the server-side session interface on ``app``; returns the backend in use"""
+    if backend not in SESSION_BACKENDS:
+        logger.warning(f"⚠️ Unknown SESSION_BACKEND {backend!r}, using {SESSION_BACKEND_AUTO}")
+        backend = SESSION_BACKEND_AUTO
+    if backend == SESSION_BACKEND_AUTO:
+        # Sessions must survive deploys and be shared by every instance
+        backend = SESSION_BACKEND_MONGODB if mongo_client is not None else SESSION_BACKEND_COOKIE
+    if backend == SESSION_BACKEND_MONGODB and mongo_client is None:
+        logger.warning(f"⚠️ Database not connected, using {SESSION_BACKEND_COOKIE} sessions")
+        backend = SESSION_BACKEND_COOKIE
+
+    lifetime = int(app.permanent_session_lifetime.total_seconds())
+    app.config['SESSION_PERMANENT'] = True
+    app.config['SESSION_SERIALIZATION_FORMAT'] = 'msgpack'
+    if backend == SESSION_BACKEND_MEMORY:
+        app.config['SESSION_TYPE'] = 'cachelib'
+        app.config['SESSION_CACHELIB'] = SimpleCache(default_timeout=lifetime)
+    elif backend == SESSION_BACKEND_FILESYSTEM:
+        app.config['SESSION_TYPE'] = 'cachelib'
+        app.config['SESSION_CACHELIB'] = FileSystemCache(
+            SESSION_FILE_DIR, threshold=SESSION_FILE_THRESHOLD, default_timeout=lifetime
+        )
+    elif backend == SESSION_BACKEND_MONGODB:
+        # Flask-Session creates the TTL index on 'expiration'
+        app.config['SESSION_TYPE'] = 'mongodb'
+        app.config['SESSION_MONGODB'] = mongo_client
+        app.config['SESSION_MONGODB_DB'] = 'user_data'
+        app.config['SESSION_MONGODB_COLLECT'] = SESSION_MONGODB_COLLECTION
+
+    if backend != SESSION_BACKEND_COOKIE:
+        Session(app)
+    app.session_interface = TimedSessionInterface(app.session_interface, backend)
+    logger.info(f"✅ Sessions stored in {backend}")
+    return backend
+
+
+def session_backend_stats(app):
+    interface = app.session_interface
+    return {
+        'backend': getattr(interface, 'backend', SESSION_BACKEND_COOKIE),
+        'timings': session_timings.stats(),
+        'budget': session_budget.stats()
+    }
@@ -0,0 +1,236 @@
+# --- Session Size Budget ---
+"""Measures the serialized session per key and keeps it under a byte budget.
+
+Every session save encodes each key with the session serializer (msgpack) and
+records the sizes in per-key-family histograms (``degree_courses_{index}``
+rather than one entry per candidate). When the total exceeds
+``SESSION_BUDGET_BYTES``:
+
+ - ``evict`` (default): the largest derived keys (course lists, the basket,
+   payment stubs, manual activations) are moved to the server-side result store
+   and replaced with a small ``{'_spilled': key}`` marker; they are put back
+   transparently when the session is next opened
+ - ``refuse``: the keys this request grew are put back to the value they had
+   when the session was opened (new keys are dropped), largest first, until the
+   session fits; the rest of the session is still saved
+ - ``off``: only measure
+
+Either way the endpoint that pushed the session over budget is logged and
+counted. Sessions that were not modified during the request are not measured
+again. Spilled values that come back unchanged keep their marker, and their
+store entry's expiry is pushed back so it outlives the session.
+"""
+import copy
+import logging
+import os
+import re
+import threading
+from collections import Counter
+
+import msgspec
+
+from result_store import result_store
+
+logger = logging.getLogger(__name__)
+
+SESSION_BUDGET_MODE_EVICT = 'evict'
+SESSION_BUDGET_MODE_REFUSE = 'refuse'
+SESSION_BUDGET_MODE_OFF = 'off'
+
+# Browsers cap a cookie at about 4KB, which is also a sane ceiling for a server-side record
+SESSION_BUDGET_BYTES = int(os.getenv('SESSION_BUDGET_BYTES', '4096') or 0)
+SESSION_BUDGET_MODE = os.getenv('SESSION_BUDGET_MODE', SESSION_BUDGET_MODE_EVICT).lower()
+
+# Upper bounds (bytes) of the histogram buckets; larger values land in the last, open bucket
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536)
+
+# Keys that can be moved out of the session: derived data that is also kept in the database
+SPILLABLE_KEY = re.compile(r'^(course_basket|.+_courses_.+|.+_payment_.+|manual_activation_.+)$')
+PER_USER_KEY = re.compile(r'^(.+_(?:courses|payment)|manual_activation)_.+$')
+SPILL_MARKER = '_spilled'
+
+_encoder = msgspec.msgpack.Encoder()
+
+
+def key_family(key):
+    """Histogram name of a session key: the per-candidate suffix becomes {index}"""
+    return PER_USER_KEY.sub(r'\1_{index}', key)
+
+
+def bucket_label(size):
+    for bound in SIZE_BUCKETS:
+        if size <= bound:
+            return f"<={bound}"
+    return f">{SIZE_BUCKETS[-1]}"
+
+
+def encoded_size(value):
+    try:
+        return len(_encoder.encode(value))
+    except (TypeError, ValueError, OverflowError):
+        # Values the serializer cannot encode will fail the save anyway; size them as text
+        return len(str(value).encode('utf-8'))
+
+
+def is_spilled(value):
+    return isinstance(value, dict) and SPILL_MARKER in value
+
+
+class SessionBudget:
+    """Per-key size histograms plus the evict/refuse policy for oversized sessions"""
+
+    def __init__(self, budget=SESSION_BUDGET_BYTES, mode=SESSION_BUDGET_MODE):
+        self.budget = budget
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._totals = Counter()
+        self._over_budget = Counter()
+        self.spilled = 0
+        self.restored = 0
+        self.refused = 0
+        self.largest = 0
+
+    def measure(self, session):
+        """{key: serialized bytes} of a session, recorded in the histograms"""
+        sizes = {key: encoded_size(value) for key, value in session.items()}
+        total = sum(sizes.values())
+        with self._lock:
+            for key, size in sizes.items():
+                self._histograms.setdefault(key_family(key), Counter())[bucket_label(size)] += 1
+            self._totals[bucket_label(total)] += 1
+            self.largest = max(self.largest, total)
+        return sizes
+
+    def restore(self, session):
+        """Put spilled values back into a freshly opened session (without marking it modified)"""
+        spilled = [key for key, value in session.items() if is_spilled(value)]
+        if not spilled:
+            self._remember_opened(session)
+            return
+        modified = getattr(session, 'modified', False)
+        markers = {}
+        for key in spilled:
+            marker = session[key]
+            value = result_store.get_value(marker[SPILL_MARKER])
+            if value is None:
+                # Expired from the store: drop it, the database copy is reloaded on demand
+                del session[key]
+                continue
+            session[key] = copy.deepcopy(value)
+            markers[key] = marker
+            with self._lock:
+                self.restored += 1
+        # Remembered so an unchanged value goes back out as the same marker on save
+        session.spill_markers = markers
+        session.modified = modified
+        self._remember_opened(session)
+
+    def _remember_opened(self, session):
+        """Refuse mode: keep each key as opened (encoded, so later in-place changes do not leak in)"""
+        if self.mode != SESSION_BUDGET_MODE_REFUSE or not self.budget:
+            return
+        opened = {}
+        for key, value in session.items():
+            try:
+                opened[key] = _encoder.encode(value)
+            except (TypeError, ValueError, OverflowError):
+                continue
+        session.budget_opened = opened
+
+    def _respill_unchanged(self, session):
+        markers = getattr(session, 'spill_markers', None)
+        if not markers:
+            return
+        modified = getattr(session, 'modified', False)
+        for key, marker in markers.items():
+            if key in session and not is_spilled(session[key]):
+                namespace = marker[SPILL_MARKER].rsplit(':', 1)[0]
+                if result_store.value_key(namespace, session[key]) == marker[SPILL_MARKER]:
+                    # Still referenced: keep the stored copy from expiring under the session
+                    result_store.touch(marker[SPILL_MARKER], session[key])
+                    session[key] = marker
+        session.modified = modified
+
+    def enforce(self, session, endpoint=None):
+        """Measure the session before it is saved and bring it under budget; False means the write must be skipped"""
+        if not session:
+            return True
+        self._respill_unchanged(session)
+        if not getattr(session, 'modified', True):
+            # Unchanged since it was opened: it was measured when it was last saved
+            return True
+        sizes = self.measure(session)
+        total = sum(sizes.values())
+        if not self.budget or total <= self.budget or self.mode == SESSION_BUDGET_MODE_OFF:
+            return True
+
+        largest = sorted(sizes.items(), key=lambda item: item[1], reverse=True)[:3]
+        with self._lock:
+            self._over_budget[endpoint or 'unknown'] += 1
+        logger.warning(
+            f"⚠️ Session over budget after {endpoint}: {total} > {self.budget} bytes "
+            f"(largest: {', '.join(f'{key}={size}' for key, size in largest)})"
+        )
+
+        if self.mode == SESSION_BUDGET_MODE_REFUSE:
+            refused = self._refuse_changed(session, sizes, total)
+            with self._lock:
+                self.refused += len(refused)
+            if refused:
+                logger.warning(f"⚠️ Refused session changes after {endpoint}: {', '.join(refused)}")
+            return True
+
+        for key, size in sorted(sizes.items(), key=lambda item: item[1], reverse=True):
+            if total <= self.budget:
+                break
+            if not SPILLABLE_KEY.match(key) or is_spilled(session[key]):
+                continue
+            marker = {SPILL_MARKER: result_store.put_value(f"session:{key_family(key)}", session[key])}
+            session[key] = marker
+            total += encoded_size(marker) - size
+            with self._lock:
+                self.spilled += 1
+        return True
+
+    def _refuse_changed(self, session, sizes, total):
+        """Revert the largest keys changed since the session was opened until it fits; returns them"""
+        opened = getattr(session, 'budget_opened', {})
+        refused = []
+        for key, size in sorted(sizes.items(), key=lambda item: item[1], reverse=True):
+            if total <= self.budget:
+                break
+            if is_spilled(session[key]):
+                continue
+            before = opened.get(key)
+            if before is None:
+                del session[key]
+                total -= size
+            else:
+                try:
+                    if _encoder.encode(session[key]) == before:
+                        # Already this size when opened: not this request's doing
+                        continue
+                except (TypeError, ValueError, OverflowError):
+                    pass
+                session[key] = msgspec.msgpack.decode(before)
+                total += len(before) - size
+            refused.append(key)
+        return refused
+
+    def stats(self):
+        with self._lock:
+            return {
+                'budget_bytes': self.budget,
+                'mode': self.mode,
+                'largest_bytes': self.largest,
+                'spilled': self.spilled,
+                'restored': self.restored,
+                'refused': self.refused,
+                'total_sizes': dict(self._totals),
+                'key_sizes': {family: dict(counts) for family, counts in sorted(self._histograms.items())},
+                'over_budget_endpoints': dict(self._over_budget.most_common(10))
+            }
+
+
+session_budget = SessionBudget()
@@ -0,0 +1,181 @@
+"""BasketService write-behind buffer: batching, coalescing, flush order and duplicate drops.
+
+``BasketsCollection`` applies the update shapes BasketService sends (upsert
+with $setOnInsert, $pull by basket_id, $push guarded by $ne on basket fields)
+to in-memory documents and counts modifications the way MongoDB does, so this
+needs no database:
+
+  python -m pytest -q tests/test_basket.py
+"""
+import copy
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from basket import BasketService  # noqa: E402
+
+INDEX = '12345678/2024'
+
+
+class BasketsCollection:
+    def __init__(self):
+        self.documents = []
+        self.bulk_writes = 0
+        self.fail_next = False
+
+    def _find(self, query):
+        for document in self.documents:
+            if self._matches(document, query):
+                return document
+        return None
+
+    @staticmethod
+    def _matches(document, query):
+        for field, condition in query.items():
+            if field.startswith('basket.'):
+                # $ne on an array field: no element may hold the value
+                name = field.split('.', 1)[1]
+                if any(item.get(name) == condition['$ne'] for item in document.get('basket', [])):
+                    return False
+            elif document.get(field) != condition:
+                return False
+        return True
+
+    def _update(self, query, update, upsert=False):
+        """Apply one update; returns (matched, modified)"""
+        document = self._find(query)
+        if document is None:
+            if upsert:
+                document = {key: value for key, value in query.items() if not key.startswith('basket.')}
+                document.update(copy.deepcopy(update.get('$setOnInsert', {})))
+                self.documents.append(document)
+            return 0, 0
+        before = copy.deepcopy(document)
+        if '$pull' in update:
+            removed = set(update['$pull']['basket']['basket_id']['$in'])
+            document['basket'] = [item for item in document['basket'] if item.get('basket_id') not in removed]
+        if '$push' in update:
+            document.setdefault('basket', []).append(copy.deepcopy(update['$push']['basket']))
+        document.update(copy.deepcopy(update.get('$set', {})))
+        return 1, int(document != before)
+
+    def bulk_write(self, operations, ordered=True):
+        if self.fail_next:
+            self.fail_next = False
+            raise ConnectionError('primary stepped down')
+        self.bulk_writes += 1
+        modified = 0
+        for operation in operations:
+            modified += self._update(operation._filter, operation._doc, operation._upsert)[1]
+        return SimpleNamespace(modified_count=modified)
+
+    def update_one(self, query, update, upsert=False):
+        matched, modified = self._update(query, update, upsert)
+        return SimpleNamespace(matched_count=matched, modified_count=modified)
+
+    def find_one(self, query, projection=None):
+        document = self._find(query)
+        return copy.deepcopy(document) if document is not None else None
+
+    def basket_ids(self):
+        document = self._find({'index_number': INDEX}) or {}
+        return [item['basket_id'] for item in document.get('basket', [])]
+
+
+@pytest.fixture
+def collection():
+    return BasketsCollection()
+
+
+@pytest.fixture
+def service(collection):
+    # A long window: nothing is written until the test flushes
+    service = BasketService(window=60)
+    service.attach(collection)
+    yield service
+    service._stop.set()
+
+
+def item(course_id, basket_id=None, code=None):
+    return {
+        'level': 'degree', 'collection': 'cluster_1', 'course_id': course_id,
+        'basket_id': basket_id or f"b-{course_id}", 'programme_code': code or f"P{course_id}"
+    }
+
+
+def test_buffered_operations_are_written_in_one_batch(service, collection):
+    for course_id in ('1', '2', '3'):
+        assert service.add('a@example.com', INDEX, item(course_id))
+    assert collection.bulk_writes == 0
+    assert service.is_pending(INDEX)
+    assert service.flush(INDEX) == 1
+    assert collection.bulk_writes == 1
+    assert collection.basket_ids() == ['b-1', 'b-2', 'b-3']
+    assert not service.is_pending(INDEX)
+    assert service.stats()['writes'] == 1 and service.stats()['flushed'] == 3
+
+
+def test_pending_duplicate_and_add_then_remove(service, collection):
+    assert service.add('a@example.com', INDEX, item('1'))
+    assert not service.add('a@example.com', INDEX, item('1', basket_id='other'))
+    # Removed inside the window: never reaches the database
+    service.remove(INDEX, 'b-1')
+    assert not service.is_pending(INDEX)
+    assert service.flush(INDEX) == 0
+    assert collection.bulk_writes == 0
+    assert service.stats()['coalesced'] == 1
+
+
+def test_course_already_stored_is_dropped_and_reported(service, collection):
+    other_worker = BasketService(window=0)
+    other_worker.attach(collection)
+    other_worker.add('a@example.com', INDEX, item('1', basket_id='first'))
+
+    service.add('a@example.com', INDEX, item('1', basket_id='second'))
+    service.add('a@example.com', INDEX, item('2'))
+    service.flush(INDEX)
+    assert collection.basket_ids() == ['first', 'b-2']
+    assert service.take_dropped(INDEX) == ['second']
+    assert service.take_dropped(INDEX) == []
+    assert service.stats()['dropped'] == 1
+
+
+def test_remove_is_applied_before_re_adding_the_same_course(service, collection):
+    service.add('a@example.com', INDEX, item('1', basket_id='old'))
+    service.flush(INDEX)
+    service.remove(INDEX, 'old')
+    service.add('a@example.com', INDEX, item('1', basket_id='new'))
+    service.flush(INDEX)
+    assert collection.basket_ids() == ['new']
+    assert service.take_dropped(INDEX) == []
+
+
+def test_failed_batch_is_retried_before_newer_operations(service, collection):
+    service.add('a@example.com', INDEX, item('1'))
+    collection.fail_next = True
+    assert service.flush(INDEX) == 0
+    assert service.is_pending(INDEX)
+    service.add('a@example.com', INDEX, item('2'))
+    service.flush(INDEX)
+    assert collection.basket_ids() == ['b-1', 'b-2']
+    assert service.stats()['errors'] == 1
+
+
+def test_zero_window_writes_through(collection):
+    service = BasketService(window=0)
+    service.attach(collection)
+    service.add('a@example.com', INDEX, item('1'))
+    assert collection.basket_ids() == ['b-1']
+
+
+def test_load_flushes_and_clear_discards_pending(service, collection):
+    service.add('a@example.com', INDEX, item('1'))
+    assert [entry['basket_id'] for entry in service.load(INDEX)] == ['b-1']
+    service.add('a@example.com', INDEX, item('2'))
+    assert service.clear(INDEX)
+    assert not service.is_pending(INDEX)
+    assert service.load(INDEX) is None
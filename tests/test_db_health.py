@@ -0,0 +1,62 @@
+"""ConnectionHealthMonitor state from heartbeat events, without a MongoDB server.
+
+  python -m pytest -q tests/test_db_health.py
+"""
+import os
+import sys
+
+from pymongo.hello import Hello
+from pymongo.monitoring import ServerHeartbeatFailedEvent, ServerHeartbeatSucceededEvent
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from db_health import STATE_DEGRADED, STATE_HEALTHY, ConnectionHealthMonitor  # noqa: E402
+
+PRIMARY = ('db-0.example.net', 27017)
+SECONDARY = ('db-1.example.net', 27017)
+
+
+def hello(writable=True):
+    return Hello({'ok': 1, 'isWritablePrimary': writable, 'secondary': not writable, 'setName': 'rs0'})
+
+
+def succeeded(address, seconds, writable=True, awaited=False):
+    return ServerHeartbeatSucceededEvent(seconds, hello(writable), address, awaited=awaited)
+
+
+def test_awaited_heartbeat_is_not_a_latency_sample():
+    monitor = ConnectionHealthMonitor(slow_ms=2000)
+    monitor.succeeded(succeeded(PRIMARY, 0.004))
+    # Streaming heartbeats wait about heartbeatFrequencyMS on the server
+    monitor.succeeded(succeeded(PRIMARY, 10.0, awaited=True))
+    assert monitor.healthy
+    assert monitor.state == STATE_HEALTHY
+    stats = monitor.stats()
+    assert stats['max_latency_ms'] == 4.0
+    assert stats['servers'][str(PRIMARY)]['latency_ms'] == 4.0
+
+
+def test_awaited_heartbeat_alone_is_healthy():
+    monitor = ConnectionHealthMonitor(slow_ms=2000)
+    monitor.succeeded(succeeded(PRIMARY, 10.0, awaited=True))
+    assert monitor.state == STATE_HEALTHY
+    assert monitor.stats()['last_latency_ms'] is None
+
+
+def test_slow_polled_heartbeat_degrades():
+    monitor = ConnectionHealthMonitor(slow_ms=2000)
+    monitor.succeeded(succeeded(PRIMARY, 3.0))
+    assert monitor.state == STATE_DEGRADED
+    monitor.succeeded(succeeded(PRIMARY, 0.01))
+    assert monitor.state == STATE_HEALTHY
+
+
+def test_secondary_alone_is_degraded():
+    monitor = ConnectionHealthMonitor(slow_ms=2000)
+    monitor.succeeded(succeeded(PRIMARY, 0.004))
+    monitor.succeeded(succeeded(SECONDARY, 0.004, writable=False))
+    monitor.failed(ServerHeartbeatFailedEvent(5.0, ConnectionError('timed out'), PRIMARY))
+    assert not monitor.healthy
+    # A primary that comes back through a streaming heartbeat is healthy again
+    monitor.succeeded(succeeded(PRIMARY, 10.0, awaited=True))
+    assert monitor.healthy
@@ -0,0 +1,103 @@
+"""QualificationCache LRU / TTL / catalog-version behaviour and the profile key.
+
+  python -m pytest -q tests/test_qualification_cache.py
+"""
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import qualification_cache as cache_module  # noqa: E402
+from qualification_cache import QualificationCache, on_points_grid, profile_key  # noqa: E402
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_module, 'time', SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = QualificationCache(max_size=2, ttl=0)
+    cache.put('a', 'v1', [1])
+    cache.put('b', 'v1', [2])
+    assert cache.get('a', 'v1') == (1,)
+    cache.put('c', 'v1', [3])
+    assert cache.get('b', 'v1') is None
+    assert cache.get('a', 'v1') == (1,)
+    assert cache.get('c', 'v1') == (3,)
+    assert cache.stats()['evictions'] == 1
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = QualificationCache(max_size=10, ttl=60)
+    cache.put('a', 'v1', [1, 2])
+    clock.now += 60
+    assert cache.get('a', 'v1') == (1, 2)
+    clock.now += 1
+    assert cache.get('a', 'v1') is None
+    assert cache.peek('a', 'v1') is None
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (1, 1, 0)
+
+
+def test_new_catalog_version_drops_every_entry():
+    cache = QualificationCache(max_size=10, ttl=0)
+    cache.put('a', 'v1', [1])
+    cache.put('b', 'v1', [2])
+    assert cache.get('a', 'v2') is None
+    assert cache.stats()['invalidations'] == 1
+    # The old entries are gone, not just hidden
+    assert cache.get('b', 'v1') is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_peek_leaves_order_and_counters_alone():
+    cache = QualificationCache(max_size=2, ttl=0)
+    cache.put('a', 'v1', [1])
+    cache.put('b', 'v1', [2])
+    assert cache.peek('a', 'v1') == (1,)
+    assert cache.peek('a', 'v2') is None
+    cache.put('c', 'v1', [3])
+    # peek did not refresh 'a', so it was the one evicted
+    assert cache.peek('a', 'v1') is None
+    assert cache.stats()['hits'] == cache.stats()['misses'] == 0
+
+
+def test_disabled_cache_stores_nothing():
+    cache = QualificationCache(max_size=0)
+    cache.put('a', 'v1', [1])
+    assert cache.get('a', 'v1') is None
+    assert not cache.stats()['enabled']
+
+
+def test_profile_key_groups_equivalent_profiles():
+    grades = {'MAT': 'A', 'ENG': 'B+'}
+    key = profile_key('degree', 'v1', grades, None, {'cluster_1': 38.1234, 'cluster_2': 30.0})
+    assert key == profile_key('degree', 'v1', dict(reversed(grades.items())), None,
+                              {'cluster_2': 30.0, 'cluster_1': 38.1239})
+    assert key != profile_key('degree', 'v1', grades, None, {'cluster_1': 38.124, 'cluster_2': 30.0})
+    assert key != profile_key('degree', 'v2', grades, None, {'cluster_1': 38.1234, 'cluster_2': 30.0})
+    # Exact points for levels whose cut-offs are finer than three decimals
+    assert profile_key('degree', 'v1', grades, None, {'cluster_1': 38.1234}, canonical_points=False) != \
+        profile_key('degree', 'v1', grades, None, {'cluster_1': 38.1239}, canonical_points=False)
+    assert profile_key('diploma', 'v1', grades, 'B') != profile_key('diploma', 'v1', grades, 'B-')
+
+
+def test_points_grid():
+    assert on_points_grid(38.125)
+    assert on_points_grid(40)
+    assert not on_points_grid(38.1254)
+    assert not on_points_grid('n/a')
@@ -0,0 +1,136 @@
+"""Every qualification engine must agree with the reference loop over the raw check_* functions.
+
+Runs over synthetic degree (cluster cut-off) and diploma (mean grade) catalogs,
+so it needs neither MongoDB nor the Flask app:
+
+  python -m pytest -q tests/test_qualification_engines.py
+"""
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from qualification import (  # noqa: E402
+    ENGINE_LOOP, ENGINE_VECTORIZED, ENGINES, GRADE_VALUES, KIND_CLUSTER, KIND_MEAN,
+    check_engine, compile_level, loop_qualifying_indices, np, qualifying_count, qualifying_indices
+)
+
+GRADES = list(GRADE_VALUES)
+SUBJECTS = ['MAT', 'ENG', 'KIS', 'CHE', 'BIO', 'PHY', 'GEO', 'HAG', 'CRE', 'BST', 'COM', 'AGR']
+CLUSTERS = [f"cluster_{i}" for i in range(1, 7)]
+DIPLOMA_COLLECTIONS = ['Business_Related', 'Computing_IT_Related', 'Health_Sciences_Related']
+# Cut-offs shared by courses and profiles, so points exactly at a cut-off are covered
+CUT_OFFS = [0, 18.5, 24.125, 31.2, 36.667, 40.0, 44.891]
+
+COMPARED_ENGINES = [
+    pytest.param(
+        engine,
+        marks=pytest.mark.skipif(engine == ENGINE_VECTORIZED and np is None, reason='numpy not installed')
+    )
+    for engine in ENGINES if engine != ENGINE_LOOP
+]
+
+
+def random_requirements(rng):
+    requirements = {}
+    for _ in range(rng.randint(0, 4)):
+        if rng.random() < 0.3:
+            key = '/'.join(rng.sample(SUBJECTS, rng.randint(2, 3)))
+        else:
+            key = rng.choice(SUBJECTS)
+        roll = rng.random()
+        if roll < 0.1:
+            grade = f"{rng.choice(GRADES)}/{rng.choice(GRADES)}"
+        elif roll < 0.13:
+            grade = 'X'  # unparseable: the course can never be met
+        else:
+            grade = rng.choice(GRADES[:9])
+        requirements[key] = grade
+    return requirements
+
+
+def degree_catalog(rng, per_cluster=40):
+    courses, collections = [], []
+    for cluster in CLUSTERS:
+        for _ in range(per_cluster):
+            courses.append({
+                'cluster': cluster,
+                'cut_off_points': rng.choice(CUT_OFFS) if rng.random() < 0.5 else round(rng.uniform(10, 46), 3),
+                'minimum_subject_requirements': random_requirements(rng),
+            })
+            collections.append(cluster)
+    return compile_level('degree', KIND_CLUSTER, courses, collections), courses
+
+
+def diploma_catalog(rng, per_collection=60):
+    courses, collections = [], []
+    for collection_name in DIPLOMA_COLLECTIONS:
+        for _ in range(per_collection):
+            course = {'minimum_subject_requirements': random_requirements(rng)}
+            if rng.random() < 0.85:
+                course['minimum_grade'] = {'mean_grade': rng.choice(GRADES[:10])}
+            courses.append(course)
+            collections.append(collection_name)
+    return compile_level('diploma', KIND_MEAN, courses, collections), courses
+
+
+def random_profile(rng, kind):
+    grades = {subject: rng.choice(GRADES) for subject in rng.sample(SUBJECTS, rng.randint(5, 9))}
+    cluster_points = None
+    if kind == KIND_CLUSTER:
+        cluster_points = {
+            cluster: rng.choice(CUT_OFFS) if rng.random() < 0.3 else round(rng.uniform(10, 48), 3)
+            for cluster in CLUSTERS if rng.random() < 0.9
+        }
+    return grades, rng.choice(GRADES), cluster_points
+
+
+@pytest.fixture(scope='module', params=['degree', 'diploma'])
+def catalog(request):
+    rng = random.Random(7)
+    compiled, courses = degree_catalog(rng) if request.param == 'degree' else diploma_catalog(rng)
+    profiles = [random_profile(rng, compiled.kind) for _ in range(150)]
+    return compiled, courses, profiles
+
+
+@pytest.mark.parametrize('engine', COMPARED_ENGINES)
+def test_engine_matches_loop(catalog, engine):
+    compiled, courses, profiles = catalog
+    for grades, mean_grade, cluster_points in profiles:
+        expected = loop_qualifying_indices(compiled.kind, courses, grades, mean_grade, cluster_points)
+        got = qualifying_indices(compiled, courses, grades, mean_grade, cluster_points, engine=engine)
+        assert sorted(got) == expected
+        assert qualifying_count(compiled, courses, grades, mean_grade, cluster_points, engine=engine) == len(expected)
+
+
+def test_inverted_requalify_matches_loop(catalog):
+    compiled, courses, profiles = catalog
+    rng = random.Random(11)
+    inverted = compiled.inverted()
+    for prior in profiles:
+        grades, mean_grade, cluster_points = prior
+        grades = dict(grades)
+        for subject in rng.sample(SUBJECTS, 2):
+            grades[subject] = rng.choice(GRADES)
+        if rng.random() < 0.5:
+            mean_grade = rng.choice(GRADES)
+        if cluster_points is not None:
+            cluster_points = dict(cluster_points, **{rng.choice(CLUSTERS): rng.choice(CUT_OFFS)})
+        changed = (grades, mean_grade, cluster_points)
+
+        prior_positions = loop_qualifying_indices(compiled.kind, courses, *prior)
+        result = inverted.requalify(prior_positions, prior, changed)
+        assert result.positions == loop_qualifying_indices(compiled.kind, courses, *changed)
+
+
+def test_unknown_engine_is_rejected(catalog):
+    compiled, courses, profiles = catalog
+    grades, mean_grade, cluster_points = profiles[0]
+    with pytest.raises(ValueError):
+        qualifying_indices(compiled, courses, grades, mean_grade, cluster_points, engine='fast')
+    with pytest.raises(ValueError):
+        check_engine('vectorised')
+    assert check_engine(ENGINE_LOOP) == ENGINE_LOOP
@@ -0,0 +1,150 @@
+"""ResultStore local tier, shared tier and the write-skipping of content-addressed keys.
+
+The shared tier is a dict-backed stand-in for the MongoDB collection, so this
+needs no database:
+
+  python -m pytest -q tests/test_result_store.py
+"""
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+from bson import ObjectId
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import result_store as store_module  # noqa: E402
+from result_store import ResultStore  # noqa: E402
+
+TTL = 600
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+class SharedCollection:
+    """The few collection methods the shared tier uses, over a dict"""
+
+    def __init__(self):
+        self.documents = {}
+        self.writes = 0
+        self.indexes = []
+
+    def create_index(self, field, **options):
+        self.indexes.append((field, options))
+
+    def replace_one(self, query, document, upsert=False):
+        self.writes += 1
+        self.documents[query['_id']] = dict(document, _id=query['_id'])
+
+    def find_one(self, query):
+        document = self.documents.get(query['_id'])
+        return dict(document) if document is not None else None
+
+    def delete_one(self, query):
+        self.documents.pop(query['_id'], None)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(store_module, 'time', SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+
+@pytest.fixture
+def shared():
+    return SharedCollection()
+
+
+def worker(shared=None, max_size=100):
+    store = ResultStore(max_size=max_size, ttl=TTL)
+    if shared is not None:
+        store.attach(shared)
+    return store
+
+
+def courses(*ids):
+    return [{'_id': course_id, 'programme_name': f"Course {course_id}"} for course_id in ids]
+
+
+def test_local_round_trip_and_handle(clock):
+    store = worker()
+    object_id = ObjectId()
+    handle = store.put('IDX1', 'degree', courses(object_id, 'b'), notified=True)
+    assert handle['courses_count'] == 2 and handle['notified'] is True
+    stored = store.get(handle)
+    assert [course['_id'] for course in stored] == [str(object_id), 'b']
+    # ObjectIds are stored as strings so the list stays session/JSON safe
+    assert isinstance(stored[0]['_id'], str)
+    assert store.get(None) is None
+
+
+def test_local_entries_expire_and_evict(clock):
+    store = worker(max_size=1)
+    first = store.put('IDX1', 'degree', courses('a'))
+    second = store.put('IDX2', 'degree', courses('b'))
+    assert store.get(first) is None
+    assert store.stats()['evictions'] == 1
+    clock.now += TTL + 1
+    assert store.get(second) is None
+    assert store.stats()['misses'] == 2
+
+
+def test_other_worker_reads_the_shared_tier(clock, shared):
+    writer, reader = worker(shared), worker(shared)
+    assert shared.indexes[0] == ('expires_at', {'expireAfterSeconds': 0})
+    handle = writer.put('IDX1', 'diploma', courses('a', 'b'))
+    assert [course['_id'] for course in reader.get(handle)] == ['a', 'b']
+    assert reader.stats()['shared_hits'] == 1
+    # Now cached locally by the reader too
+    reader.get(handle)
+    assert reader.stats()['hits'] == 1
+
+
+def test_same_content_is_written_once_per_half_ttl(clock, shared):
+    store = worker(shared)
+    for _ in range(3):
+        handle = store.put('IDX1', 'degree', courses('a'))
+    assert shared.writes == 1
+    clock.now += TTL / 2
+    assert store.put('IDX1', 'degree', courses('a')) == handle
+    assert shared.writes == 2
+    # A different list is a different key and is written
+    store.put('IDX1', 'degree', courses('a', 'b'))
+    assert shared.writes == 3
+
+
+def test_shared_hit_is_renewed_by_the_next_put(clock, shared):
+    handle = worker(shared).put('IDX1', 'degree', courses('a'))
+    reader = worker(shared)
+    reader.get(handle)
+    # The reader cannot tell how old the shared copy is, so its next put rewrites it
+    reader.put('IDX1', 'degree', courses('a'))
+    assert shared.writes == 2
+
+
+def test_values_round_trip_and_touch(clock, shared):
+    store = worker(shared)
+    value = {'status': 'paid', 'amount': 200}
+    key = store.put_value('session:payment', value)
+    assert key == ResultStore.value_key('session:payment', dict(reversed(value.items())))
+    assert worker(shared).get_value(key) == value
+    assert store.touch(key, value) is False
+    clock.now += TTL / 2
+    assert store.touch(key, value) is True
+    assert shared.writes == 2
+
+
+def test_discard_removes_both_tiers(clock, shared):
+    store = worker(shared)
+    handle = store.put('IDX1', 'degree', courses('a'))
+    store.discard(handle)
+    assert store.get(handle) is None
+    assert worker(shared).get(handle) is None
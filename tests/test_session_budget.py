@@ -0,0 +1,123 @@
+"""Session size budget on a real Flask app with the in-memory session backend.
+
+  python -m pytest -q tests/test_session_budget.py
+"""
+import os
+import sys
+
+import pytest
+from flask import Flask, jsonify, session
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from session_backend import SESSION_BACKEND_MEMORY, configure_session_backend  # noqa: E402
+from result_store import result_store  # noqa: E402
+from session_budget import (  # noqa: E402
+    SESSION_BUDGET_MODE_EVICT, SESSION_BUDGET_MODE_REFUSE, SPILL_MARKER, bucket_label, key_family, session_budget
+)
+
+BUDGET = 2048
+
+
+def courses(count):
+    return [
+        {'programme_name': f"Course {i}", 'programme_code': f"C{i:04d}", 'institution_name': 'University ' * 4}
+        for i in range(count)
+    ]
+
+
+@pytest.fixture
+def app(monkeypatch):
+    monkeypatch.setattr(session_budget, 'budget', BUDGET)
+    app = Flask(__name__)
+    app.secret_key = 'test'
+
+    @app.route('/set', methods=['POST'])
+    def set_keys():
+        from flask import request
+        for key, value in request.get_json().items():
+            session[key] = courses(value) if type(value) is int else value
+        return 'ok'
+
+    @app.route('/get')
+    def get_keys():
+        return jsonify({key: session[key] for key in session})
+
+    configure_session_backend(app, backend=SESSION_BACKEND_MEMORY)
+    return app
+
+
+def stored_session(app):
+    """The session as the backend holds it (markers included, nothing restored)"""
+    cache = app.config['SESSION_CACHELIB']
+    (data,) = [cache.get(key) for key in list(cache._cache)]
+    return data
+
+
+def test_evict_spills_and_restores(app, monkeypatch):
+    monkeypatch.setattr(session_budget, 'mode', SESSION_BUDGET_MODE_EVICT)
+    client = app.test_client()
+    client.post('/set', json={'degree_courses_1': 200, 'email': 'a@example.com'})
+
+    saved = stored_session(app)
+    marker = saved['degree_courses_1']
+    assert set(marker) == {SPILL_MARKER}
+    assert saved['email'] == 'a@example.com'
+
+    # Read back transparently, and an unchanged value goes out as the same marker
+    data = client.get('/get').get_json()
+    assert len(data['degree_courses_1']) == 200
+    assert stored_session(app)['degree_courses_1'] == marker
+
+    # A changed value is spilled again under a new content key
+    client.post('/set', json={'degree_courses_1': 201})
+    assert stored_session(app)['degree_courses_1'] != marker
+    assert len(client.get('/get').get_json()['degree_courses_1']) == 201
+
+
+def test_non_spillable_keys_stay_in_the_session(app, monkeypatch):
+    monkeypatch.setattr(session_budget, 'mode', SESSION_BUDGET_MODE_EVICT)
+    client = app.test_client()
+    client.post('/set', json={'notes': 'x' * (BUDGET * 2)})
+    assert stored_session(app)['notes'] == 'x' * (BUDGET * 2)
+
+
+def test_expired_spill_is_dropped_on_open(app, monkeypatch):
+    monkeypatch.setattr(session_budget, 'mode', SESSION_BUDGET_MODE_EVICT)
+    client = app.test_client()
+    client.post('/set', json={'diploma_courses_1': 200, 'email': 'a@example.com'})
+    result_store.discard({'result_key': stored_session(app)['diploma_courses_1'][SPILL_MARKER]})
+    data = client.get('/get').get_json()
+    assert 'diploma_courses_1' not in data
+    assert data['email'] == 'a@example.com'
+
+
+def test_key_families_and_buckets():
+    assert key_family('degree_courses_12345678/2024') == 'degree_courses_{index}'
+    assert key_family('manual_activation_12345678') == 'manual_activation_{index}'
+    assert key_family('course_basket') == 'course_basket'
+    assert bucket_label(64) == '<=64'
+    assert bucket_label(70000) == '>65536'
+
+
+def test_refuse_reverts_only_the_grown_key(app, monkeypatch):
+    monkeypatch.setattr(session_budget, 'mode', SESSION_BUDGET_MODE_REFUSE)
+    client = app.test_client()
+    client.post('/set', json={'degree_courses_1': 3, 'email': 'a@example.com'})
+
+    # The course list blows the budget; the payment flag set alongside must still be saved
+    client.post('/set', json={'degree_courses_1': 200, 'degree_payment_1': {'status': 'paid'}})
+    data = client.get('/get').get_json()
+    assert len(data['degree_courses_1']) == 3
+    assert data['degree_payment_1'] == {'status': 'paid'}
+    assert data['email'] == 'a@example.com'
+
+
+def test_refuse_drops_an_oversized_new_key(app, monkeypatch):
+    monkeypatch.setattr(session_budget, 'mode', SESSION_BUDGET_MODE_REFUSE)
+    client = app.test_client()
+    client.post('/set', json={'email': 'a@example.com'})
+    client.post('/set', json={'diploma_courses_1': 200, 'verified': True})
+    data = client.get('/get').get_json()
+    assert 'diploma_courses_1' not in data
+    assert data['verified'] is True